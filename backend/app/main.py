@@ -1,18 +1,46 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, EmailStr
 from uuid import uuid4
+import ast
+import keyword
 import subprocess
 import tempfile
 import textwrap
 from typing import Optional
 import os
-import requests
+import httpx
 from dotenv import load_dotenv
-from threading import Lock
+from threading import Event, Lock, Timer
+import queue
 import json
+import re
+import asyncio
+import codecs
+import hashlib
+import math
+import random
+import shutil
+import signal
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache, partial
 from typing import Optional, Dict, Any
 
+try:
+    import fcntl  # POSIX only; cache locking is skipped on Windows dev machines
+except ImportError:
+    fcntl = None
+
+try:
+    import resource  # POSIX only; per-run rlimits are skipped on Windows dev machines
+except ImportError:
+    resource = None
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -97,411 +125,4481 @@ class ExecuteRequest(BaseModel):
     code: str
     stdin: Optional[str] = None
     trace: Optional[bool] = False
+    profile: Optional[bool] = False
+
+
+class ProfileFunction(BaseModel):
+    name: str
+    line: int | None = None
+    calls: int | None = None
+    selfMs: float | None = None
+    totalMs: float | None = None
+
+
+class ProfileLine(BaseModel):
+    line: int
+    hits: int
+    timeMs: float
+
+
+class ProfileReport(BaseModel):
+    tool: str | None = None  # "cProfile" | "gprof" | "jvm-sampler"
+    totalMs: float | None = None
+    functions: list[ProfileFunction] = []  # top-N by self time
+    lines: list[ProfileLine] = []  # top-N by time (Python only)
+    note: str | None = None
 
 
 class ExecuteResponse(BaseModel):
     output: str | None = None
     stderr: str | None = None
-    trace: Optional[list[dict]] = None  # [{line:int, locals:{k:v_repr}}]
+    trace: Optional[list[dict]] = None  # [{line:int, set:{name_idx:v_repr}, del?:[name_idx]}]
+    traceId: str | None = None
+    traceNames: list[str] | None = None
+    traceInfo: dict | None = None
+    exitCode: int | None = None
+    wallTimeMs: float | None = None
+    cpuTimeMs: float | None = None
+    compileTimeMs: float | None = None
+    peakRssKb: int | None = None
+    limitHit: str | None = None  # "cpu" | "memory" | "output" | "processes" | "wall"
+    profile: ProfileReport | None = None
 
 
-@app.post("/execute", response_model=ExecuteResponse)
-def execute(req: ExecuteRequest):
-    lang = req.language.lower()
-    if lang not in {"python", "javascript", "cpp", "java"}:
-        raise HTTPException(status_code=400, detail="Unsupported language")
+class RunResult(subprocess.CompletedProcess):
+    """CompletedProcess plus the run's resource usage (times in seconds) and which limit, if any, ended it."""
 
-    try:
-        if lang == "python":
-            return run_python(req.code, req.stdin or "", trace=req.trace or False)
-        if lang == "javascript":
-            return run_node(req.code, req.stdin or "")
-        if lang == "cpp":
-            return run_cpp(req.code, req.stdin or "")
-        if lang == "java":
-            return run_java(req.code, req.stdin or "")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    def __init__(self, args, returncode, stdout=None, stderr=None, wall_time: float | None = None,
+                 cpu_time: float | None = None, peak_rss_kb: int | None = None, limit_hit: str | None = None):
+        super().__init__(args, returncode, stdout, stderr)
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.peak_rss_kb = peak_rss_kb
+        self.limit_hit = limit_hit
 
 
-def run_python(code: str, stdin: str, trace: bool = False) -> ExecuteResponse:
-    if not trace:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as f:
-            f.write(textwrap.dedent(code))
-            path = f.name
-        return run_process(["python", path], stdin)
-
-    # Tracing wrapper: collects locals per executed line
-    wrapper = f"""
-import sys, json
-trace = []
-def _trace(frame, event, arg):
-    if event != 'line':
-        return _trace
-    try:
-        locs = {{}}
-        for k,v in frame.f_locals.items():
-            # Filter out internal variables and built-ins
-            if k.startswith('__') or k in ['self', 'cls', 'args', 'kwargs']:
-                continue
-            try:
-                locs[k] = repr(v)[:200]
-            except Exception:
-                locs[k] = '<unrepr>'
-        trace.append({{'line': frame.f_lineno, 'locals': locs}})
-    except Exception:
-        pass
-    return _trace
-code = compile({repr(code)}, '<user>', 'exec')
-g = {{}}
-sys.settrace(_trace)
-try:
-    exec(code, g, g)
-except Exception as e:
-    import traceback
-    print('ERROR:' + traceback.format_exc(), file=sys.stderr)
-finally:
-    sys.settrace(None)
-print('TRACE_JSON:' + json.dumps(trace))
-"""
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as f:
-        f.write(wrapper)
-        wrapper_path = f.name
-    proc = subprocess.run(["python", wrapper_path], input=stdin, capture_output=True, text=True, timeout=7)
-    out = proc.stdout or ""
-    trace_json = None
-    if 'TRACE_JSON:' in out:
-        prefix, _, rest = out.partition('TRACE_JSON:')
-        out = prefix
-        try:
-            import json as _json
-            trace_json = _json.loads(rest.strip())
-        except Exception:
-            trace_json = None
-    return ExecuteResponse(output=out, stderr=proc.stderr or None if proc.returncode == 0 else (proc.stderr or 'Error'), trace=trace_json)
+def _ms(seconds: float | None) -> float | None:
+    return round(seconds * 1000, 2) if seconds is not None else None
 
 
-def run_node(code: str, stdin: str) -> ExecuteResponse:
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".js", delete=False) as f:
-        f.write(code)
-        path = f.name
-    return run_process(["node", path], stdin)
+# -------- Per-run resource limits --------
+# Cold processes and zygote children get rlimits; the warm JVM and Node runners
+# can't, so they cap heap and output inside the runtime instead.
 
+RUN_CPU_LIMIT = int(os.getenv("RUN_CPU_LIMIT", "4"))
+# Python trace and profile runs are slowed down by their tracer: they get a longer
+# wall clock than the normal 5s, and a CPU limit raised by the same factor
+TRACE_TIMEOUT = float(os.getenv("TRACE_TIMEOUT", "7"))
+TRACE_CPU_LIMIT = math.ceil(RUN_CPU_LIMIT * TRACE_TIMEOUT / 5)
+RUN_MEMORY_LIMIT_MB = int(os.getenv("RUN_MEMORY_LIMIT_MB", "256"))
+# RLIMIT_NPROC counts every process of the server's user, so this is only a fork-bomb guard
+RUN_MAX_PROCS = int(os.getenv("RUN_MAX_PROCS", "512"))
+RUN_MAX_OUTPUT_BYTES = int(os.getenv("RUN_MAX_OUTPUT_KB", "1024")) * 1024
 
-def run_cpp(code: str, stdin: str) -> ExecuteResponse:
-    with tempfile.TemporaryDirectory() as tmp:
-        src = f"{tmp}/main.cpp"
-        out = f"{tmp}/a.exe"
-        with open(src, "w") as f:
-            f.write(code)
-        compile_proc = subprocess.run(["g++", src, "-O2", "-static", "-s", "-o", out], capture_output=True, text=True)
-        if compile_proc.returncode != 0:
-            return ExecuteResponse(stderr=compile_proc.stderr)
-        return run_process([out], stdin)
+LIMIT_MESSAGES = {
+    "cpu": f"CPU time limit exceeded ({RUN_CPU_LIMIT}s)",
+    "memory": f"Memory limit exceeded ({RUN_MEMORY_LIMIT_MB} MB)",
+    "output": f"Output limit exceeded ({RUN_MAX_OUTPUT_BYTES // 1024} KB)",
+    "processes": f"Process limit exceeded ({RUN_MAX_PROCS})",
+    "wall": "Time limit exceeded",
+}
+MEMORY_ERROR_MARKERS = ("MemoryError", "std::bad_alloc", "java.lang.OutOfMemoryError", "heap out of memory")
+PROCESS_ERROR_MARKERS = ("BlockingIOError", "Resource temporarily unavailable")
 
+# Runtimes that reserve far more address space than they use and spawn their own
+# threads; they get a heap flag instead of RLIMIT_AS/RLIMIT_NPROC.
+JAVA_HEAP_FLAGS = [f"-Xmx{RUN_MEMORY_LIMIT_MB}m"]
+NODE_HEAP_FLAGS = [f"--max-old-space-size={RUN_MEMORY_LIMIT_MB}"]
 
-def run_java(code: str, stdin: str) -> ExecuteResponse:
-    with tempfile.TemporaryDirectory() as tmp:
-        # Extract class name from code
-        class_match = None
-        for line in code.split('\n'):
-            if 'public class' in line:
-                class_match = line.split('public class')[1].split()[0].strip('{').strip()
-                break
-        
-        if not class_match:
-            return ExecuteResponse(stderr="No public class found in Java code")
-        
-        src = f"{tmp}/{class_match}.java"
-        with open(src, "w") as f:
-            f.write(code)
-        
-        # Compile Java code
-        compile_proc = subprocess.run(["javac", src], capture_output=True, text=True, cwd=tmp)
-        if compile_proc.returncode != 0:
-            return ExecuteResponse(stderr=compile_proc.stderr)
-        
-        # Run Java code
-        return run_process(["java", class_match], stdin, cwd=tmp)
-
-
-def run_process(cmd: list[str], stdin: str, cwd: str = None) -> ExecuteResponse:
-    proc = subprocess.run(
-        cmd,
-        input=stdin,
-        capture_output=True,
-        text=True,
-        timeout=5,
-        cwd=cwd
-    )
-    return ExecuteResponse(output=proc.stdout, stderr=proc.stderr if proc.returncode != 0 else None)
 
+def run_rlimits(native: bool = True, file_size: int = RUN_MAX_OUTPUT_BYTES,
+                cpu_limit: int = RUN_CPU_LIMIT) -> dict[str, tuple[int, int]]:
+    """rlimits for one run, keyed by `resource` constant name so they can be sent to the zygote as JSON."""
+    memory = RUN_MEMORY_LIMIT_MB * 1024 * 1024
+    limits = {
+        "RLIMIT_CPU": (cpu_limit, cpu_limit + 1),
+        "RLIMIT_FSIZE": (file_size, file_size),
+    }
+    if native:
+        limits["RLIMIT_AS"] = (memory, memory)
+        if RUN_MAX_PROCS > 0:
+            limits["RLIMIT_NPROC"] = (RUN_MAX_PROCS, RUN_MAX_PROCS)
+    return limits
 
-# -------- AI: Ollama Integration --------
 
-def query_ollama(model: str, prompt: str) -> str:
-    """
-    Query the local Ollama API for AI responses.
-    
-    Args:
-        model: The model name to use (e.g., 'mistral:7b')
-        prompt: The prompt to send to the model
-        
-    Returns:
-        str: The response text from Ollama
-        
-    Raises:
-        requests.exceptions.RequestException: If request fails
-        ValueError: If response is invalid
-    """
-    try:
-        ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
-        
-        payload = {
-            "model": model,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "temperature": 0.3,
-                "top_p": 0.9,
-                "top_k": 40,
-                "repeat_penalty": 1.1,
-                "num_ctx": 4096
-            }
-        }
-        
-        response = requests.post(
-            f"{ollama_url}/api/generate",
-            json=payload,
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        data = response.json()
-        return data.get('response', '')
-            
-    except requests.exceptions.Timeout:
-        raise requests.exceptions.Timeout("Ollama request timed out after 120 seconds")
-    except requests.exceptions.RequestException as e:
-        raise requests.exceptions.RequestException(f"Ollama request failed: {str(e)}")
-    except Exception as e:
-        raise ValueError(f"Failed to parse Ollama response: {str(e)}")
+def apply_rlimits(limits: dict[str, tuple[int, int]]) -> None:
+    """preexec_fn for run processes; a limit the platform doesn't support is skipped."""
+    for name, (soft, hard) in limits.items():
+        try:
+            resource.setrlimit(getattr(resource, name), (soft, hard))
+        except (AttributeError, ValueError, OSError):
+            pass
+
+
+def rlimit_preexec(native: bool = True):
+    return partial(apply_rlimits, run_rlimits(native)) if resource is not None else None
+
+
+def detect_limit_hit(returncode: int | None, stderr: str | None, output_bytes: int = 0) -> str | None:
+    """Work out which limit ended a run from its exit status, output size and error text."""
+    if returncode is not None and returncode < 0:
+        if -returncode == getattr(signal, "SIGXCPU", None):
+            return "cpu"
+        if -returncode == getattr(signal, "SIGXFSZ", None):
+            return "output"
+    if output_bytes >= RUN_MAX_OUTPUT_BYTES:
+        return "output"
+    if returncode and stderr:
+        if any(marker in stderr for marker in MEMORY_ERROR_MARKERS):
+            return "memory"
+        if any(marker in stderr for marker in PROCESS_ERROR_MARKERS):
+            return "processes"
+    return None
+
+
+def read_capped(path: str) -> tuple[str, int]:
+    """Read a run's output file up to the output limit; returns (text, size on disk)."""
+    with open(path, "rb") as f:
+        data = f.read(RUN_MAX_OUTPUT_BYTES)
+        size = os.fstat(f.fileno()).st_size
+    return data.decode(errors="replace"), size
+
 
-def get_ollama_response(prompt: str) -> str:
+def read_peak_rss(pid: int) -> int | None:
     """
-    Get response from the configured Ollama model.
-    
-    Args:
-        prompt: The prompt to send to Ollama
-        
-    Returns:
-        str: The response text from Ollama
-        
-    Raises:
-        requests.exceptions.RequestException: If request fails
-        ValueError: If no valid model is configured
+    A running child's peak RSS in KB from /proc (Linux only).
+
+    wait4's ru_maxrss can't be used for cold runs: it keeps the high-water mark
+    of the forking server process across exec. Zygote children don't exec, so
+    the zygote uses theirs, less its preloads (see ZYGOTE_SRC).
     """
-    model_name = os.getenv("OLLAMA_MODEL", "mistral:7b")
-    
     try:
-        return query_ollama(model_name, prompt)
-    except Exception as e:
-        raise ValueError(f"Ollama error: {str(e)}")
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
 
 
-def get_ai_provider() -> str:
-    """Get the configured AI provider."""
-    return os.getenv("AI_PROVIDER", "ollama").lower()
+def limit_message(limit_hit: str, cpu_limit: int = RUN_CPU_LIMIT) -> str:
+    if limit_hit == "cpu":
+        return f"CPU time limit exceeded ({cpu_limit}s)"
+    return LIMIT_MESSAGES[limit_hit]
 
-def get_openai_response(prompt: str, api_key: str) -> str:
-    """
-    Make a request to OpenAI GPT-4o API.
-    
-    Args:
-        prompt: The prompt to send to OpenAI
-        api_key: The OpenAI API key
-        
-    Returns:
-        str: The response text from OpenAI
-        
-    Raises:
-        requests.exceptions.Timeout: If request times out
-        requests.exceptions.RequestException: If request fails
-    """
+
+def to_execute_response(proc: RunResult, compile_time: float | None = None,
+                        cpu_limit: int = RUN_CPU_LIMIT) -> ExecuteResponse:
+    stderr = proc.stderr if proc.returncode != 0 else None
+    if proc.limit_hit:
+        stderr = "\n".join(filter(None, [(stderr or "").rstrip("\n"), limit_message(proc.limit_hit, cpu_limit)]))
+    return ExecuteResponse(
+        output=proc.stdout,
+        stderr=stderr,
+        exitCode=proc.returncode,
+        wallTimeMs=_ms(proc.wall_time),
+        cpuTimeMs=_ms(proc.cpu_time),
+        compileTimeMs=_ms(compile_time),
+        peakRssKb=proc.peak_rss_kb,
+        limitHit=proc.limit_hit,
+    )
+
+
+def timeout_response(e: subprocess.TimeoutExpired) -> ExecuteResponse:
+    return ExecuteResponse(stderr=f"{LIMIT_MESSAGES['wall']} ({e.timeout:g}s)", limitHit="wall")
+
+
+# -------- Execution engine --------
+# Runs submissions on a dedicated thread pool sized to the available cores so a
+# burst of slow programs can never starve the server's shared threadpool (and
+# with it /api/ping). Requests beyond the concurrency limit wait in a bounded
+# queue; once that is full the server answers 503 with Retry-After.
+
+def _available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+EXECUTE_CONCURRENCY = int(os.getenv("EXECUTE_CONCURRENCY", str(_available_cores())))
+EXECUTE_QUEUE_SIZE = int(os.getenv("EXECUTE_QUEUE_SIZE", str(EXECUTE_CONCURRENCY * 4)))
+
+
+class ExecutionQueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Execution queue is full")
+        self.retry_after = retry_after
+
+
+class ExecutionEngine:
+    """Bounded-concurrency gate in front of the blocking language runners."""
+
+    def __init__(self, concurrency: int, queue_size: int):
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="execute")
+        self.running = 0
+        self.waiting = 0
+        self.avg_seconds = 1.0  # EWMA of run time, used for Retry-After
+        self._slots: asyncio.Semaphore | None = None
+
+    def retry_after(self) -> int:
+        backlog = self.running + self.waiting
+        return max(1, math.ceil(self.avg_seconds * backlog / self.concurrency))
+
+    @asynccontextmanager
+    async def slot(self, track_time: bool = True):
+        """Hold one execution slot; raises ExecutionQueueFull instead of queueing past the limit."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        if self._slots.locked() and self.waiting >= self.queue_size:
+            raise ExecutionQueueFull(self.retry_after())
+
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if track_time:
+                self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * (time.monotonic() - start)
+            self.running -= 1
+            self._slots.release()
+
+    async def run(self, fn, *args, **kwargs):
+        async with self.slot():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+
+execution_engine = ExecutionEngine(EXECUTE_CONCURRENCY, EXECUTE_QUEUE_SIZE)
+
+SUPPORTED_LANGUAGES = {"python", "javascript", "cpp", "java"}
+
+
+def run_submission(lang: str, code: str, stdin: str, trace: bool = False, profile: bool = False) -> ExecuteResponse:
     try:
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are a helpful coding assistant. Always respond with valid JSON only, no markdown formatting."
-                },
-                {
-                    "role": "user", 
-                    "content": prompt
-                }
-            ],
-            "temperature": 0.3,
-            "max_tokens": 1000
-        }
-        
-        resp = requests.post(
-            "https://api.openai.com/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=15
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data["choices"][0]["message"]["content"]
-        
-    except requests.exceptions.Timeout:
-        raise requests.exceptions.Timeout("OpenAI request timed out after 15 seconds")
-    except requests.exceptions.RequestException as e:
-        raise requests.exceptions.RequestException(f"OpenAI request failed: {str(e)}")
+        if lang == "python":
+            return run_python(code, stdin, trace=trace, profile=profile)
+        if lang == "javascript":
+            res = run_node(code, stdin)
+            if profile:
+                res.profile = ProfileReport(note="Profiling is not supported for JavaScript")
+            return res
+        if lang == "cpp":
+            return run_cpp(code, stdin, profile=profile)
+        if lang == "java":
+            return run_java(code, stdin, profile=profile)
+    except subprocess.TimeoutExpired as e:
+        return timeout_response(e)
+    raise ValueError(f"Unsupported language: {lang}")
+
 
-def get_anthropic_response(prompt: str, api_key: str) -> str:
+def build_submission(lang: str, code: str) -> tuple[str | None, str | None]:
     """
-    Make a request to Anthropic Claude API.
-    
-    Args:
-        prompt: The prompt to send to Claude
-        api_key: The Anthropic API key
-        
-    Returns:
-        str: The response text from Claude
-        
-    Raises:
-        requests.exceptions.Timeout: If request times out
-        requests.exceptions.RequestException: If request fails
+    Compile ahead of any runs so they all hit the compile cache.
+
+    Returns (artifact_dir, compile_error); both are None for interpreted languages.
     """
+    if lang == "cpp":
+        return compile_cpp(code)
+    if lang == "java":
+        class_name = find_java_class(code)
+        if not class_name:
+            return None, "No public class found in Java code"
+        worker = java_pool.acquire()
+        try:
+            return compile_java(code, class_name, worker)
+        finally:
+            if worker is not None:
+                java_pool.release(worker)
+    return None, None
+
+
+@app.post("/execute", response_model=ExecuteResponse)
+async def execute(req: ExecuteRequest):
+    lang = req.language.lower()
+    if lang not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    if req.trace and req.profile:
+        raise HTTPException(status_code=400, detail="trace and profile can't be combined")
+
     try:
-        headers = {
-            "x-api-key": api_key,
-            "Content-Type": "application/json",
-            "anthropic-version": "2023-06-01"
-        }
-        
-        payload = {
-            "model": "claude-3-5-sonnet-20241022",
-            "max_tokens": 1000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": f"Always respond with valid JSON only, no markdown formatting. {prompt}"
-                }
-            ]
-        }
-        
-        resp = requests.post(
-            "https://api.anthropic.com/v1/messages",
-            headers=headers,
-            json=payload,
-            timeout=15
+        return await execution_engine.run(
+            run_submission, lang, req.code, req.stdin or "", req.trace or False, req.profile or False
         )
-        resp.raise_for_status()
-        data = resp.json()
-        return data["content"][0]["text"]
-        
-    except requests.exceptions.Timeout:
-        raise requests.exceptions.Timeout("Anthropic request timed out after 15 seconds")
-    except requests.exceptions.RequestException as e:
-        raise requests.exceptions.RequestException(f"Anthropic request failed: {str(e)}")
+    except ExecutionQueueFull as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Execution queue is full, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
-def get_llm_response(prompt: str) -> str:
-    """
-    Get response from the configured LLM provider.
-    
-    Args:
-        prompt: The prompt to send to the LLM
-        
-    Returns:
-        str: The response text from the LLM
-        
-    Raises:
-        requests.exceptions.Timeout: If request times out
-        requests.exceptions.RequestException: If request fails
-        ValueError: If no valid API key is found
-    """
-    provider = get_ai_provider()
-    
-    if provider == "ollama":
-        return get_ollama_response(prompt)
-        
-    elif provider == "openai":
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found")
-        return get_openai_response(prompt, api_key)
-        
-    elif provider == "anthropic":
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY not found")
-        return get_anthropic_response(prompt, api_key)
-        
-    else:
-        raise ValueError(f"Unsupported AI provider: {provider}")
+# -------- Batch execution --------
 
-def create_fallback_response(error_message: str = "AI service temporarily unavailable. Please try again.") -> dict:
-    """
-    Create a standardized fallback response for AI service failures.
-    
-    Args:
-        error_message: The error message to include
-        
-    Returns:
-        dict: The fallback response
-    """
-    return {"error": error_message}
+BATCH_MAX_CASES = int(os.getenv("BATCH_MAX_CASES", "50"))
 
-# -------- AI: Gemini Proxy --------
-class AISuggestRequest(BaseModel):
+
+class BatchExecuteRequest(BaseModel):
     language: str
     code: str
-    cursor: int | None = None
-    goal: str | None = None
-    hints: list[str] | None = None
+    inputs: list[str]
+    stopOnFailure: bool = False
 
 
-class AISuggestResponse(BaseModel):
-    suggestions: list[str]
-    explanation: str | None = None
-    qualityNotes: list[str] | None = None
-    variables: list[str] | None = None
-    problemUnderstanding: str | None = None
-    bestApproach: str | None = None
-    algorithmName: str | None = None
-    timeComplexity: str | None = None
-    spaceComplexity: str | None = None
-    whyThisApproach: str | None = None
+class BatchCaseResult(BaseModel):
+    index: int
+    status: str  # "ok" | "error" | "timeout" | "skipped" | "busy" (no execution slot; retry it)
+    output: str | None = None
+    stderr: str | None = None
+    exitCode: int | None = None
+    wallTimeMs: float | None = None
+    cpuTimeMs: float | None = None
+    peakRssKb: int | None = None
+    limitHit: str | None = None
 
 
-class AIExplainRequest(BaseModel):
-    language: str
-    code: str
-    error: str | None = None
+class BatchExecuteResponse(BaseModel):
+    compileError: str | None = None
+    results: list[BatchCaseResult]
 
 
-class AIExplainResponse(BaseModel):
-    summary: str
-    lineFixes: list[str] | None = None
-    walkthrough: list[str] | None = None
-    beginnerExplanation: str | None = None
-    whyItHappened: str | None = None
-    howToFix: list[str] | None = None
-    proTip: str | None = None
+def run_case(lang: str, code: str, stdin: str, index: int) -> BatchCaseResult:
+    res = run_submission(lang, code, stdin)
+    if res.limitHit == "wall":
+        status = "timeout"
+    else:
+        status = "ok" if res.exitCode == 0 else "error"
+    return BatchCaseResult(
+        index=index,
+        status=status,
+        output=res.output,
+        stderr=res.stderr,
+        exitCode=res.exitCode,
+        wallTimeMs=res.wallTimeMs,
+        cpuTimeMs=res.cpuTimeMs,
+        peakRssKb=res.peakRssKb,
+        limitHit=res.limitHit,
+    )
 
 
-@app.post("/ai/suggest", response_model=AISuggestResponse)
-def ai_suggest(req: AISuggestRequest):
-    provider = get_ai_provider()
+@app.post("/execute/batch", response_model=BatchExecuteResponse)
+async def execute_batch(req: BatchExecuteRequest):
+    """
+    Compile once, then run every stdin in `inputs` in parallel (at most one
+    case per execution slot). With stopOnFailure, cases not yet started after
+    the first failure are reported as skipped. Cases turned away by a full
+    execution queue are reported as busy next to the ones that ran; only a
+    batch where nothing ran gets 503.
+    """
+    lang = req.language.lower()
+    if lang not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    if len(req.inputs) > BATCH_MAX_CASES:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_CASES} inputs per batch")
+
+    results: list[BatchCaseResult | None] = [None] * len(req.inputs)
+    window = asyncio.Semaphore(execution_engine.concurrency)
+    failed = asyncio.Event()
+    retry_after: list[int] = []
+
+    async def run_one(index: int, stdin: str):
+        async with window:
+            if failed.is_set():
+                return
+            try:
+                result = await execution_engine.run(run_case, lang, req.code, stdin, index)
+            except ExecutionQueueFull as e:
+                retry_after.append(e.retry_after)
+                results[index] = BatchCaseResult(index=index, status="busy")
+                return
+            results[index] = result
+            if req.stopOnFailure and result.status != "ok":
+                failed.set()
+
+    tasks = []
+    try:
+        _, compile_err = await execution_engine.run(build_submission, lang, req.code)
+        if compile_err is not None:
+            return BatchExecuteResponse(compileError=compile_err, results=[])
+        tasks = [asyncio.create_task(run_one(i, stdin)) for i, stdin in enumerate(req.inputs)]
+        await asyncio.gather(*tasks)
+        if retry_after and all(r is not None and r.status == "busy" for r in results):
+            raise ExecutionQueueFull(min(retry_after))
+    except ExecutionQueueFull as e:
+        for task in tasks:
+            task.cancel()
+        raise HTTPException(
+            status_code=503,
+            detail="Execution queue is full, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except Exception as e:
+        for task in tasks:
+            task.cancel()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return BatchExecuteResponse(
+        results=[r or BatchCaseResult(index=i, status="skipped") for i, r in enumerate(results)]
+    )
+
+
+# -------- Empirical complexity --------
+# Runs a submission on generated inputs of geometrically growing size, then fits
+# cpu time (and peak RSS) against the standard classes with a weighted least
+# squares fit of a + b*f(n). Weights of 1/y^2 make it a fit on relative error,
+# so the few large sizes don't drown out the small ones. Sizes run smallest
+# first on the batch window; once a run goes over the per-run budget or fails,
+# larger sizes are skipped since they could only be slower.
+
+COMPLEXITY_MIN_N = int(os.getenv("COMPLEXITY_MIN_N", "1000"))
+COMPLEXITY_POINTS = int(os.getenv("COMPLEXITY_POINTS", "7"))
+COMPLEXITY_MAX_N = int(os.getenv("COMPLEXITY_MAX_N", "1000000"))
+COMPLEXITY_RUN_BUDGET_MS = float(os.getenv("COMPLEXITY_RUN_BUDGET_MS", "1000"))
+# Below this spread between the fastest and slowest run, startup noise dominates
+COMPLEXITY_MIN_SIGNAL_MS = 20.0
+
+COMPLEXITY_CLASSES = [
+    ("O(1)", lambda n: 0.0),
+    ("O(log n)", lambda n: math.log2(n)),
+    ("O(n)", lambda n: n),
+    ("O(n log n)", lambda n: n * math.log2(n)),
+    ("O(n^2)", lambda n: n ** 2),
+    ("O(n^3)", lambda n: n ** 3),
+]
+COMPLEXITY_INPUTS = ("array", "sorted", "string", "n")
+
+
+class ComplexityRequest(BaseModel):
+    language: str
+    code: str
+    # stdin shape: "array" = n then n ints, "sorted" = same but ascending,
+    # "string" = n lowercase letters, "n" = just the number
+    inputKind: str = "array"
+    sizes: list[int] | None = None
+
+
+class ComplexityPoint(BaseModel):
+    n: int
+    status: str  # "ok" | "error" | "timeout" | "skipped"
+    cpuTimeMs: float | None = None
+    wallTimeMs: float | None = None
+    peakRssKb: int | None = None
+    limitHit: str | None = None
+
+
+class ComplexityFit(BaseModel):
+    complexity: str
+    confidence: float  # 0..1: fit quality times how clearly it beats the runner-up
+    note: str | None = None
+
+
+class ComplexityResponse(BaseModel):
+    compileError: str | None = None
+    points: list[ComplexityPoint]
+    time: ComplexityFit | None = None
+    space: ComplexityFit | None = None
+
+
+def complexity_input(kind: str, n: int) -> str:
+    """Deterministic stdin of size n for the given input kind."""
+    rng = random.Random(n)
+    if kind == "n":
+        return f"{n}\n"
+    if kind == "string":
+        return "".join(chr(97 + rng.randrange(26)) for _ in range(n)) + "\n"
+    values = [rng.randint(1, 10**9) for _ in range(n)]
+    if kind == "sorted":
+        values.sort()
+    return f"{n}\n{' '.join(map(str, values))}\n"
+
+
+def fit_growth(ns: list[int], ys: list[float]) -> list[tuple[float, float]]:
+    """Weighted least squares for y = a + b*f(n); returns (rss, r2) for each of COMPLEXITY_CLASSES."""
+    ws = [1 / max(y, 1e-3) ** 2 for y in ys]
+    sw = sum(ws)
+    y_mean = sum(w * y for w, y in zip(ws, ys)) / sw
+    total = sum(w * (y - y_mean) ** 2 for w, y in zip(ws, ys)) or 1e-12
+    fits = []
+    for _, f in COMPLEXITY_CLASSES:
+        fs = [f(n) for n in ns]
+        swf = sum(w * x for w, x in zip(ws, fs))
+        swff = sum(w * x * x for w, x in zip(ws, fs))
+        swy = sum(w * y for w, y in zip(ws, ys))
+        swfy = sum(w * x * y for w, x, y in zip(ws, fs, ys))
+        det = sw * swff - swf * swf
+        if det > 1e-12 * sw * swff:
+            b = (sw * swfy - swf * swy) / det
+            a = (swy - b * swf) / sw
+        else:
+            a, b = y_mean, 0.0
+        if b < 0:
+            a, b = y_mean, 0.0  # a shrinking cost means no growth at all
+        elif a < 0:
+            a, b = 0.0, swfy / swff  # no negative startup cost
+        rss = sum(w * (y - a - b * x) ** 2 for w, x, y in zip(ws, fs, ys))
+        fits.append((rss, 1 - rss / total))
+    return fits
+
+
+def best_complexity(ns: list[int], ys: list[float], min_signal: float) -> ComplexityFit | None:
+    if len(ns) < 3:
+        return None
+    if max(ys) - min(ys) < min_signal:
+        return ComplexityFit(
+            complexity="O(1)",
+            confidence=0.6,
+            note=f"No measurable growth between n={min(ns)} and n={max(ns)}; larger sizes may still show some",
+        )
+    fits = fit_growth(ns, ys)
+    ranked = sorted(range(len(fits)), key=lambda i: fits[i][0])
+    best, runner_up = fits[ranked[0]], fits[ranked[1]]
+    separation = 1 - best[0] / runner_up[0] if runner_up[0] > 0 else 1.0
+    confidence = max(0.0, min(1.0, best[1])) * separation
+    return ComplexityFit(complexity=COMPLEXITY_CLASSES[ranked[0]][0], confidence=round(confidence, 2))
+
+
+@app.post("/analyze/complexity", response_model=ComplexityResponse)
+async def analyze_complexity(req: ComplexityRequest):
+    """
+    Estimate time and space complexity by measurement rather than asking a model.
+
+    Compiles once, runs each size through the same paths as /execute and
+    reports every measurement alongside the best-fitting class per resource.
+    """
+    lang = req.language.lower()
+    if lang not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    if req.inputKind not in COMPLEXITY_INPUTS:
+        raise HTTPException(status_code=400, detail=f"inputKind must be one of {', '.join(COMPLEXITY_INPUTS)}")
+    sizes = sorted(set(req.sizes or [COMPLEXITY_MIN_N * 2 ** i for i in range(COMPLEXITY_POINTS)]))
+    if len(sizes) > BATCH_MAX_CASES or sizes[0] < 1 or sizes[-1] > COMPLEXITY_MAX_N:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Up to {BATCH_MAX_CASES} sizes between 1 and {COMPLEXITY_MAX_N}",
+        )
+
+    window = asyncio.Semaphore(execution_engine.concurrency)
+
+    async def measure(round_sizes: list[int]) -> list[ComplexityPoint]:
+        results: list[BatchCaseResult | None] = [None] * len(round_sizes)
+        stop = asyncio.Event()
+
+        async def run_one(index: int, n: int):
+            async with window:
+                if stop.is_set():
+                    return
+                stdin = complexity_input(req.inputKind, n)
+                result = await execution_engine.run(run_case, lang, req.code, stdin, index)
+                results[index] = result
+                if result.status != "ok" or (result.cpuTimeMs or result.wallTimeMs or 0) > COMPLEXITY_RUN_BUDGET_MS:
+                    stop.set()
+
+        tasks = [asyncio.create_task(run_one(i, n)) for i, n in enumerate(round_sizes)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        return [
+            ComplexityPoint(
+                n=n,
+                status=r.status,
+                cpuTimeMs=r.cpuTimeMs,
+                wallTimeMs=r.wallTimeMs,
+                peakRssKb=r.peakRssKb,
+                limitHit=r.limitHit,
+            ) if r else ComplexityPoint(n=n, status="skipped")
+            for n, r in zip(round_sizes, results)
+        ]
+
+    try:
+        _, compile_err = await execution_engine.run(build_submission, lang, req.code)
+        if compile_err is not None:
+            return ComplexityResponse(compileError=compile_err, points=[])
+        points = await measure(sizes)
+        ok_count = sum(p.status == "ok" for p in points)
+        if req.sizes is None and ok_count < 4 and all(p.status in ("ok", "skipped") for p in points):
+            # Slow code used up the budget early: fill in below the default range
+            smaller = [COMPLEXITY_MIN_N >> k for k in range(1, 5 - ok_count)]
+            points = await measure([n for n in reversed(smaller) if n >= 8]) + points
+    except ExecutionQueueFull as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Execution queue is full, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    ok = [p for p in points if p.status == "ok"]
+    timed = [(p.n, p.cpuTimeMs if p.cpuTimeMs is not None else p.wallTimeMs) for p in ok]
+    timed = [(n, t) for n, t in timed if t is not None]
+    time_fit = best_complexity([n for n, _ in timed], [t for _, t in timed], COMPLEXITY_MIN_SIGNAL_MS)
+    if time_fit is None:
+        failed = next((p for p in points if p.status not in ("ok", "skipped")), None)
+        reason = f"; n={failed.n} ended with {failed.status}" if failed else ""
+        return ComplexityResponse(
+            points=points,
+            time=ComplexityFit(complexity="unknown", confidence=0.0,
+                               note=f"Need at least 3 successful runs{reason}"),
+        )
+    sized = [(p.n, p.peakRssKb) for p in ok if p.peakRssKb is not None]
+    # RSS moves in pages, so demand a 1 MB spread before trusting growth
+    space_fit = best_complexity([n for n, _ in sized], [float(kb) for _, kb in sized], 1024.0)
+    return ComplexityResponse(points=points, time=time_fit, space=space_fit)
+
+
+# -------- Streaming execution --------
+# WebSocket protocol for /execute/stream:
+#   client -> {"language", "code", "stdin"?, "analyze"?}   first message, same shape as ExecuteRequest
+#   client -> {"stdin": "..."} | {"eof": true} | {"kill": true}   while the program runs
+#   server -> {"type": "stdout" | "stderr", "data": "..."}        as output is produced
+#   server -> {"type": "exit", "exitCode", "wallTimeMs", "timedOut"}   final frame without "analyze"
+#   server -> {"type": "analysis", "kind": "suggest" | "explain", "response" | "error"}   after exit
+#   server -> {"type": "error", "message", "retryAfter"?}          request rejected
+# "analyze" is true or {"cursor", "goal", "hints"} for the AI suggestions (see RunAnalysis).
+
+STREAM_TIMEOUT = float(os.getenv("STREAM_TIMEOUT", "60"))
+# Live runs mostly sit waiting on the user's stdin, so they get their own slots
+# rather than holding the engine's for up to STREAM_TIMEOUT; only the compile
+# goes through the execution engine.
+STREAM_CONCURRENCY = int(os.getenv("STREAM_CONCURRENCY", "8"))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "4"))
+
+stream_engine = ExecutionEngine(STREAM_CONCURRENCY, STREAM_QUEUE_SIZE)
+
+
+def stream_command(lang: str, code: str, artifact_dir: str | None, tmp: str) -> list[str]:
+    """Command line for a live run; compiled languages must already be built."""
+    if lang == "python":
+        path = os.path.join(tmp, "main.py")
+        with open(path, "w") as f:
+            f.write(textwrap.dedent(code))
+        return ["python", "-u", path]
+    if lang == "javascript":
+        path = os.path.join(tmp, "main.js")
+        with open(path, "w") as f:
+            f.write(code)
+        return ["node", *NODE_HEAP_FLAGS, path]
+    if lang == "cpp":
+        return [f"{artifact_dir}/a.exe"]
+    return ["java", *JAVA_HEAP_FLAGS, "-cp", artifact_dir, find_java_class(code)]
+
+
+async def stream_submission(ws: WebSocket, lang: str, req: ExecuteRequest) -> dict:
+    """Run `req` live over `ws`; returns the exit frame plus the run's stderr."""
+    artifact_dir, compile_err = await execution_engine.run(build_submission, lang, req.code)
+    if compile_err is not None:
+        await ws.send_json({"type": "stderr", "data": compile_err})
+        await ws.send_json({"type": "exit", "exitCode": None, "wallTimeMs": None, "timedOut": False})
+        return {"exitCode": None, "timedOut": False, "limitHit": None, "stderr": compile_err}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cmd = stream_command(lang, req.code, artifact_dir, tmp)
+        start = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=tmp,
+            preexec_fn=rlimit_preexec(native=lang in ("python", "cpp")),
+        )
+        sent = 0
+        limit_hit = None
+        errors = []
+
+        async def write_stdin(data: str):
+            if proc.stdin.is_closing():
+                return
+            try:
+                proc.stdin.write(data.encode())
+                await proc.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        async def pump(stream: asyncio.StreamReader, kind: str):
+            nonlocal sent, limit_hit
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while chunk := await stream.read(4096):
+                if sent >= RUN_MAX_OUTPUT_BYTES:
+                    continue
+                chunk = chunk[:RUN_MAX_OUTPUT_BYTES - sent]
+                sent += len(chunk)
+                if sent >= RUN_MAX_OUTPUT_BYTES:
+                    limit_hit = "output"
+                    proc.kill()
+                text = decoder.decode(chunk)
+                if text:
+                    await ws.send_json({"type": kind, "data": text})
+                    if kind == "stderr":
+                        errors.append(text)
+
+        async def feed():
+            try:
+                while True:
+                    msg = await ws.receive_json()
+                    if msg.get("stdin"):
+                        await write_stdin(msg["stdin"])
+                    if msg.get("eof"):
+                        proc.stdin.close()
+                    if msg.get("kill"):
+                        proc.kill()
+                        return
+            except WebSocketDisconnect:
+                proc.kill()
+
+        if req.stdin:
+            await write_stdin(req.stdin)
+        feeder = asyncio.create_task(feed())
+        timed_out = False
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(pump(proc.stdout, "stdout"), pump(proc.stderr, "stderr"), proc.wait()),
+                timeout=STREAM_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            timed_out = True
+        finally:
+            feeder.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+        if timed_out:
+            limit_hit = "wall"
+        elif limit_hit is None:
+            limit_hit = detect_limit_hit(proc.returncode, None)
+        exit_frame = {
+            "type": "exit",
+            "exitCode": proc.returncode,
+            "wallTimeMs": _ms(time.monotonic() - start),
+            "timedOut": timed_out,
+            "limitHit": limit_hit,
+        }
+        await ws.send_json(exit_frame)
+        return {**exit_frame, "stderr": "".join(errors)}
+
+
+@app.websocket("/execute/stream")
+async def execute_stream(ws: WebSocket):
+    await ws.accept()
+    analysis = None
+    try:
+        msg = await ws.receive_json()
+        req = ExecuteRequest(**msg)
+        lang = req.language.lower()
+        if lang not in SUPPORTED_LANGUAGES:
+            await ws.send_json({"type": "error", "message": "Unsupported language"})
+            return
+        if msg.get("analyze"):
+            analysis = RunAnalysis(lang, req.code, msg["analyze"])
+        async with stream_engine.slot(track_time=False):
+            outcome = await stream_submission(ws, lang, req)
+        if analysis is not None:
+            await ws.send_json(await analysis.finish(outcome))
+    except ExecutionQueueFull as e:
+        await ws.send_json({
+            "type": "error",
+            "message": "Execution queue is full, please retry shortly",
+            "retryAfter": e.retry_after,
+        })
+    except WebSocketDisconnect:
+        return
+    except Exception as e:
+        try:
+            await ws.send_json({"type": "error", "message": str(e)})
+        except Exception:
+            return
+    finally:
+        if analysis is not None:
+            analysis.discard()
+    try:
+        await ws.close()
+    except Exception:
+        pass
+
+
+# -------- Warm runner pools --------
+
+WORKER_RESTART_BACKOFF = float(os.getenv("WORKER_RESTART_BACKOFF", "5"))
+
+
+class PooledWorker:
+    """Base for long-lived runner processes handed out by a WorkerPool."""
+
+    proc: subprocess.Popen
+
+    def __init__(self):
+        self.runs = 0
+        self.dirty = False  # set when the worker must not be reused
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def request(self, line: str, timeout: float) -> str:
+        """Send one protocol line and wait for the reply line ('' if the process died).
+
+        A watchdog kills the process if it has not answered within `timeout`.
+        """
+        self.proc.stdin.write(line + "\n")
+        self.proc.stdin.flush()
+        watchdog = Timer(timeout, self.proc.kill)
+        watchdog.start()
+        try:
+            return self.proc.stdout.readline()
+        finally:
+            watchdog.cancel()
+
+    def close(self) -> None:
+        try:
+            self.proc.kill()
+            self.proc.wait(timeout=1)
+        except Exception:
+            pass
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of warm workers, started lazily on first use.
+
+    acquire() returns None when the pool is disabled, could not start, or no
+    worker frees up within `wait` seconds; callers then fall back to a cold
+    process. Workers that are dirty, dead or past `max_runs` are replaced on
+    release; one that fails to restart is retried by a later acquire(), at
+    most every WORKER_RESTART_BACKOFF seconds.
+    """
+
+    def __init__(self, name: str, factory, size: int, wait: float, max_runs: int = 0):
+        self.name = name
+        self.factory = factory
+        self.size = size
+        self.wait = wait
+        self.max_runs = max_runs
+        self._idle: "queue.Queue[PooledWorker] | None" = None
+        self._lock = Lock()
+        self._missing = 0  # workers that failed to restart
+        self._retry_at = 0.0
+
+    def acquire(self) -> PooledWorker | None:
+        if self.size <= 0:
+            return None
+        with self._lock:
+            if self._idle is None:
+                started: list[PooledWorker] = []
+                try:
+                    for _ in range(self.size):
+                        started.append(self.factory())
+                except BaseException as e:
+                    for worker in started:
+                        worker.close()
+                    if not isinstance(e, (OSError, RuntimeError)):
+                        raise
+                    print(f"[DEBUG] {self.name} pool disabled: {e}")
+                    self.size = 0
+                    return None
+                self._idle = queue.Queue()
+                for worker in started:
+                    self._idle.put(worker)
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        worker = self._restart()
+        if worker is not None:
+            return worker
+        if self._missing >= self.size:
+            return None  # no worker left to wait for
+        try:
+            return self._idle.get(timeout=self.wait)
+        except queue.Empty:
+            return None
+
+    def _restart(self) -> PooledWorker | None:
+        """Start a replacement for a worker that failed to restart, unless one failed just now."""
+        with self._lock:
+            if not self._missing or time.monotonic() < self._retry_at:
+                return None
+            try:
+                worker = self.factory()
+            except (OSError, RuntimeError) as e:
+                print(f"[DEBUG] {self.name} worker restart failed again: {e}")
+                self._retry_at = time.monotonic() + WORKER_RESTART_BACKOFF
+                return None
+            self._missing -= 1
+            return worker
+
+    def release(self, worker: PooledWorker) -> None:
+        worker.runs += 1
+        if worker.dirty or not worker.alive() or (self.max_runs and worker.runs >= self.max_runs):
+            worker.close()
+            try:
+                worker = self.factory()
+            except (OSError, RuntimeError) as e:
+                print(f"[DEBUG] {self.name} worker restart failed, retrying later: {e}")
+                with self._lock:
+                    self._missing += 1
+                    self._retry_at = time.monotonic() + WORKER_RESTART_BACKOFF
+                return
+        self._idle.put(worker)
+
+
+# Python: each zygote is a long-lived interpreter with common modules already imported.
+# For every run it forks a child that gets its own stdin/stdout/stderr files,
+# working directory and process group, so runs stay isolated from each other.
+
+PYTHON_POOL_SIZE = int(os.getenv("PYTHON_POOL_SIZE", "2"))
+PYTHON_POOL_WAIT = float(os.getenv("PYTHON_POOL_WAIT", "0.5"))
+PYTHON_POOL_PRELOAD = os.getenv(
+    "PYTHON_POOL_PRELOAD",
+    "math,random,re,string,json,collections,itertools,functools,heapq,bisect,datetime,traceback,runpy"
+)
+
+ZYGOTE_SRC = r"""
+import os, sys, json, signal, time, runpy, traceback, resource
+def status_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+bare_anon = status_kb("self", "RssAnon:")
+for _name in sys.argv[1].split(","):
+    try:
+        __import__(_name.strip())
+    except Exception:
+        pass
+for line in sys.stdin:
+    req = json.loads(line)
+    start = time.monotonic()
+    # The child never execs, so ru_maxrss is exactly its own VmHWM, but fork() maps
+    # the zygote's anonymous pages into it; what the preloads added isn't the run's
+    anon = status_kb("self", "RssAnon:")
+    overhead = max(0, anon - bare_anon) if anon and bare_anon else 0
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            os.setsid()
+            for name, (soft, hard) in req["limits"].items():
+                try:
+                    resource.setrlimit(getattr(resource, name), (soft, hard))
+                except (AttributeError, ValueError, OSError):
+                    pass
+            for fd, key, flags in ((0, "stdin", os.O_RDONLY), (1, "stdout", os.O_WRONLY), (2, "stderr", os.O_WRONLY)):
+                f = os.open(req[key], flags)
+                os.dup2(f, fd)
+                os.close(f)
+            sys.stdin = open(0, "r", closefd=False)
+            sys.stdout = open(1, "w", closefd=False)
+            sys.stderr = open(2, "w", closefd=False, buffering=1)
+            os.chdir(req["cwd"])
+            sys.argv = [req["path"]]
+            sys.path[0] = os.path.dirname(req["path"])
+            runpy.run_path(req["path"], run_name="__main__")
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException as e:
+            tb = e.__traceback__
+            while tb is not None and tb.tb_frame.f_code.co_filename != req["path"]:
+                tb = tb.tb_next
+            traceback.print_exception(type(e), e, tb)
+            code = 1
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except Exception:
+                pass
+            os._exit(code)
+    deadline = time.monotonic() + req["timeout"]
+    timed_out = False
+    while True:
+        wpid, status, usage = os.wait4(pid, os.WNOHANG)
+        if wpid:
+            break
+        if time.monotonic() > deadline:
+            timed_out = True
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                # Not yet its own group leader (setsid hasn't run): kill the child itself
+                os.kill(pid, signal.SIGKILL)
+            _, status, usage = os.wait4(pid, 0)
+            break
+        time.sleep(0.002)
+    sys.stdout.write(json.dumps({
+        "returncode": os.waitstatus_to_exitcode(status),
+        "timeout": timed_out,
+        "wall": time.monotonic() - start,
+        "cpu": usage.ru_utime + usage.ru_stime,
+        "rss": max(0, usage.ru_maxrss - overhead),
+    }) + "\n")
+    sys.stdout.flush()
+"""
+
+
+class PythonZygote(PooledWorker):
+    """A pre-started interpreter that forks one clean child per run."""
+
+    def __init__(self):
+        super().__init__()
+        self.proc = subprocess.Popen(
+            ["python", "-c", ZYGOTE_SRC, PYTHON_POOL_PRELOAD],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+
+    def run(self, path: str, stdin: str, timeout: float, limits: dict) -> RunResult:
+        with tempfile.TemporaryDirectory() as tmp:
+            io_paths = {name: os.path.join(tmp, name) for name in ("stdin", "stdout", "stderr")}
+            with open(io_paths["stdin"], "w") as f:
+                f.write(stdin)
+            for name in ("stdout", "stderr"):
+                open(io_paths[name], "w").close()
+
+            self.proc.stdin.write(json.dumps({"path": path, "cwd": tmp, "timeout": timeout, "limits": limits, **io_paths}) + "\n")
+            self.proc.stdin.flush()
+            reply = self.proc.stdout.readline()
+            if not reply:
+                raise RuntimeError("Python zygote exited unexpectedly")
+            result = json.loads(reply)
+            if result["timeout"]:
+                raise subprocess.TimeoutExpired(["python", path], timeout)
+
+            out, out_size = read_capped(io_paths["stdout"])
+            err, _ = read_capped(io_paths["stderr"])
+            return RunResult(
+                ["python", path], result["returncode"], out, err, result["wall"], result["cpu"],
+                peak_rss_kb=result["rss"],
+                limit_hit=detect_limit_hit(result["returncode"], err, out_size),
+            )
+
+python_pool = WorkerPool(
+    "Python",
+    PythonZygote,
+    size=PYTHON_POOL_SIZE if hasattr(os, "fork") else 0,
+    wait=PYTHON_POOL_WAIT,
+)
+
+
+def run_python_script(path: str, stdin: str, timeout: float = 5, file_size: int = RUN_MAX_OUTPUT_BYTES,
+                      cpu_limit: int = RUN_CPU_LIMIT) -> RunResult:
+    """
+    Run a Python file on a warm zygote, falling back to a cold `python` process
+    when the pool is disabled, busy or a zygote has died.
+
+    `file_size` caps every file the run writes, which for the tracer includes its trace.
+    """
+    limits = run_rlimits(file_size=file_size, cpu_limit=cpu_limit)
+    zygote = python_pool.acquire()
+    if zygote is None:
+        return run_command(["python", path], stdin, timeout=timeout, limits=limits)
+    try:
+        return zygote.run(path, stdin, timeout, limits)
+    except (RuntimeError, OSError, ValueError):
+        zygote.dirty = True
+        return run_command(["python", path], stdin, timeout=timeout, limits=limits)
+    finally:
+        python_pool.release(zygote)
+
+
+def run_python_file(path: str, stdin: str) -> ExecuteResponse:
+    return to_execute_response(run_python_script(path, stdin))
+
+
+# -------- Python trace engine --------
+# The tracer writes one compact JSON record per line to a side-channel file:
+#   {"name": "x"}                   interns the next variable index
+#   [line, [idx, repr, ...], [idx]] a step: changed variables, then removed ones
+#   {"truncated": "steps"|"bytes"}  budget hit, tracing stopped, program continues
+#   {"end": {...}}                  totals written when the program finishes
+# Only frames of the user's code are traced. After TRACE_LOOP_FULL hits of the
+# same line, hits are sampled with a stride that doubles as the count grows;
+# deltas are always relative to the last emitted step, so sampling never
+# loses a change.
+
+TRACE_MAX_STEPS = int(os.getenv("TRACE_MAX_STEPS", "20000"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(2 * 1024 * 1024)))
+TRACE_LOOP_FULL = int(os.getenv("TRACE_LOOP_FULL", "64"))
+TRACE_REPR_LIMIT = int(os.getenv("TRACE_REPR_LIMIT", "200"))
+
+TRACER_SRC = r"""
+import sys, json, reprlib
+
+_repr = reprlib.Repr()
+_repr.maxstring = _repr.maxother = _CONFIG["repr_limit"]
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxfrozenset = _repr.maxdict = _repr.maxdeque = 16
+_SKIP = {"self", "cls", "args", "kwargs"}
+_out = open(_CONFIG["trace_path"], "w")
+_names = {}
+_state = {}
+_hits = {}
+_counts = {"steps": 0, "sampled": 0, "bytes": 0}
+_stopped = False
+
+
+def _emit(record):
+    line = json.dumps(record, separators=(",", ":"))
+    _counts["bytes"] += len(line) + 1
+    _out.write(line + "\n")
+
+
+def _local(frame, event, arg):
+    global _stopped
+    if _stopped:
+        return None
+    if event != "line":
+        return _local
+    lineno = frame.f_lineno
+    hits = _hits.get(lineno, 0) + 1
+    _hits[lineno] = hits
+    if hits > _CONFIG["loop_full"]:
+        stride = 1 << ((hits // _CONFIG["loop_full"]).bit_length() - 1)
+        if hits % stride:
+            _counts["sampled"] += 1
+            return _local
+    changed = []
+    seen = set()
+    for k, v in frame.f_locals.items():
+        if k.startswith("__") or k in _SKIP:
+            continue
+        idx = _names.get(k)
+        if idx is None:
+            idx = _names[k] = len(_names)
+            _emit({"name": k})
+        seen.add(idx)
+        try:
+            r = _repr.repr(v)
+        except Exception:
+            r = "<unrepr>"
+        if _state.get(idx) != r:
+            _state[idx] = r
+            changed += (idx, r)
+    removed = [i for i in _state if i not in seen]
+    for i in removed:
+        del _state[i]
+    _emit([lineno, changed, removed] if removed else [lineno, changed])
+    _counts["steps"] += 1
+    if _counts["steps"] >= _CONFIG["max_steps"] or _counts["bytes"] >= _CONFIG["max_bytes"]:
+        _emit({"truncated": "steps" if _counts["steps"] >= _CONFIG["max_steps"] else "bytes"})
+        _stopped = True
+        sys.settrace(None)
+        return None
+    return _local
+
+
+def _global(frame, event, arg):
+    if _stopped or frame.f_code.co_filename != "<user>":
+        return None
+    return _local
+
+
+_code = compile(_USER_CODE, "<user>", "exec")
+_g = {"__name__": "__main__"}
+sys.settrace(_global)
+try:
+    exec(_code, _g, _g)
+except Exception:
+    import traceback
+    print("ERROR:" + traceback.format_exc(), file=sys.stderr)
+finally:
+    sys.settrace(None)
+    _emit({"end": {"steps": _counts["steps"], "sampled": _counts["sampled"]}})
+    _out.close()
+"""
+
+
+def read_trace(path: str) -> tuple[list[dict] | None, list[str] | None, dict | None]:
+    """
+    Decode the tracer's side-channel file into (steps, names, info).
+
+    Steps keep the delta encoding: {"line", "set": {idx: repr}, "del": [idx]},
+    with idx pointing into names.
+    """
+    if not os.path.exists(path):
+        return None, None, None
+    names: list[str] = []
+    steps: list[dict] = []
+    info: dict = {"truncated": None, "complete": False}
+    with open(path, errors="replace") as f:
+        for raw in f:
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                break  # partial last line if the run was killed
+            if isinstance(record, list):
+                changed = record[1]
+                step = {"line": record[0], "set": {str(changed[i]): changed[i + 1] for i in range(0, len(changed), 2)}}
+                if len(record) > 2:
+                    step["del"] = record[2]
+                steps.append(step)
+            elif "name" in record:
+                names.append(record["name"])
+            elif "truncated" in record:
+                info["truncated"] = record["truncated"]
+            elif "end" in record:
+                info.update(record["end"], complete=True)
+    info["steps"] = len(steps)
+    return steps, names, info
+
+
+# -------- Trace store --------
+# Finished traces are kept on disk so any server worker can page through them
+# and /execute only returns the first page. Each trace directory holds
+# steps.jsonl (one delta step per line) and meta.json with byte offsets per
+# step, a full-state keyframe every TRACE_KEYFRAME_EVERY steps, and per-line
+# and per-variable step indexes for seeking.
+
+TRACE_STORE_DIR = os.getenv("TRACE_STORE_DIR", os.path.join(tempfile.gettempdir(), "codex_traces"))
+TRACE_STORE_MAX = int(os.getenv("TRACE_STORE_MAX", "200"))
+TRACE_STORE_TTL = int(os.getenv("TRACE_STORE_TTL", "3600"))
+TRACE_PAGE_SIZE = int(os.getenv("TRACE_PAGE_SIZE", "200"))
+TRACE_PAGE_MAX = 1000
+TRACE_KEYFRAME_EVERY = 256
+
+
+def _apply_step(state: dict, step: dict) -> None:
+    state.update(step["set"])
+    for idx in step.get("del", []):
+        state.pop(str(idx), None)
+
+
+def store_trace(steps: list[dict], names: list[str], info: dict) -> str:
+    """Persist a decoded trace and return its id; evicts expired and excess traces."""
+    os.makedirs(TRACE_STORE_DIR, exist_ok=True)
+    trace_id = uuid4().hex
+    build_dir = tempfile.mkdtemp(prefix=".tmp-", dir=TRACE_STORE_DIR)
+    offsets, keyframes, lines, changes = [], {}, {}, {}
+    state: dict = {}
+    with open(os.path.join(build_dir, "steps.jsonl"), "wb") as f:
+        pos = 0
+        for i, step in enumerate(steps):
+            if i % TRACE_KEYFRAME_EVERY == 0:
+                keyframes[str(i)] = dict(state)
+            data = (json.dumps(step, separators=(",", ":")) + "\n").encode()
+            offsets.append(pos)
+            pos += len(data)
+            f.write(data)
+            lines.setdefault(str(step["line"]), []).append(i)
+            for idx in [*step["set"], *map(str, step.get("del", []))]:
+                changes.setdefault(idx, []).append(i)
+            _apply_step(state, step)
+    meta = {"names": names, "info": info, "offsets": offsets, "keyframes": keyframes, "lines": lines, "changes": changes}
+    with open(os.path.join(build_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, separators=(",", ":"))
+    os.rename(build_dir, os.path.join(TRACE_STORE_DIR, trace_id))
+    evict_traces()
+    return trace_id
+
+
+def evict_traces() -> None:
+    """Drop traces older than TRACE_STORE_TTL, then the oldest beyond TRACE_STORE_MAX."""
+    entries = []
+    for name in os.listdir(TRACE_STORE_DIR):
+        path = os.path.join(TRACE_STORE_DIR, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    now = time.time()
+    entries.sort(reverse=True)
+    for i, (mtime, path) in enumerate(entries):
+        if i >= TRACE_STORE_MAX or now - mtime > TRACE_STORE_TTL:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@lru_cache(maxsize=32)
+def _read_trace_meta(path: str, mtime: float) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Trace not found or expired")
+
+
+def load_trace_meta(trace_id: str) -> dict:
+    """Trace metadata; cached per file version, and never for traces that were evicted."""
+    if not trace_id.isalnum():
+        raise HTTPException(status_code=404, detail="Trace not found")
+    path = os.path.join(TRACE_STORE_DIR, trace_id, "meta.json")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Trace not found or expired")
+    if time.time() - mtime > TRACE_STORE_TTL:
+        raise HTTPException(status_code=404, detail="Trace not found or expired")
+    return _read_trace_meta(path, mtime)
+
+
+def read_trace_steps(trace_id: str, meta: dict, start: int, end: int) -> list[dict]:
+    """Read steps [start, end) using the stored byte offsets."""
+    offsets = meta["offsets"]
+    start, end = max(0, start), min(end, len(offsets))
+    if start >= end:
+        return []
+    try:
+        with open(os.path.join(TRACE_STORE_DIR, trace_id, "steps.jsonl"), "rb") as f:
+            f.seek(offsets[start])
+            return [json.loads(f.readline()) for _ in range(end - start)]
+    except OSError:
+        raise HTTPException(status_code=404, detail="Trace not found or expired")
+
+
+def trace_state_before(trace_id: str, meta: dict, step: int) -> dict:
+    """Full variable state (name index -> repr) before `step` is applied."""
+    key = (step // TRACE_KEYFRAME_EVERY) * TRACE_KEYFRAME_EVERY
+    state = dict(meta["keyframes"].get(str(key), {}))
+    for s in read_trace_steps(trace_id, meta, key, step):
+        _apply_step(state, s)
+    return state
+
+
+class TraceSummaryResponse(BaseModel):
+    traceId: str
+    names: list[str]
+    info: dict
+
+
+class TraceStepsResponse(BaseModel):
+    traceId: str
+    start: int
+    total: int
+    base: dict[str, str]  # state before the first returned step, by name index
+    steps: list[dict]
+
+
+class TraceSeekResponse(BaseModel):
+    traceId: str
+    step: int
+    line: int
+    locals: dict[str, str]  # state after the step, by variable name
+
+
+class TraceVariableEntry(BaseModel):
+    step: int
+    line: int
+    value: str | None = None  # None when the variable went out of scope
+
+
+class TraceVariableResponse(BaseModel):
+    traceId: str
+    name: str
+    total: int
+    history: list[TraceVariableEntry]
+
+
+@app.get("/trace/{trace_id}", response_model=TraceSummaryResponse)
+def trace_summary(trace_id: str):
+    meta = load_trace_meta(trace_id)
+    return TraceSummaryResponse(traceId=trace_id, names=meta["names"], info=meta["info"])
+
+
+@app.get("/trace/{trace_id}/steps", response_model=TraceStepsResponse)
+def trace_steps(trace_id: str, start: int = 0, count: int = TRACE_PAGE_SIZE):
+    meta = load_trace_meta(trace_id)
+    start = max(0, start)
+    count = max(0, min(count, TRACE_PAGE_MAX))
+    return TraceStepsResponse(
+        traceId=trace_id,
+        start=start,
+        total=len(meta["offsets"]),
+        base=trace_state_before(trace_id, meta, start),
+        steps=read_trace_steps(trace_id, meta, start, start + count),
+    )
+
+
+@app.get("/trace/{trace_id}/seek", response_model=TraceSeekResponse)
+def trace_seek(trace_id: str, line: int, hit: int = 1):
+    """Jump to the `hit`-th recorded execution (1-based) of `line`."""
+    meta = load_trace_meta(trace_id)
+    hits = meta["lines"].get(str(line), [])
+    if hit < 1 or hit > len(hits):
+        raise HTTPException(status_code=404, detail=f"Line {line} has {len(hits)} recorded hits")
+    step = hits[hit - 1]
+    state = trace_state_before(trace_id, meta, step)
+    _apply_step(state, read_trace_steps(trace_id, meta, step, step + 1)[0])
+    names = meta["names"]
+    return TraceSeekResponse(
+        traceId=trace_id,
+        step=step,
+        line=line,
+        locals={names[int(idx)]: value for idx, value in state.items()},
+    )
+
+
+@app.get("/trace/{trace_id}/variables/{name}", response_model=TraceVariableResponse)
+def trace_variable(trace_id: str, name: str, start: int = 0, count: int = TRACE_PAGE_SIZE):
+    """Every recorded change of `name` (across all frames using that name)."""
+    meta = load_trace_meta(trace_id)
+    if name not in meta["names"]:
+        raise HTTPException(status_code=404, detail=f"Variable {name} not in trace")
+    idx = str(meta["names"].index(name))
+    changed_at = meta["changes"].get(idx, [])
+    history = []
+    for step_index in changed_at[max(0, start):max(0, start) + max(0, min(count, TRACE_PAGE_MAX))]:
+        step = read_trace_steps(trace_id, meta, step_index, step_index + 1)[0]
+        history.append(TraceVariableEntry(step=step_index, line=step["line"], value=step["set"].get(idx)))
+    return TraceVariableResponse(traceId=trace_id, name=name, total=len(changed_at), history=history)
+
+
+def run_python(code: str, stdin: str, trace: bool = False, profile: bool = False) -> ExecuteResponse:
+    if profile:
+        return profile_python(code, stdin)
+    if not trace:
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as f:
+            f.write(textwrap.dedent(code))
+            path = f.name
+        return run_python_file(path, stdin)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trace_path = os.path.join(tmp, "trace.jsonl")
+        config = {
+            "trace_path": trace_path,
+            "max_steps": TRACE_MAX_STEPS,
+            "max_bytes": TRACE_MAX_BYTES,
+            "loop_full": TRACE_LOOP_FULL,
+            "repr_limit": TRACE_REPR_LIMIT,
+        }
+        wrapper_path = os.path.join(tmp, "trace_wrapper.py")
+        with open(wrapper_path, "w") as f:
+            f.write(f"_CONFIG = {config!r}\n_USER_CODE = {code!r}\n" + TRACER_SRC)
+        # The trace file is capped by TRACE_MAX_BYTES, not the output limit
+        proc = run_python_script(wrapper_path, stdin, timeout=TRACE_TIMEOUT, cpu_limit=TRACE_CPU_LIMIT,
+                                 file_size=max(RUN_MAX_OUTPUT_BYTES, 2 * TRACE_MAX_BYTES))
+        steps, names, info = read_trace(trace_path)
+    trace_id = store_trace(steps, names, info) if steps is not None else None
+    stderr = proc.stderr or None if proc.returncode == 0 else (proc.stderr or 'Error')
+    if proc.limit_hit:
+        stderr = "\n".join(filter(None, [(stderr or "").rstrip("\n"), limit_message(proc.limit_hit, TRACE_CPU_LIMIT)]))
+    return ExecuteResponse(
+        output=proc.stdout or "",
+        stderr=stderr,
+        trace=steps[:TRACE_PAGE_SIZE] if steps is not None else None,
+        traceId=trace_id,
+        traceNames=names,
+        traceInfo=info,
+        exitCode=proc.returncode,
+        wallTimeMs=_ms(proc.wall_time),
+        cpuTimeMs=_ms(proc.cpu_time),
+        peakRssKb=proc.peak_rss_kb,
+        limitHit=proc.limit_hit,
+    )
+
+
+# -------- Warm Node.js runner --------
+# Each worker is a long-lived node process that runs every submission in a fresh
+# worker_threads Worker (its own V8 isolate, module cache and event loop) with
+# per-run stdin and captured stdout/stderr. A run that overruns its timeout is
+# terminated; a runner that stops answering is killed and replaced.
+
+NODE_POOL_SIZE = int(os.getenv("NODE_POOL_SIZE", "2"))
+NODE_POOL_WAIT = float(os.getenv("NODE_POOL_WAIT", "0.5"))
+NODE_POOL_MAX_RUNS = int(os.getenv("NODE_POOL_MAX_RUNS", "100"))
+
+NODE_RUNNER_SRC = r"""
+const { Worker } = require('worker_threads');
+const readline = require('readline');
+
+// Runs inside each Worker: serves the run's stdin through process.stdin and
+// fs.readFileSync(0 | '/dev/stdin'), then starts the submission as the main module.
+const BOOTSTRAP = `
+const { workerData } = require('worker_threads');
+const { Readable } = require('stream');
+const fs = require('fs');
+const input = Buffer.from(workerData.stdin);
+const stdin = new Readable({ read() {} });
+stdin.push(input);
+stdin.push(null);
+stdin.fd = 0;
+Object.defineProperty(process, 'stdin', { value: stdin, configurable: true });
+const readFileSync = fs.readFileSync;
+fs.readFileSync = function (file, options) {
+  if (file === 0 || file === '/dev/stdin') {
+    const encoding = typeof options === 'string' ? options : options && options.encoding;
+    return encoding ? input.toString(encoding) : Buffer.from(input);
+  }
+  return readFileSync.apply(this, arguments);
+};
+process.argv[1] = workerData.path;
+require('module').runMain(workerData.path);
+`;
+
+// Keeps at most `limit` bytes of a stream and calls onOverflow once past it.
+function collect(stream, limit, onOverflow) {
+  const chunks = [];
+  let size = 0;
+  let ended = false;
+  stream.on('data', (c) => {
+    if (size >= limit) return;
+    chunks.push(c.subarray(0, limit - size));
+    size += c.length;
+    if (size >= limit) onOverflow();
+  });
+  const done = new Promise((resolve) => stream.on('end', () => { ended = true; resolve(); }));
+  return async () => {
+    if (!ended) await Promise.race([done, new Promise((r) => setTimeout(r, 200))]);
+    return Buffer.concat(chunks).toString();
+  };
+}
+
+function run(req) {
+  const startWall = process.hrtime.bigint();
+  const startCpu = process.cpuUsage();
+  return new Promise((resolve) => {
+    const worker = new Worker(BOOTSTRAP, {
+      eval: true,
+      workerData: { path: req.path, stdin: req.stdin },
+      stdout: true,
+      stderr: true,
+      resourceLimits: { maxOldGenerationSizeMb: req.memoryMb },
+    });
+    let outputLimited = false;
+    const overflow = () => { outputLimited = true; worker.terminate(); };
+    const stdout = collect(worker.stdout, req.maxOutput, overflow);
+    const stderr = collect(worker.stderr, req.maxOutput, overflow);
+    let error = null;
+    let timedOut = false;
+    const timer = setTimeout(() => { timedOut = true; worker.terminate(); }, req.timeout);
+    worker.on('error', (e) => { error = e; });
+    worker.on('exit', async (code) => {
+      clearTimeout(timer);
+      const out = await stdout();
+      let err = await stderr();
+      if (error) {
+        err += (error.code === 'ERR_WORKER_OUT_OF_MEMORY' ? 'FATAL ERROR: JavaScript heap out of memory'
+          : error.stack ? error.stack : String(error)) + '\n';
+        code = code || 1;
+      }
+      // The runner executes one submission at a time, so its own CPU delta is the run's.
+      const cpu = process.cpuUsage(startCpu);
+      const wallMs = Number(process.hrtime.bigint() - startWall) / 1e6;
+      resolve({ stdout: out, stderr: err, code, timedOut, outputLimited, wallMs, cpuMs: (cpu.user + cpu.system) / 1000 });
+    });
+  });
+}
+
+readline.createInterface({ input: process.stdin }).on('line', async (line) => {
+  const result = await run(JSON.parse(line));
+  process.stdout.write(JSON.stringify(result) + '\n');
+});
+"""
+
+
+class NodeWorker(PooledWorker):
+    """A warm node process that runs one submission at a time in a worker thread."""
+
+    def __init__(self):
+        super().__init__()
+        self.proc = subprocess.Popen(
+            ["node", "-e", NODE_RUNNER_SRC],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+
+    def run(self, path: str, stdin: str, timeout: float) -> RunResult:
+        reply = self.request(json.dumps({
+            "path": path,
+            "stdin": stdin,
+            "timeout": int(timeout * 1000),
+            "memoryMb": RUN_MEMORY_LIMIT_MB,
+            "maxOutput": RUN_MAX_OUTPUT_BYTES,
+        }), timeout + 2)
+        if not reply:
+            self.dirty = True
+            if self.proc.wait() == -9:
+                raise subprocess.TimeoutExpired(["node", path], timeout)
+            raise RuntimeError("Node worker exited unexpectedly")
+        result = json.loads(reply)
+        if result["timedOut"]:
+            raise subprocess.TimeoutExpired(["node", path], timeout)
+        if result["outputLimited"]:
+            limit_hit = "output"
+        else:
+            limit_hit = detect_limit_hit(result["code"], result["stderr"])
+        return RunResult(
+            ["node", path], result["code"], result["stdout"], result["stderr"],
+            wall_time=result["wallMs"] / 1000, cpu_time=result["cpuMs"] / 1000, limit_hit=limit_hit,
+        )
+
+
+node_pool = WorkerPool("Node", NodeWorker, size=NODE_POOL_SIZE, wait=NODE_POOL_WAIT, max_runs=NODE_POOL_MAX_RUNS)
+
+
+def run_node(code: str, stdin: str) -> ExecuteResponse:
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".js", delete=False) as f:
+        f.write(code)
+        path = f.name
+    cmd = ["node", *NODE_HEAP_FLAGS, path]
+    worker = node_pool.acquire()
+    if worker is None:
+        return run_process(cmd, stdin, native=False)
+    try:
+        proc = worker.run(path, stdin, timeout=5)
+    except (RuntimeError, OSError, ValueError):
+        worker.dirty = True
+        return run_process(cmd, stdin, native=False)
+    finally:
+        node_pool.release(worker)
+    return to_execute_response(proc)
+
+
+# -------- Compile cache (C++ / Java) --------
+
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "codex_compile_cache"))
+COMPILE_CACHE_MAX_BYTES = int(os.getenv("COMPILE_CACHE_MAX_MB", "256")) * 1024 * 1024
+
+CPP_FLAGS = ["-O2", "-static", "-s"]
+# gprof needs symbols and only sees the main executable, so profiled builds are
+# dynamic and unstripped; no inlining keeps small functions visible.
+CPP_PROFILE_FLAGS = ["-O2", "-pg", "-fno-inline"]
+JAVAC_FLAGS: list[str] = []
+
+
+@lru_cache(maxsize=None)
+def get_compiler_version(compiler: str) -> str:
+    """Return the first line of `<compiler> -version`, or '' if unavailable."""
+    flag = "-version" if compiler == "javac" else "--version"
+    try:
+        proc = subprocess.run([compiler, flag], capture_output=True, text=True, timeout=10)
+        text = (proc.stdout or proc.stderr or "").strip()
+        return text.splitlines()[0] if text else ""
+    except Exception:
+        return ""
+
+
+def compile_cache_key(language: str, compiler: str, flags: list[str], code: str) -> str:
+    """Hash of everything that determines the compiled artifact."""
+    h = hashlib.sha256()
+    for part in (language, compiler, get_compiler_version(compiler), " ".join(flags), code):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _cache_lock():
+    """Open the cache-wide lock file; shared between gunicorn workers via flock."""
+    os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+    return open(os.path.join(COMPILE_CACHE_DIR, ".lock"), "a")
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def compile_cache_get(key: str) -> str | None:
+    """Return the artifact directory for `key` if cached, marking it as recently used."""
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    if not os.path.isdir(path):
+        return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        return None
+    return path
+
+
+def compile_cache_put(key: str, build_dir: str) -> str:
+    """
+    Publish a finished build directory under `key` and evict least recently
+    used entries beyond the size cap.
+
+    The build dir must live inside COMPILE_CACHE_DIR so the rename is atomic;
+    if another worker published the same key first, ours is discarded.
+    """
+    path = os.path.join(COMPILE_CACHE_DIR, key)
+    try:
+        os.rename(build_dir, path)
+    except OSError:
+        shutil.rmtree(build_dir, ignore_errors=True)
+    evict_compile_cache()
+    return path
+
+
+def evict_compile_cache() -> None:
+    """Remove least recently used entries until the cache fits COMPILE_CACHE_MAX_BYTES."""
+    with _cache_lock() as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        entries = []
+        for name in os.listdir(COMPILE_CACHE_DIR):
+            path = os.path.join(COMPILE_CACHE_DIR, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), _dir_size(path), path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= COMPILE_CACHE_MAX_BYTES:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+# Builds running in this process by cache key: {"done": Event, "result": (dir, err) | None}.
+# A compile of the same source waits for the running one (e.g. a run right after a prewarm).
+_compiles_in_flight: dict[str, dict] = {}
+_compiles_lock = Lock()
+
+
+def run_compiler(cmd: list[str], cwd: str | None = None) -> subprocess.CompletedProcess:
+    return subprocess.run(cmd, capture_output=True, text=True, cwd=cwd)
+
+
+def compile_cached(language: str, compiler: str, flags: list[str], code: str, build) -> tuple[str | None, str | None]:
+    """
+    Return (artifact_dir, compile_stderr) for `code`, compiling only on a cache miss.
+
+    `build(build_dir)` writes sources into build_dir, compiles in place and
+    returns the failed CompletedProcess, or None on success. Failed compiles
+    are not cached.
+    """
+    key = compile_cache_key(language, compiler, flags, code)
+    cached = compile_cache_get(key)
+    if cached:
+        return cached, None
+    with _compiles_lock:
+        running = _compiles_in_flight.get(key)
+        if running is None:
+            running = _compiles_in_flight[key] = {"done": Event(), "result": None}
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        running["done"].wait()
+        if running["result"] is not None:
+            return running["result"]
+        return compile_cached(language, compiler, flags, code, build)  # that build was cancelled
+
+    os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=".build-", dir=COMPILE_CACHE_DIR)
+    try:
+        failed = build(build_dir)
+        if failed is not None:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            running["result"] = (None, failed.stderr)
+        else:
+            running["result"] = (compile_cache_put(key, build_dir), None)
+        return running["result"]
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    finally:
+        with _compiles_lock:
+            _compiles_in_flight.pop(key, None)
+        running["done"].set()
+
+
+def compile_cpp(code: str, flags: list[str] = CPP_FLAGS, run=run_compiler) -> tuple[str | None, str | None]:
+    def build(build_dir: str):
+        src = f"{build_dir}/main.cpp"
+        with open(src, "w") as f:
+            f.write(code)
+        compile_proc = run(["g++", src, *flags, "-o", f"{build_dir}/a.exe"])
+        return compile_proc if compile_proc.returncode != 0 else None
+
+    return compile_cached("cpp", "g++", flags, code, build)
+
+
+def run_cpp(code: str, stdin: str, profile: bool = False) -> ExecuteResponse:
+    start = time.monotonic()
+    artifact_dir, compile_err = compile_cpp(code, CPP_PROFILE_FLAGS if profile else CPP_FLAGS)
+    compile_time = time.monotonic() - start
+    if compile_err is not None:
+        return ExecuteResponse(stderr=compile_err, compileTimeMs=_ms(compile_time))
+    with tempfile.TemporaryDirectory() as tmp:
+        res = run_process([f"{artifact_dir}/a.exe"], stdin, cwd=tmp, compile_time=compile_time)
+        if profile:
+            res.profile = read_gprof(f"{artifact_dir}/a.exe", os.path.join(tmp, "gmon.out"))
+        return res
+
+
+def find_java_class(code: str) -> str | None:
+    """Extract the public class name from Java source."""
+    for line in code.split('\n'):
+        if 'public class' in line:
+            return line.split('public class')[1].split()[0].strip('{').strip()
+    return None
+
+
+# -------- Warm JVM runner --------
+# Each worker is a long-lived JVM that compiles through javax.tools in-process
+# and runs every submission's main() in its own classloader with System.in/out/err
+# redirected to per-run files. System.exit(), a timeout or threads left running
+# after main() returns end the worker, and the pool replaces it.
+
+JAVA_POOL_SIZE = int(os.getenv("JAVA_POOL_SIZE", "1"))
+JAVA_POOL_WAIT = float(os.getenv("JAVA_POOL_WAIT", "0.5"))
+JAVA_POOL_MAX_RUNS = int(os.getenv("JAVA_POOL_MAX_RUNS", "50"))
+JAVA_POOL_OPTS = os.getenv("JAVA_POOL_OPTS", "-XX:+UseSerialGC -Xss16m")
+
+JAVA_RUNNER_SRC = """
+import java.io.*;
+import java.lang.management.ManagementFactory;
+import java.lang.reflect.*;
+import java.net.*;
+import java.nio.charset.StandardCharsets;
+import java.util.*;
+import javax.tools.*;
+
+public class CodexJavaRunner {
+    static final InputStream STDIN = System.in;
+    static final PrintStream REPLY = System.out;
+    static final PrintStream STDERR = System.err;
+    static volatile PrintStream runOut;
+
+    // Drops everything past the run's output limit and remembers that it did.
+    static class CappedOutputStream extends FilterOutputStream {
+        long left;
+        volatile boolean exceeded;
+
+        CappedOutputStream(OutputStream out, long limit) { super(out); left = limit; }
+
+        @Override public void write(int b) throws IOException {
+            write(new byte[]{(byte) b}, 0, 1);
+        }
+
+        @Override public void write(byte[] b, int off, int len) throws IOException {
+            int n = (int) Math.min(len, left);
+            out.write(b, off, n);
+            left -= n;
+            if (n < len) {
+                exceeded = true;
+                throw new IOException("Output limit exceeded");
+            }
+        }
+    }
+
+    public static void main(String[] args) throws Exception {
+        JavaCompiler javac = ToolProvider.getSystemJavaCompiler();
+        Runtime.getRuntime().addShutdownHook(new Thread(() -> {
+            PrintStream out = runOut;
+            if (out != null) out.flush();
+        }));
+        BufferedReader in = new BufferedReader(new InputStreamReader(STDIN, StandardCharsets.UTF_8));
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] cmd = line.split("\\t", -1);
+            String reply;
+            if (cmd[0].equals("COMPILE")) {
+                List<String> javacArgs = new ArrayList<>(Arrays.asList(cmd).subList(4, cmd.length));
+                javacArgs.addAll(List.of("-d", cmd[2], cmd[1]));
+                try (OutputStream err = new FileOutputStream(cmd[3])) {
+                    reply = "DONE\\t" + javac.run(null, null, err, javacArgs.toArray(new String[0])) + "\\t0\\t0\\t0";
+                }
+            } else {
+                reply = run(cmd[1], cmd[2], cmd[3], cmd[4], cmd[5], Long.parseLong(cmd[6]), Long.parseLong(cmd[7]), cmd[8]);
+            }
+            REPLY.println(reply);
+            REPLY.flush();
+            if (!reply.endsWith("\\t0")) Runtime.getRuntime().halt(0);
+        }
+    }
+
+    // Samples the submission's main thread every millisecond: the top frame is
+    // charged self time, every distinct method on the stack total time.
+    static class Sampler extends Thread {
+        static final Set<String> RUNNER_FRAMES = Set.of(
+            "CodexJavaRunner", "java.lang.Thread", "java.lang.reflect.Method",
+            "jdk.internal.reflect.DirectMethodHandleAccessor", "jdk.internal.reflect.NativeMethodAccessorImpl",
+            "jdk.internal.reflect.DelegatingMethodAccessorImpl");
+        final Thread target;
+        final Map<String, long[]> counts = new HashMap<>();  // method -> {self, total, line}
+        volatile boolean stop;
+        long samples;
+
+        Sampler(Thread target) {
+            this.target = target;
+            setDaemon(true);
+        }
+
+        @Override public void run() {
+            while (!stop && target.isAlive()) {
+                StackTraceElement[] stack = target.getStackTrace();
+                Set<String> seen = new HashSet<>();
+                boolean top = true;
+                for (StackTraceElement frame : stack) {
+                    String cls = frame.getClassName();
+                    if (RUNNER_FRAMES.contains(cls) || cls.startsWith("CodexJavaRunner$")) continue;
+                    String method = cls + "." + frame.getMethodName();
+                    long[] c = counts.computeIfAbsent(method, k -> new long[]{0, 0, frame.getLineNumber()});
+                    if (top) c[0]++;
+                    if (seen.add(method)) c[1]++;
+                    top = false;
+                }
+                if (stack.length > 0) samples++;
+                try {
+                    Thread.sleep(1);
+                } catch (InterruptedException e) {
+                    return;
+                }
+            }
+        }
+
+        // Writes "samples\\twallNs" then one "method\\tline\\tself\\ttotal" row per method.
+        void finish(String path, long wallNs) throws IOException {
+            stop = true;
+            try {
+                join(100);
+            } catch (InterruptedException ignored) {
+            }
+            try (PrintStream p = new PrintStream(new FileOutputStream(path), false, "UTF-8")) {
+                p.println(samples + "\\t" + wallNs);
+                for (Map.Entry<String, long[]> e : counts.entrySet()) {
+                    long[] c = e.getValue();
+                    p.println(e.getKey() + "\\t" + c[2] + "\\t" + c[0] + "\\t" + c[1]);
+                }
+            }
+        }
+    }
+
+    static String run(String classDir, String className, String stdinPath, String stdoutPath,
+                      String stderrPath, long timeoutMs, long maxOutput, String profilePath) throws Exception {
+        Properties savedProps = (Properties) System.getProperties().clone();
+        ThreadGroup group = new ThreadGroup("submission");
+        int[] exit = {0};
+        long[] cpu = {0};
+        CappedOutputStream capped = new CappedOutputStream(new FileOutputStream(stdoutPath), maxOutput);
+        try (InputStream stdin = new BufferedInputStream(new FileInputStream(stdinPath));
+             PrintStream out = new PrintStream(new BufferedOutputStream(capped), false, "UTF-8");
+             PrintStream err = new PrintStream(new FileOutputStream(stderrPath), true, "UTF-8");
+             URLClassLoader loader = new URLClassLoader(
+                 new URL[]{new File(classDir).toURI().toURL()}, ClassLoader.getPlatformClassLoader())) {
+            runOut = out;
+            System.setIn(stdin);
+            System.setOut(out);
+            System.setErr(err);
+            Thread main = new Thread(group, () -> {
+                try {
+                    Method m = loader.loadClass(className).getMethod("main", String[].class);
+                    m.invoke(null, (Object) new String[0]);
+                } catch (InvocationTargetException e) {
+                    err.print("Exception in thread \\"main\\" ");
+                    e.getCause().printStackTrace(err);
+                    exit[0] = 1;
+                } catch (Throwable e) {
+                    err.println("Error: " + e);
+                    exit[0] = 1;
+                } finally {
+                    cpu[0] = ManagementFactory.getThreadMXBean().getCurrentThreadCpuTime();
+                }
+            }, "main");
+            long start = System.nanoTime();
+            long deadline = start + timeoutMs * 1_000_000L;
+            main.start();
+            Sampler sampler = profilePath.isEmpty() ? null : new Sampler(main);
+            if (sampler != null) sampler.start();
+            while (main.isAlive() && !capped.exceeded && System.nanoTime() < deadline) {
+                main.join(Math.max(1, Math.min(50, (deadline - System.nanoTime()) / 1_000_000L)));
+            }
+            long wall = System.nanoTime() - start;
+            out.flush();
+            if (sampler != null) sampler.finish(profilePath, wall);
+            // A thread that can't be stopped ends the worker either way
+            if (main.isAlive() && capped.exceeded) return "OUTPUT\\t1\\t0\\t" + wall + "\\t1";
+            if (main.isAlive()) return "TIMEOUT\\t-1\\t0\\t" + wall + "\\t1";
+            // Reply: status, exit code, CPU ns, wall ns, leaked-threads flag (always last)
+            return "DONE\\t" + exit[0] + "\\t" + cpu[0] + "\\t" + wall + "\\t" + (group.activeCount() > 0 ? 1 : 0);
+        } finally {
+            runOut = null;
+            System.setIn(STDIN);
+            System.setOut(REPLY);
+            System.setErr(STDERR);
+            System.setProperties(savedProps);
+        }
+    }
+}
+"""
+
+
+def get_java_runner_dir() -> str:
+    """Compile the JVM runner once into the compile cache and return its class dir."""
+    def build(build_dir: str):
+        src = f"{build_dir}/CodexJavaRunner.java"
+        with open(src, "w") as f:
+            f.write(JAVA_RUNNER_SRC)
+        compile_proc = subprocess.run(["javac", src], capture_output=True, text=True, cwd=build_dir)
+        return compile_proc if compile_proc.returncode != 0 else None
+
+    runner_dir, compile_err = compile_cached("java-runner", "javac", [], JAVA_RUNNER_SRC, build)
+    if compile_err is not None:
+        raise RuntimeError(f"JVM runner failed to compile: {compile_err}")
+    return runner_dir
+
+
+class JavaWorker(PooledWorker):
+    """A warm JVM speaking a tab-separated line protocol over stdin/stdout."""
+
+    def __init__(self):
+        super().__init__()
+        runner_dir = get_java_runner_dir()
+        self.tmp = tempfile.mkdtemp(prefix="codex-jvm-")
+        self.proc = subprocess.Popen(
+            ["java", *JAVA_POOL_OPTS.split(), *JAVA_HEAP_FLAGS, "-cp", runner_dir, "CodexJavaRunner"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+            cwd=self.tmp,
+        )
+
+    def _call(self, fields: list[str], timeout: float) -> list[str] | None:
+        reply = self.request("\t".join(fields), timeout)
+        return reply.rstrip("\n").split("\t") if reply else None
+
+    def compile(self, src: str, out_dir: str, flags: list[str]) -> subprocess.CompletedProcess:
+        err_path = os.path.join(self.tmp, "javac.err")
+        reply = self._call(["COMPILE", src, out_dir, err_path, *flags], timeout=30)
+        if reply is None:
+            self.dirty = True
+            raise RuntimeError("JVM worker exited during compile")
+        with open(err_path, errors="replace") as f:
+            err = f.read()
+        return subprocess.CompletedProcess(["javac", src], int(reply[1]), "", err)
+
+    def run(self, class_dir: str, class_name: str, stdin: str, timeout: float, profile_path: str = "") -> RunResult:
+        with tempfile.TemporaryDirectory() as tmp:
+            io_paths = [os.path.join(tmp, name) for name in ("stdin", "stdout", "stderr")]
+            with open(io_paths[0], "w") as f:
+                f.write(stdin)
+            for path in io_paths[1:]:
+                open(path, "w").close()
+
+            reply = self._call(
+                ["RUN", class_dir, class_name, *io_paths, str(int(timeout * 1000)), str(RUN_MAX_OUTPUT_BYTES), profile_path],
+                timeout + 2,
+            )
+            cpu_time = wall_time = None
+            if reply is None:
+                # System.exit() in user code (or a watchdog kill) ends the JVM
+                self.dirty = True
+                returncode = self.proc.wait()
+                if returncode == -9:
+                    raise subprocess.TimeoutExpired(["java", class_name], timeout)
+            elif reply[0] == "TIMEOUT":
+                self.dirty = True
+                raise subprocess.TimeoutExpired(["java", class_name], timeout)
+            else:
+                returncode = int(reply[1])
+                cpu_time, wall_time = int(reply[2]) / 1e9, int(reply[3]) / 1e9
+                self.dirty = reply[-1] != "0"
+
+            out, out_size = read_capped(io_paths[1])
+            err, _ = read_capped(io_paths[2])
+            limit_hit = "output" if reply and reply[0] == "OUTPUT" else detect_limit_hit(returncode, err, out_size)
+            if limit_hit == "memory":
+                # Heap state after an OutOfMemoryError can't be trusted
+                self.dirty = True
+            return RunResult(["java", class_name], returncode, out, err, wall_time, cpu_time, limit_hit=limit_hit)
+
+    def close(self) -> None:
+        super().close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+java_pool = WorkerPool("JVM", JavaWorker, size=JAVA_POOL_SIZE, wait=JAVA_POOL_WAIT, max_runs=JAVA_POOL_MAX_RUNS)
+
+
+def compile_java(code: str, class_name: str, worker: JavaWorker | None = None,
+                 run=run_compiler) -> tuple[str | None, str | None]:
+    """Compile through a warm JVM worker when one is given, else with a javac subprocess."""
+    def build(build_dir: str):
+        src = f"{build_dir}/{class_name}.java"
+        with open(src, "w") as f:
+            f.write(code)
+        if worker is not None:
+            compile_proc = worker.compile(src, build_dir, JAVAC_FLAGS)
+        else:
+            compile_proc = run(["javac", *JAVAC_FLAGS, src], cwd=build_dir)
+        return compile_proc if compile_proc.returncode != 0 else None
+
+    return compile_cached("java", "javac", JAVAC_FLAGS, code, build)
+
+
+def run_java(code: str, stdin: str, profile: bool = False) -> ExecuteResponse:
+    class_match = find_java_class(code)
+    if not class_match:
+        return ExecuteResponse(stderr="No public class found in Java code")
+
+    worker = java_pool.acquire()
+    try:
+        start = time.monotonic()
+        artifact_dir, compile_err = compile_java(code, class_match, worker)
+        compile_time = time.monotonic() - start
+        if compile_err is not None:
+            return ExecuteResponse(stderr=compile_err, compileTimeMs=_ms(compile_time))
+        if worker is None:
+            with tempfile.TemporaryDirectory() as tmp:
+                res = run_process(["java", *JAVA_HEAP_FLAGS, "-cp", artifact_dir, class_match], stdin, cwd=tmp,
+                                  native=False, compile_time=compile_time)
+            if profile:
+                res.profile = ProfileReport(note="Java profiling needs the warm JVM pool (JAVA_POOL_SIZE > 0)")
+            return res
+        if not profile:
+            return to_execute_response(worker.run(artifact_dir, class_match, stdin, timeout=5), compile_time)
+        with tempfile.TemporaryDirectory() as tmp:
+            profile_path = os.path.join(tmp, "profile.tsv")
+            res = to_execute_response(worker.run(artifact_dir, class_match, stdin, 5, profile_path), compile_time)
+            res.profile = read_java_profile(profile_path)
+        return res
+    finally:
+        if worker is not None:
+            java_pool.release(worker)
+
+
+# -------- Compile prewarm (C++ / Java) --------
+# The editor calls /execute/prewarm on a debounce while C++/Java code changes.
+# The source is compiled in the background, at low CPU priority, into the
+# compile cache, so the Run that follows finds the build ready (or joins the
+# one still running) instead of paying for g++/javac; the compiler's errors
+# come back as diagnostics for inline markers. A newer prewarm from the same
+# editor kills the build it supersedes.
+
+PREWARM_WORKERS = int(os.getenv("PREWARM_WORKERS", "2"))
+PREWARM_NICE = int(os.getenv("PREWARM_NICE", "10"))
+# Prewarms queued or compiling per process, with or without an editorId; more get 503
+PREWARM_MAX_PENDING = int(os.getenv("PREWARM_MAX_PENDING", str(PREWARM_WORKERS * 4)))
+# A compile still running after this many seconds is killed and reported as an error
+PREWARM_COMPILE_TIMEOUT = float(os.getenv("PREWARM_COMPILE_TIMEOUT", "30"))
+
+_COMPILER_DIAGNOSTIC = re.compile(r"^[^:\n]*\.(?:cpp|java):(\d+):(?:(\d+):)?\s*(fatal error|error|warning):\s*(.*)$")
+
+
+class BuildCancelled(Exception):
+    pass
+
+
+class PrewarmQueueFull(Exception):
+    pass
+
+
+class CompileDiagnostic(BaseModel):
+    line: int | None = None
+    column: int | None = None
+    severity: str  # "error" | "warning"
+    message: str
+
+
+class PrewarmRequest(BaseModel):
+    language: str
+    code: str
+    editorId: str | None = None  # newer code from the same editor cancels the older build
+
+
+class PrewarmResponse(BaseModel):
+    status: str  # "ready" | "error" | "cancelled"
+    sourceHash: str | None = None  # compile cache key; a run of the same source reuses the build
+    compileTimeMs: float | None = None
+    diagnostics: list[CompileDiagnostic] = []
+
+
+def compile_diagnostics(stderr: str) -> list[CompileDiagnostic]:
+    """Errors and warnings with their positions from g++ or javac output."""
+    diagnostics = []
+    lines = stderr.split("\n")
+    for i, line in enumerate(lines):
+        match = _COMPILER_DIAGNOSTIC.match(line)
+        if not match:
+            continue
+        column = int(match.group(2)) if match.group(2) else None
+        if column is None and i + 2 < len(lines) and lines[i + 2].strip() == "^":
+            column = lines[i + 2].index("^") + 1  # javac: source line, then a caret under the column
+        message = match.group(4).strip()
+        details = [rest.strip() for rest in lines[i + 1:i + 6] if rest.strip().startswith(("symbol:", "location:"))]
+        if details:
+            message += f" ({', '.join(details)})"
+        diagnostics.append(CompileDiagnostic(
+            line=int(match.group(1)), column=column,
+            severity="warning" if match.group(3) == "warning" else "error", message=message,
+        ))
+    return diagnostics
+
+
+class PrewarmBuild:
+    """Compiler runs of one prewarm; cancel() kills the one in progress."""
+
+    def __init__(self):
+        self.cancelled = False
+        self.proc = None
+        self.lock = Lock()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            if self.proc is not None and self.proc.poll() is None:
+                self.proc.kill()
+
+    def run(self, cmd: list[str], cwd: str | None = None) -> subprocess.CompletedProcess:
+        with self.lock:
+            if self.cancelled:
+                raise BuildCancelled()
+            self.proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=cwd,
+                preexec_fn=lambda: os.nice(PREWARM_NICE),
+            )
+        try:
+            out, err = self.proc.communicate(timeout=PREWARM_COMPILE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            out, err = self.proc.communicate()
+            err = f"{err}Compilation timed out after {PREWARM_COMPILE_TIMEOUT:g}s"
+        if self.cancelled:
+            raise BuildCancelled()
+        return subprocess.CompletedProcess(cmd, self.proc.returncode, out, err)
+
+
+class CompilePrewarmer:
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prewarm")
+        self.latest: dict[str, PrewarmBuild] = {}  # editorId -> newest build
+        self.lock = Lock()
+        self.pending: set[PrewarmBuild] = set()  # queued or compiling, not yet superseded
+        self.stats = {"builds": 0, "cached": 0, "cancelled": 0, "rejected": 0}
+
+    @staticmethod
+    def source_hash(lang: str, code: str) -> str:
+        if lang == "cpp":
+            return compile_cache_key("cpp", "g++", CPP_FLAGS, code)
+        return compile_cache_key("java", "javac", JAVAC_FLAGS, code)
+
+    @staticmethod
+    def _compile(lang: str, code: str, build: PrewarmBuild) -> tuple[str | None, str | None]:
+        if lang == "cpp":
+            return compile_cpp(code, CPP_FLAGS, run=build.run)
+        class_name = find_java_class(code)
+        if not class_name:
+            return None, "No public class found in Java code"
+        # javac subprocess rather than a pool JVM, which runs need more
+        return compile_java(code, class_name, run=build.run)
+
+    async def prewarm(self, lang: str, code: str, editor_id: str | None) -> PrewarmResponse:
+        key = self.source_hash(lang, code)
+        if compile_cache_get(key):
+            self.stats["cached"] += 1
+            return PrewarmResponse(status="ready", sourceHash=key, compileTimeMs=0.0)
+        build = PrewarmBuild()
+        with self.lock:
+            outdated = self.latest.get(editor_id) if editor_id else None
+            # Replacing the editor's own pending build doesn't add to the queue
+            if len(self.pending - {outdated}) >= PREWARM_MAX_PENDING:
+                self.stats["rejected"] += 1
+                raise PrewarmQueueFull()
+            if editor_id:
+                self.latest[editor_id] = build
+            self.pending.discard(outdated)
+            self.pending.add(build)
+        if outdated is not None:
+            outdated.cancel()
+        start = time.monotonic()
+        try:
+            self.stats["builds"] += 1
+            _, compile_err = await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self._compile, lang, code, build)
+            )
+        except BuildCancelled:
+            self.stats["cancelled"] += 1
+            return PrewarmResponse(status="cancelled", sourceHash=key)
+        finally:
+            with self.lock:
+                self.pending.discard(build)
+                if editor_id and self.latest.get(editor_id) is build:
+                    del self.latest[editor_id]
+        elapsed = _ms(time.monotonic() - start)
+        if compile_err is None:
+            return PrewarmResponse(status="ready", sourceHash=key, compileTimeMs=elapsed)
+        diagnostics = compile_diagnostics(compile_err) or [CompileDiagnostic(severity="error", message=compile_err.strip())]
+        return PrewarmResponse(status="error", sourceHash=key, compileTimeMs=elapsed, diagnostics=diagnostics)
+
+
+compile_prewarmer = CompilePrewarmer(PREWARM_WORKERS)
+
+
+@app.post("/execute/prewarm", response_model=PrewarmResponse)
+async def execute_prewarm(req: PrewarmRequest):
+    lang = req.language.lower()
+    if lang not in ("cpp", "java"):
+        raise HTTPException(status_code=400, detail="Prewarm is only available for cpp and java")
+    try:
+        return await compile_prewarmer.prewarm(lang, req.code, req.editorId)
+    except PrewarmQueueFull:
+        raise HTTPException(status_code=503, detail="Too many background compiles, please retry shortly",
+                            headers={"Retry-After": "1"})
+
+
+# -------- Profile mode --------
+# Profiles are reduced server-side to the PROFILE_TOP_N hottest functions (and,
+# for Python, lines). Python runs under cProfile plus a line tracer in the
+# trace-wrapper style; C++ is built with -pg and read back with gprof; Java is
+# sampled inside the warm JVM runner. Profiled runs keep their mode's timeouts
+# (trace mode's for Python), so a program that runs out of CPU still reports
+# where the time went (Python).
+
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "15"))
+
+PROFILER_SRC = r"""
+import os, sys, json, signal, time, traceback, cProfile
+
+_clock = time.perf_counter
+_lines = {}   # line -> [hits, seconds spent on the line outside user-function calls]
+_stack = []   # [current line, time it started] per active user frame
+_interrupted = None
+
+
+class _CpuLimit(BaseException):
+    pass
+
+
+def _on_xcpu(signum, frame):
+    raise _CpuLimit
+
+
+def _charge(now):
+    if _stack:
+        top = _stack[-1]
+        if top[0] is not None:
+            _lines[top[0]][1] += now - top[1]
+        top[1] = now
+
+
+def _local(frame, event, arg):
+    now = _clock()
+    if event == "line":
+        _charge(now)
+        entry = _lines.get(frame.f_lineno)
+        if entry is None:
+            entry = _lines[frame.f_lineno] = [0, 0.0]
+        entry[0] += 1
+        _stack[-1][0] = frame.f_lineno
+    elif event == "return":
+        _charge(now)
+        _stack.pop()
+        if _stack:
+            _stack[-1][1] = now
+    return _local
+
+
+def _global(frame, event, arg):
+    if frame.f_code.co_filename != "<user>":
+        return None
+    now = _clock()
+    _charge(now)
+    _stack.append([None, now])
+    return _local
+
+
+def _write_profile(prof, elapsed):
+    prof.create_stats()
+    functions = [
+        [file, line, name, cc, nc, tt, ct]
+        for (file, line, name), (cc, nc, tt, ct, _) in prof.stats.items()
+        if file != __file__ and "_lsprof" not in name and name != "<built-in method builtins.exec>"
+    ]
+    with open(_PROFILE_PATH, "w") as f:
+        json.dump({"total": elapsed, "interrupted": _interrupted, "functions": functions, "lines": _lines}, f)
+
+
+if hasattr(signal, "SIGXCPU"):
+    signal.signal(signal.SIGXCPU, _on_xcpu)
+_code = compile(_USER_CODE, "<user>", "exec")
+_g = {"__name__": "__main__"}
+_failed = False
+_elapsed = None
+_prof = cProfile.Profile()
+_start = _clock()
+try:
+    sys.settrace(_global)
+    _prof.enable()
+    try:
+        exec(_code, _g, _g)
+    finally:
+        _prof.disable()
+        sys.settrace(None)
+        _elapsed = _clock() - _start
+except _CpuLimit:
+    _interrupted = "cpu"
+except Exception as e:
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != "<user>":
+        tb = tb.tb_next
+    traceback.print_exception(type(e), e, tb)
+    _failed = True
+finally:
+    _write_profile(_prof, _elapsed if _elapsed is not None else _clock() - _start)
+if _interrupted:
+    # Die the way the CPU limit would have killed us so the run reports limitHit "cpu"
+    sys.stdout.flush()
+    signal.signal(signal.SIGXCPU, signal.SIG_DFL)
+    os.kill(os.getpid(), signal.SIGXCPU)
+if _failed:
+    sys.exit(1)
+"""
+
+
+def summarize_python_profile(raw: dict) -> ProfileReport:
+    functions = []
+    for file, line, name, primitive_calls, calls, self_time, total_time in raw["functions"]:
+        if file == "<user>":
+            label = name
+        elif file == "~":
+            label = name.strip("<>")  # builtins, e.g. "built-in method builtins.sorted"
+        else:
+            label = f"{os.path.basename(file)}:{name}"
+        functions.append(ProfileFunction(
+            name=label,
+            line=line if file == "<user>" else None,
+            calls=calls,
+            selfMs=_ms(self_time),
+            totalMs=_ms(total_time),
+        ))
+    functions.sort(key=lambda f: f.selfMs, reverse=True)
+    lines = sorted(
+        (ProfileLine(line=int(line), hits=hits, timeMs=_ms(seconds)) for line, (hits, seconds) in raw["lines"].items()),
+        key=lambda l: l.timeMs,
+        reverse=True,
+    )
+    return ProfileReport(
+        tool="cProfile",
+        totalMs=_ms(raw["total"]),
+        functions=functions[:PROFILE_TOP_N],
+        lines=lines[:PROFILE_TOP_N],
+        note="Stopped at the CPU limit; the profile covers the run up to that point" if raw["interrupted"] else None,
+    )
+
+
+def profile_python(code: str, stdin: str) -> ExecuteResponse:
+    with tempfile.TemporaryDirectory() as tmp:
+        profile_path = os.path.join(tmp, "profile.json")
+        wrapper_path = os.path.join(tmp, "profile_wrapper.py")
+        with open(wrapper_path, "w") as f:
+            f.write(f"_PROFILE_PATH = {profile_path!r}\n_USER_CODE = {textwrap.dedent(code)!r}\n" + PROFILER_SRC)
+        # Same budget as trace mode: tracing slows the program down
+        proc = run_python_script(wrapper_path, stdin, timeout=TRACE_TIMEOUT, cpu_limit=TRACE_CPU_LIMIT)
+        raw = None
+        try:
+            with open(profile_path) as f:
+                raw = json.load(f)
+        except (OSError, ValueError):
+            pass
+    res = to_execute_response(proc, cpu_limit=TRACE_CPU_LIMIT)
+    if raw is None:
+        res.profile = ProfileReport(tool="cProfile", note="The program ended before its profile was written")
+    else:
+        res.profile = summarize_python_profile(raw)
+    return res
+
+
+def read_gprof(exe: str, gmon_path: str) -> ProfileReport:
+    """Top functions from gprof's call graph: exact call counts, 10 ms time samples."""
+    if not os.path.exists(gmon_path):
+        return ProfileReport(tool="gprof", note="No profile was written; the program must exit normally")
+    try:
+        proc = subprocess.run(["gprof", "-b", "-q", exe, gmon_path], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return ProfileReport(tool="gprof", note="gprof is not available on this server")
+
+    functions = []
+    # Primary call-graph lines: "[idx] %time self children called name [idx]"
+    primary = re.compile(r"^\[\d+\]\s+[\d.]+\s+([\d.]+)\s+([\d.]+)\s+(?:(\d+)(?:\+(\d+))?\s+)?(.+?)\s+\[\d+\]$")
+    for row in proc.stdout.splitlines():
+        m = primary.match(row)
+        if not m or m.group(5).startswith(("_", "<")):
+            continue  # runtime internals and cycle summaries
+        self_s, children_s = float(m.group(1)), float(m.group(2))
+        calls = int(m.group(3)) + int(m.group(4) or 0) if m.group(3) else None
+        functions.append(ProfileFunction(
+            name=m.group(5), calls=calls, selfMs=_ms(self_s), totalMs=_ms(self_s + children_s),
+        ))
+    functions.sort(key=lambda f: (f.selfMs, f.calls or 0), reverse=True)
+    return ProfileReport(
+        tool="gprof",
+        totalMs=_ms(sum(f.selfMs for f in functions) / 1000),
+        functions=functions[:PROFILE_TOP_N],
+        note="Times are sampled every 10 ms; call counts are exact",
+    )
+
+
+def read_java_profile(path: str) -> ProfileReport:
+    """Turn the JVM runner's stack samples into per-method self/total time estimates."""
+    try:
+        with open(path, errors="replace") as f:
+            rows = [row.rstrip("\n").split("\t") for row in f]
+    except OSError:
+        return ProfileReport(tool="jvm-sampler", note="No profile was written; the run did not finish")
+    samples, wall_ns = int(rows[0][0]), int(rows[0][1])
+    per_sample = wall_ns / 1e9 / samples if samples else 0
+    functions = [
+        ProfileFunction(
+            name=method,
+            line=int(line) if int(line) > 0 else None,
+            selfMs=_ms(int(self_count) * per_sample),
+            totalMs=_ms(int(total_count) * per_sample),
+        )
+        for method, line, self_count, total_count in rows[1:]
+    ]
+    functions.sort(key=lambda f: (f.selfMs, f.totalMs), reverse=True)
+    return ProfileReport(
+        tool="jvm-sampler",
+        totalMs=_ms(wall_ns / 1e9),
+        functions=functions[:PROFILE_TOP_N],
+        note=f"{samples} stack samples of the main thread; times are estimates",
+    )
+
+
+def run_command(cmd: list[str], stdin: str, cwd: str = None, timeout: float = 5,
+                native: bool = True, limits: dict | None = None) -> RunResult:
+    """
+    Run `cmd` to completion under the per-run rlimits and measure its resource usage.
+
+    I/O goes through temp files and the child is reaped with wait4 so its
+    resource usage is exact; platforms without wait4 fall back to
+    subprocess.run and report wall time only. `native=False` leaves out the
+    address-space and process limits for runtimes that cap their own heap.
+    """
+    start = time.monotonic()
+    if not hasattr(os, "wait4"):
+        proc = subprocess.run(cmd, input=stdin, capture_output=True, text=True, timeout=timeout, cwd=cwd)
+        return RunResult(cmd, proc.returncode, proc.stdout, proc.stderr, wall_time=time.monotonic() - start)
+
+    if limits is None:
+        limits = run_rlimits(native)
+    with tempfile.TemporaryFile("w+", errors="replace") as fin, \
+            tempfile.TemporaryFile("w+b") as fout, \
+            tempfile.TemporaryFile("w+b") as ferr:
+        fin.write(stdin)
+        fin.seek(0)
+        proc = subprocess.Popen(
+            cmd, stdin=fin, stdout=fout, stderr=ferr, cwd=cwd,
+            preexec_fn=partial(apply_rlimits, limits) if resource is not None else None,
+        )
+        # Popen returns once the exec has happened, so every sample is of the new image
+        deadline = start + timeout
+        peak_rss = read_peak_rss(proc.pid)
+        while True:
+            wpid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+            if wpid:
+                break
+            if time.monotonic() > deadline:
+                proc.kill()
+                os.wait4(proc.pid, 0)
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            peak_rss = read_peak_rss(proc.pid) or peak_rss
+            time.sleep(0.002)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        out_size = os.fstat(fout.fileno()).st_size
+        fout.seek(0)
+        ferr.seek(0)
+        out = fout.read(RUN_MAX_OUTPUT_BYTES).decode(errors="replace")
+        err = ferr.read(RUN_MAX_OUTPUT_BYTES).decode(errors="replace")
+        return RunResult(
+            cmd, proc.returncode, out, err,
+            wall_time=time.monotonic() - start,
+            cpu_time=usage.ru_utime + usage.ru_stime,
+            peak_rss_kb=peak_rss,
+            limit_hit=detect_limit_hit(proc.returncode, err, out_size),
+        )
+
+
+def run_process(cmd: list[str], stdin: str, cwd: str = None, native: bool = True,
+                compile_time: float | None = None) -> ExecuteResponse:
+    return to_execute_response(run_command(cmd, stdin, cwd=cwd, native=native), compile_time)
+
+
+# -------- AI: HTTP client pool --------
+# One keep-alive httpx.AsyncClient per provider, so AI calls reuse TCP/TLS
+# connections and never hold a threadpool thread while a model is generating.
+# Clients are created lazily on the running event loop and closed on shutdown.
+
+LLM_TIMEOUTS = {
+    "ollama": float(os.getenv("OLLAMA_TIMEOUT", "120")),
+    "openai": float(os.getenv("OPENAI_TIMEOUT", "15")),
+    "anthropic": float(os.getenv("ANTHROPIC_TIMEOUT", "15")),
+}
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "20"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "10"))
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "false").lower() == "true"
+
+
+def llm_base_url(provider: str) -> str:
+    if provider == "ollama":
+        return os.getenv("OLLAMA_URL", "http://localhost:11434")
+    if provider == "openai":
+        return "https://api.openai.com"
+    if provider == "anthropic":
+        return "https://api.anthropic.com"
+    raise ValueError(f"Unsupported AI provider: {provider}")
+
+
+class LLMHttpClients:
+    """Lazily created, per-provider pooled async HTTP clients."""
+
+    def __init__(self):
+        self.clients: dict[str, tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+
+    def _create(self, provider: str) -> httpx.AsyncClient:
+        options = dict(
+            base_url=llm_base_url(provider),
+            timeout=httpx.Timeout(LLM_TIMEOUTS[provider], connect=LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=LLM_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+            ),
+        )
+        # Ollama is plain HTTP on localhost; HTTP/2 only helps the TLS providers
+        if LLM_HTTP2 and provider != "ollama":
+            try:
+                return httpx.AsyncClient(http2=True, **options)
+            except ImportError:
+                print("[DEBUG] LLM_HTTP2 is set but the h2 package is missing, using HTTP/1.1")
+        return httpx.AsyncClient(**options)
+
+    def client(self, provider: str) -> httpx.AsyncClient:
+        # A client's connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        entry = self.clients.get(provider)
+        if entry is None or entry[0] is not loop or entry[1].is_closed:
+            entry = self.clients[provider] = (loop, self._create(provider))
+        return entry[1]
+
+    async def aclose(self) -> None:
+        clients, self.clients = self.clients, {}
+        for loop, client in clients.values():
+            if loop is asyncio.get_running_loop():
+                await client.aclose()
+
+
+llm_http = LLMHttpClients()
+
+
+@app.on_event("shutdown")
+async def close_llm_clients():
+    await llm_http.aclose()
+
+
+# -------- AI: provider health --------
+# A background task probes each configured provider every AI_HEALTH_INTERVAL
+# seconds and keeps its up/down state and latency. Each provider has a circuit
+# breaker fed by both probes and real calls: after AI_BREAKER_FAILURES
+# consecutive failures it opens and AI calls fail fast to the mock/fallback
+# answers; after AI_BREAKER_COOLDOWN it goes half-open and lets one probe or
+# request through to decide whether to close again. Real calls also keep a
+# window of latencies and outcomes for routing (see "AI: provider routing"),
+# and each provider has a concurrency limit and an optional hourly budget.
+
+AI_HEALTH_INTERVAL = float(os.getenv("AI_HEALTH_INTERVAL", "15"))
+AI_HEALTH_TIMEOUT = float(os.getenv("AI_HEALTH_TIMEOUT", "3"))
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", "3"))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", "30"))
+AI_PROVIDERS = ("ollama", "openai", "anthropic")
+AI_LATENCY_WINDOW = 100  # recent calls kept per provider for percentiles and error rate
+PROVIDER_MAX_CONCURRENCY = {
+    name: int(os.getenv(f"{name.upper()}_MAX_CONCURRENCY", default))
+    for name, default in (("ollama", "4"), ("openai", "16"), ("anthropic", "16"))
+}
+# Requests per rolling hour, 0 = unlimited; caps spend on the paid APIs
+PROVIDER_HOURLY_BUDGET = {name: int(os.getenv(f"{name.upper()}_HOURLY_BUDGET", "0")) for name in AI_PROVIDERS}
+
+
+class ProviderUnavailable(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open or budget is spent."""
+
+
+class ProviderHealth:
+    """Health, circuit breaker, latency and load of one provider; used from the event loop only."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"  # "closed" | "open" | "half_open"
+        self.up: bool | None = None
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.latency_ms: float | None = None  # EWMA over real calls
+        self.probe_ms: float | None = None  # EWMA over health probes
+        self.samples: deque[float] = deque(maxlen=AI_LATENCY_WINDOW)
+        self.outcomes: deque[bool] = deque(maxlen=AI_LATENCY_WINDOW)
+        self.last_check: float | None = None
+        self.last_error: str | None = None
+        self.slots = asyncio.Semaphore(PROVIDER_MAX_CONCURRENCY[name])
+        self.in_flight = 0
+        self.recent_calls: deque[float] = deque()  # start times within the last hour
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open state only one trial at a time."""
+        if self.state == "open" and time.monotonic() - self.opened_at >= AI_BREAKER_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def available(self) -> bool:
+        """allow() without taking the half-open trial."""
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            return time.monotonic() - self.opened_at >= AI_BREAKER_COOLDOWN
+        return not self.trial_in_flight
+
+    def record_success(self, latency: float, probe: bool = False) -> None:
+        if self.state != "closed":
+            print(f"[DEBUG] {self.name} recovered, closing circuit")
+        self.state = "closed"
+        self.up = True
+        self.failures = 0
+        self.trial_in_flight = False
+        self.last_error = None
+        if probe:
+            ms = latency * 1000
+            self.probe_ms = ms if self.probe_ms is None else 0.8 * self.probe_ms + 0.2 * ms
+        else:
+            self.record_latency(latency)
+            self.outcomes.append(True)
+
+    def record_latency(self, latency: float) -> None:
+        ms = latency * 1000
+        self.samples.append(ms)
+        self.latency_ms = ms if self.latency_ms is None else 0.8 * self.latency_ms + 0.2 * ms
+
+    def record_failure(self, error: Exception, probe: bool = False) -> None:
+        self.up = False
+        self.failures += 1
+        self.trial_in_flight = False
+        self.last_error = str(error) or type(error).__name__
+        if not probe:
+            self.outcomes.append(False)
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= AI_BREAKER_FAILURES):
+            print(f"[DEBUG] {self.name} unhealthy ({self.last_error}), opening circuit")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def percentile(self, q: float) -> float | None:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def budget_left(self) -> bool:
+        budget = PROVIDER_HOURLY_BUDGET[self.name]
+        while self.recent_calls and time.monotonic() - self.recent_calls[0] > 3600:
+            self.recent_calls.popleft()
+        return budget == 0 or len(self.recent_calls) < budget
+
+    def snapshot(self) -> dict:
+        p50, p90 = self.percentile(0.5), self.percentile(0.9)
+        return {
+            "state": self.state,
+            "up": self.up,
+            "latencyMs": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "p50Ms": round(p50, 1) if p50 is not None else None,
+            "p90Ms": round(p90, 1) if p90 is not None else None,
+            "probeMs": round(self.probe_ms, 1) if self.probe_ms is not None else None,
+            "errorRate": round(self.error_rate(), 3),
+            "inFlight": self.in_flight,
+            "maxConcurrency": PROVIDER_MAX_CONCURRENCY[self.name],
+            "callsLastHour": len(self.recent_calls),
+            "hourlyBudget": PROVIDER_HOURLY_BUDGET[self.name] or None,
+            "consecutiveFailures": self.failures,
+            "lastCheckAgoS": round(time.time() - self.last_check, 1) if self.last_check else None,
+            "lastError": self.last_error,
+            "retryInS": round(max(0.0, AI_BREAKER_COOLDOWN - (time.monotonic() - self.opened_at)), 1)
+            if self.state == "open" else None,
+        }
+
+
+provider_health = {name: ProviderHealth(name) for name in AI_PROVIDERS}
+
+
+def provider_api_key(provider: str) -> str | None:
+    if provider == "openai":
+        return os.getenv("OPENAI_API_KEY")
+    if provider == "anthropic":
+        return os.getenv("ANTHROPIC_API_KEY")
+    return None
+
+
+def provider_configured(provider: str) -> bool:
+    """Ollama when it is selected or has a URL; the hosted APIs when they have a key."""
+    if provider == "ollama":
+        return get_ai_provider() in ("ollama", "auto") or bool(os.getenv("OLLAMA_URL"))
+    return bool(provider_api_key(provider))
+
+
+async def probe_provider(provider: str) -> None:
+    """One cheap authenticated request (list models) that doesn't spend tokens."""
+    health = provider_health[provider]
+    if health.state == "open" and time.monotonic() - health.opened_at < AI_BREAKER_COOLDOWN:
+        return
+    trial = health.state != "closed"
+    if trial and not health.allow():
+        return  # a trial request is already deciding
+    start = time.monotonic()
+    try:
+        if provider == "ollama":
+            path, headers = "/api/tags", {}
+        elif provider == "openai":
+            path, headers = "/v1/models", {"Authorization": f"Bearer {provider_api_key(provider)}"}
+        else:
+            path, headers = "/v1/models", {"x-api-key": provider_api_key(provider), "anthropic-version": "2023-06-01"}
+        resp = await llm_http.client(provider).get(path, headers=headers, timeout=AI_HEALTH_TIMEOUT)
+        resp.raise_for_status()
+    except Exception as e:
+        # Also a closed client at shutdown or a bad key, not just HTTP errors
+        health.record_failure(e, probe=True)
+    else:
+        health.record_success(time.monotonic() - start, probe=True)
+    finally:
+        # A cancelled probe must not keep the half-open trial either
+        if trial:
+            health.trial_in_flight = False
+    health.last_check = time.time()
+
+
+async def monitor_providers() -> None:
+    while True:
+        await asyncio.gather(
+            *(probe_provider(name) for name in AI_PROVIDERS if provider_configured(name)),
+            return_exceptions=True,
+        )
+        await asyncio.sleep(AI_HEALTH_INTERVAL)
+
+
+_provider_monitor: asyncio.Task | None = None
+
+
+@app.on_event("startup")
+async def start_provider_monitor():
+    global _provider_monitor
+    _provider_monitor = asyncio.create_task(monitor_providers())
+
+
+@app.on_event("shutdown")
+async def stop_provider_monitor():
+    if _provider_monitor is not None:
+        _provider_monitor.cancel()
+
+
+@app.get("/ai/status")
+def ai_status():
+    """Cached health, latency, load and circuit-breaker state of every AI provider."""
+    return {
+        "provider": get_ai_provider(),
+        "ollamaModel": ollama_residency.snapshot(),
+        "routing": {
+            "candidates": ai_router.candidates(),
+            "order": ai_router.rank(),
+            "hedge": AI_HEDGE,
+        },
+        "providers": {
+            name: {"configured": provider_configured(name), **health.snapshot()}
+            for name, health in provider_health.items()
+        },
+    }
+
+
+# -------- AI: provider routing --------
+# AI_PROVIDER picks one provider, or "auto" to route over AI_ROUTE_PROVIDERS.
+# Each request goes to the usable candidate (breaker not open, budget left)
+# with the lowest expected latency: the call-latency EWMA, inflated by the
+# recent error rate, with providers at their concurrency limit last and
+# providers without samples first so they get measured. A failed call fails
+# over to the next candidate. With AI_HEDGE, a second provider is started when
+# the first hasn't answered within its observed p90 (at least AI_HEDGE_MIN_MS)
+# and the first answer wins; the loser is cancelled and its elapsed time still
+# counts as a latency sample, so a degraded provider drops in the ranking.
+
+AI_ROUTE_PROVIDERS = [
+    name.strip() for name in os.getenv("AI_ROUTE_PROVIDERS", ",".join(AI_PROVIDERS)).split(",")
+    if name.strip() in AI_PROVIDERS
+]
+AI_HEDGE = os.getenv("AI_HEDGE", "false").lower() == "true"
+AI_HEDGE_MIN_MS = float(os.getenv("AI_HEDGE_MIN_MS", "500"))
+AI_HEDGE_MIN_SAMPLES = 10  # below this, hedge after twice the EWMA instead of the p90
+
+
+class AIRouter:
+    def candidates(self) -> list[str]:
+        provider = get_ai_provider()
+        names = AI_ROUTE_PROVIDERS if provider == "auto" else [provider]
+        return [name for name in names if name in provider_health and provider_configured(name)]
+
+    def rank(self, exclude: list[str] = ()) -> list[str]:
+        """Usable candidates, expected fastest first."""
+        ranked = []
+        for name in self.candidates():
+            health = provider_health[name]
+            if name in exclude or not health.available() or not health.budget_left():
+                continue
+            expected = (health.latency_ms or 0.0) * (1 + 2 * health.error_rate())
+            ranked.append((health.slots.locked(), expected, name))
+        return [name for _, _, name in sorted(ranked)]
+
+    def hedge_delay(self, name: str) -> float | None:
+        health = provider_health[name]
+        if len(health.samples) >= AI_HEDGE_MIN_SAMPLES:
+            delay_ms = health.percentile(0.9)
+        elif health.latency_ms is not None:
+            delay_ms = 2 * health.latency_ms
+        else:
+            return None
+        return max(delay_ms, AI_HEDGE_MIN_MS) / 1000
+
+    async def call(self, name: str, prompt: str) -> str:
+        health = provider_health[name]
+        async with health.slots:
+            # The half-open trial is only taken once a slot is held, and always given back
+            health, api_key = reserve_provider(name)
+            trial = health.state == "half_open"
+            health.recent_calls.append(time.monotonic())
+            health.in_flight += 1
+            start = time.monotonic()
+            try:
+                if name == "ollama":
+                    text = await get_ollama_response(prompt)
+                elif name == "openai":
+                    text = await get_openai_response(prompt, api_key)
+                else:
+                    text = await get_anthropic_response(prompt, api_key)
+            except asyncio.CancelledError:
+                # Lost a hedge race or the client went away: it took at least this long
+                health.record_latency(time.monotonic() - start)
+                raise
+            except Exception as e:
+                # Includes KeyError/IndexError/TypeError from an unexpected response body
+                health.record_failure(e)
+                raise
+            finally:
+                health.in_flight -= 1
+                if trial:
+                    health.trial_in_flight = False
+        health.record_success(time.monotonic() - start)
+        return text
+
+    async def complete(self, prompt: str) -> str:
+        tried: list[str] = []
+        tasks: dict[asyncio.Task, str] = {}
+        errors: list[Exception] = []
+
+        def launch() -> bool:
+            order = self.rank(exclude=tried)
+            if not order:
+                return False
+            tried.append(order[0])
+            tasks[asyncio.create_task(self.call(order[0], prompt))] = order[0]
+            return True
+
+        if not launch():
+            raise ProviderUnavailable("no AI provider is available")
+        hedge_after = self.hedge_delay(tried[0]) if AI_HEDGE else None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                hedge_after = None
+                if not done:
+                    if launch():
+                        print(f"[DEBUG] {tried[0]} slower than its p90, hedging with {tried[-1]}")
+                    continue
+                for task in done:
+                    name = tasks.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+                    print(f"[DEBUG] {name} failed: {task.exception()}")
+                if not tasks and launch():
+                    print(f"[DEBUG] failing over to {tried[-1]}")
+            raise errors[-1]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_from(self, name: str, prompt: str):
+        health = provider_health[name]
+        async with health.slots:
+            health, api_key = reserve_provider(name)
+            trial = health.state == "half_open"
+            health.recent_calls.append(time.monotonic())
+            if name == "ollama":
+                pieces = stream_ollama(prompt)
+            elif name == "openai":
+                pieces = stream_openai(prompt, api_key)
+            else:
+                pieces = stream_anthropic(prompt, api_key)
+            health.in_flight += 1
+            start = time.monotonic()
+            try:
+                async for piece in pieces:
+                    yield piece
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception as e:
+                health.record_failure(e)
+                raise
+            finally:
+                health.in_flight -= 1
+                if trial:
+                    health.trial_in_flight = False
+                await pieces.aclose()
+        health.record_success(time.monotonic() - start)
+
+    async def stream(self, prompt: str):
+        """Stream from the best provider, failing over while nothing has been sent yet."""
+        tried: list[str] = []
+        error: Exception = ProviderUnavailable("no AI provider is available")
+        while True:
+            order = self.rank(exclude=tried)
+            if not order:
+                raise error
+            tried.append(order[0])
+            sent = False
+            try:
+                async for piece in self.stream_from(order[0], prompt):
+                    sent = True
+                    yield piece
+                return
+            except (httpx.HTTPError, ValueError, ProviderUnavailable) as e:
+                if sent:
+                    raise
+                print(f"[DEBUG] {order[0]} failed before streaming: {e}")
+                error = e
+
+
+ai_router = AIRouter()
+
+
+# -------- AI: Ollama Integration --------
+
+def ollama_payload(model: str, prompt: str, stream: bool) -> dict:
+    return {
+        "model": model,
+        "prompt": prompt,
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {
+            "temperature": 0.3,
+            "top_p": 0.9,
+            "top_k": 40,
+            "repeat_penalty": 1.1,
+            "num_ctx": 4096
+        }
+    }
+
+
+async def query_ollama(model: str, prompt: str) -> str:
+    """
+    Query the local Ollama API for AI responses.
+    
+    Args:
+        model: The model name to use (e.g., 'mistral:7b')
+        prompt: The prompt to send to the model
+        
+    Returns:
+        str: The response text from Ollama
+        
+    Raises:
+        httpx.HTTPError: If request fails
+        ValueError: If response is invalid
+    """
+    try:
+        payload = ollama_payload(model, prompt, stream=False)
+        response = await llm_http.client("ollama").post("/api/generate", json=payload)
+        response.raise_for_status()
+        
+        data = response.json()
+        ollama_residency.note_generate(data)
+        return data.get('response', '')
+            
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"Ollama request timed out after {LLM_TIMEOUTS['ollama']:g} seconds")
+    except httpx.HTTPError as e:
+        raise httpx.HTTPError(f"Ollama request failed: {str(e)}")
+    except Exception as e:
+        raise ValueError(f"Failed to parse Ollama response: {str(e)}")
+
+async def get_ollama_response(prompt: str) -> str:
+    """
+    Get response from the configured Ollama model.
+    
+    Args:
+        prompt: The prompt to send to Ollama
+        
+    Returns:
+        str: The response text from Ollama
+        
+    Raises:
+        ValueError: If the request fails or no valid model is configured
+    """
+    model_name = os.getenv("OLLAMA_MODEL", "mistral:7b")
+    
+    try:
+        return await query_ollama(model_name, prompt)
+    except Exception as e:
+        raise ValueError(f"Ollama error: {str(e)}")
+
+
+
+# -------- AI: Ollama model residency --------
+# Loading the GGUF weights is the slowest part of a cold Ollama request. Every
+# request asks Ollama to keep the model loaded for OLLAMA_KEEP_ALIVE, the model
+# is preloaded at startup, and during class hours (OLLAMA_WARM_HOURS on
+# OLLAMA_WARM_DAYS, server local time) a background task checks /api/ps every
+# OLLAMA_WARM_INTERVAL seconds and reloads or refreshes the model before it
+# would be unloaded. A preload is a generate call without a prompt: Ollama
+# loads the model and returns without running inference.
+
+_DURATION_NUMBER = re.compile(r"-?\d+")
+OLLAMA_KEEP_ALIVE: str | int = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+if _DURATION_NUMBER.fullmatch(OLLAMA_KEEP_ALIVE):
+    OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE)  # seconds; -1 keeps the model loaded forever
+OLLAMA_PRELOAD = os.getenv("OLLAMA_PRELOAD", "true").lower() == "true"
+OLLAMA_WARM_HOURS = os.getenv("OLLAMA_WARM_HOURS", "")  # e.g. "08:00-18:00"; empty = always
+OLLAMA_WARM_DAYS = [day.strip().lower()[:3] for day in os.getenv("OLLAMA_WARM_DAYS", "").split(",") if day.strip()]
+OLLAMA_WARM_INTERVAL = float(os.getenv("OLLAMA_WARM_INTERVAL", "240"))
+OLLAMA_LOAD_TIMEOUT = float(os.getenv("OLLAMA_LOAD_TIMEOUT", "300"))
+_WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+_FRACTION = re.compile(r"(\.\d{6})\d+")
+
+
+def in_warm_window(now: datetime | None = None) -> bool:
+    now = now or datetime.now()
+    if OLLAMA_WARM_DAYS and _WEEKDAYS[now.weekday()] not in OLLAMA_WARM_DAYS:
+        return False
+    if not OLLAMA_WARM_HOURS:
+        return True
+    try:
+        start, end = (datetime.strptime(part.strip(), "%H:%M").time() for part in OLLAMA_WARM_HOURS.split("-"))
+    except ValueError:
+        print(f"[DEBUG] Invalid OLLAMA_WARM_HOURS {OLLAMA_WARM_HOURS!r}, keeping the model warm all day")
+        return True
+    if start <= end:
+        return start <= now.time() < end
+    return now.time() >= start or now.time() < end  # window across midnight
+
+
+class OllamaResidency:
+    """Load state of OLLAMA_MODEL in the Ollama server, and what loading it costs."""
+
+    def __init__(self):
+        self.loaded: bool | None = None
+        self.expires_at: datetime | None = None
+        self.size_vram: int | None = None
+        self.last_load_ms: float | None = None  # model load time reported by Ollama
+        self.last_load_at: float | None = None
+        self.cold_loads = 0  # user requests that had to load the model
+        self.preloads = 0
+        self.last_check: float | None = None
+        self.last_error: str | None = None
+
+    def note_generate(self, data: dict) -> None:
+        """Record the load_duration Ollama reports with every finished generate call."""
+        load_ms = (data.get("load_duration") or 0) / 1e6
+        if load_ms >= 1000:  # just reusing a loaded model takes a few ms
+            self.cold_loads += 1
+            self.last_load_ms = load_ms
+            self.last_load_at = time.time()
+        self.loaded = True
+
+    async def refresh(self) -> None:
+        """Read the model's state from /api/ps."""
+        model = get_ai_model("ollama")
+        resp = await llm_http.client("ollama").get("/api/ps", timeout=AI_HEALTH_TIMEOUT)
+        resp.raise_for_status()
+        entry = next((m for m in resp.json().get("models", []) if m.get("name") == model or m.get("model") == model), None)
+        self.loaded = entry is not None
+        self.size_vram = entry.get("size_vram") if entry else None
+        self.expires_at = None
+        if entry and entry.get("expires_at"):
+            try:
+                self.expires_at = datetime.fromisoformat(_FRACTION.sub(r"\1", entry["expires_at"].replace("Z", "+00:00")))
+            except ValueError:
+                pass
+        self.last_check = time.time()
+
+    async def preload(self) -> None:
+        model = get_ai_model("ollama")
+        start = time.monotonic()
+        resp = await llm_http.client("ollama").post(
+            "/api/generate", json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}, timeout=OLLAMA_LOAD_TIMEOUT
+        )
+        resp.raise_for_status()
+        elapsed_ms = (time.monotonic() - start) * 1000
+        load_ms = (resp.json().get("load_duration") or 0) / 1e6
+        if not self.loaded or load_ms >= 1000:
+            self.last_load_ms = load_ms or elapsed_ms
+            self.last_load_at = time.time()
+            print(f"[DEBUG] Ollama model {model} loaded in {self.last_load_ms:.0f}ms")
+        self.preloads += 1
+        self.loaded = True
+
+    def needs_ping(self) -> bool:
+        if not self.loaded:
+            return True
+        if self.expires_at is None:
+            return False
+        # Refresh if it would expire before the next check (with one interval of slack)
+        remaining = (self.expires_at - datetime.now(self.expires_at.tzinfo)).total_seconds()
+        return remaining < 2 * OLLAMA_WARM_INTERVAL
+
+    async def keep_warm(self) -> None:
+        if OLLAMA_PRELOAD:
+            await self._step(force=True)
+        while True:
+            await asyncio.sleep(OLLAMA_WARM_INTERVAL)
+            await self._step(force=False)
+
+    async def _step(self, force: bool) -> None:
+        if not provider_configured("ollama"):
+            return
+        try:
+            await self.refresh()
+            if force or (in_warm_window() and self.needs_ping()):
+                await self.preload()
+                await self.refresh()
+            self.last_error = None
+        except (httpx.HTTPError, ValueError) as e:
+            self.last_error = str(e) or type(e).__name__
+            print(f"[DEBUG] Ollama residency check failed: {self.last_error}")
+
+    def snapshot(self) -> dict:
+        return {
+            "model": get_ai_model("ollama"),
+            "loaded": self.loaded,
+            "expiresAt": self.expires_at.isoformat() if self.expires_at else None,
+            "sizeVram": self.size_vram,
+            "keepAlive": OLLAMA_KEEP_ALIVE,
+            "warmWindowActive": in_warm_window(),
+            "lastLoadMs": round(self.last_load_ms) if self.last_load_ms is not None else None,
+            "lastLoadAgoS": round(time.time() - self.last_load_at, 1) if self.last_load_at else None,
+            "coldLoads": self.cold_loads,
+            "preloads": self.preloads,
+            "lastCheckAgoS": round(time.time() - self.last_check, 1) if self.last_check else None,
+            "lastError": self.last_error,
+        }
+
+
+ollama_residency = OllamaResidency()
+_ollama_warmer: asyncio.Task | None = None
+
+
+@app.on_event("startup")
+async def start_ollama_warmer():
+    global _ollama_warmer
+    _ollama_warmer = asyncio.create_task(ollama_residency.keep_warm())
+
+
+@app.on_event("shutdown")
+async def stop_ollama_warmer():
+    if _ollama_warmer is not None:
+        _ollama_warmer.cancel()
+
+
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL", "claude-3-5-sonnet-20241022")
+
+
+def get_ai_provider() -> str:
+    """Get the configured AI provider."""
+    return os.getenv("AI_PROVIDER", "ollama").lower()
+
+
+def get_ai_model(provider: str) -> str:
+    """Model name used for `provider`; part of the AI cache key."""
+    if provider == "auto":
+        return ",".join(f"{name}:{get_ai_model(name)}" for name in AI_ROUTE_PROVIDERS)
+    if provider == "ollama":
+        return os.getenv("OLLAMA_MODEL", "mistral:7b")
+    if provider == "openai":
+        return OPENAI_MODEL
+    if provider == "anthropic":
+        return ANTHROPIC_MODEL
+    return ""
+
+def openai_request(prompt: str, api_key: str, stream: bool = False) -> tuple[dict, dict]:
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": "You are a helpful coding assistant. Always respond with valid JSON only, no markdown formatting."
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        "temperature": 0.3,
+        "max_tokens": 1000
+    }
+    if stream:
+        payload["stream"] = True
+    return headers, payload
+
+
+async def get_openai_response(prompt: str, api_key: str) -> str:
+    """
+    Make a request to OpenAI GPT-4o API.
+    
+    Args:
+        prompt: The prompt to send to OpenAI
+        api_key: The OpenAI API key
+        
+    Returns:
+        str: The response text from OpenAI
+        
+    Raises:
+        httpx.TimeoutException: If request times out
+        httpx.HTTPError: If request fails
+    """
+    try:
+        headers, payload = openai_request(prompt, api_key)
+        resp = await llm_http.client("openai").post("/v1/chat/completions", headers=headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+        return data["choices"][0]["message"]["content"]
+        
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"OpenAI request timed out after {LLM_TIMEOUTS['openai']:g} seconds")
+    except httpx.HTTPError as e:
+        raise httpx.HTTPError(f"OpenAI request failed: {str(e)}")
+
+def anthropic_request(prompt: str, api_key: str, stream: bool = False) -> tuple[dict, dict]:
+    headers = {
+        "x-api-key": api_key,
+        "Content-Type": "application/json",
+        "anthropic-version": "2023-06-01"
+    }
+    payload = {
+        "model": ANTHROPIC_MODEL,
+        "max_tokens": 1000,
+        "messages": [
+            {
+                "role": "user",
+                "content": f"Always respond with valid JSON only, no markdown formatting. {prompt}"
+            }
+        ]
+    }
+    if stream:
+        payload["stream"] = True
+    return headers, payload
+
+
+async def get_anthropic_response(prompt: str, api_key: str) -> str:
+    """
+    Make a request to Anthropic Claude API.
+    
+    Args:
+        prompt: The prompt to send to Claude
+        api_key: The Anthropic API key
+        
+    Returns:
+        str: The response text from Claude
+        
+    Raises:
+        httpx.TimeoutException: If request times out
+        httpx.HTTPError: If request fails
+    """
+    try:
+        headers, payload = anthropic_request(prompt, api_key)
+        resp = await llm_http.client("anthropic").post("/v1/messages", headers=headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+        return data["content"][0]["text"]
+        
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"Anthropic request timed out after {LLM_TIMEOUTS['anthropic']:g} seconds")
+    except httpx.HTTPError as e:
+        raise httpx.HTTPError(f"Anthropic request failed: {str(e)}")
+
+
+def reserve_provider(provider: str) -> tuple[ProviderHealth, str | None]:
+    """Check configuration and the circuit breaker before calling `provider`."""
+    health = provider_health.get(provider)
+    if health is None:
+        raise ValueError(f"Unsupported AI provider: {provider}")
+    api_key = provider_api_key(provider)
+    if provider != "ollama" and not api_key:
+        raise ValueError(f"{provider.upper()}_API_KEY not found")
+    if not health.allow():
+        raise ProviderUnavailable(f"{provider} is unavailable (circuit open)")
+    return health, api_key
+
+
+async def get_llm_response(prompt: str) -> str:
+    """
+    Get response from the configured LLM provider.
+    
+    Args:
+        prompt: The prompt to send to the LLM
+        
+    Returns:
+        str: The response text from the LLM
+        
+    Raises:
+        httpx.TimeoutException: If request times out
+        httpx.HTTPError: If request fails
+        ValueError: If no valid API key is found
+        ProviderUnavailable: If no provider can take the request
+    """
+    return await ai_router.complete(prompt)
+
+
+async def sse_data(response: httpx.Response):
+    """JSON payloads of the `data:` lines of a server-sent event stream."""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+
+async def stream_ollama(prompt: str):
+    model_name = os.getenv("OLLAMA_MODEL", "mistral:7b")
+    payload = ollama_payload(model_name, prompt, stream=True)
+    try:
+        async with llm_http.client("ollama").stream("POST", "/api/generate", json=payload) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise ValueError(f"Ollama error: {data['error']}")
+                if data.get("response"):
+                    yield data["response"]
+                if data.get("done"):
+                    ollama_residency.note_generate(data)
+                    return
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"Ollama request timed out after {LLM_TIMEOUTS['ollama']:g} seconds")
+
+
+async def stream_openai(prompt: str, api_key: str):
+    headers, payload = openai_request(prompt, api_key, stream=True)
+    try:
+        async with llm_http.client("openai").stream("POST", "/v1/chat/completions", headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            async for data in sse_data(resp):
+                choices = data.get("choices") or [{}]
+                piece = (choices[0].get("delta") or {}).get("content")
+                if piece:
+                    yield piece
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"OpenAI request timed out after {LLM_TIMEOUTS['openai']:g} seconds")
+
+
+async def stream_anthropic(prompt: str, api_key: str):
+    headers, payload = anthropic_request(prompt, api_key, stream=True)
+    try:
+        async with llm_http.client("anthropic").stream("POST", "/v1/messages", headers=headers, json=payload) as resp:
+            resp.raise_for_status()
+            async for data in sse_data(resp):
+                if data.get("type") == "error":
+                    raise ValueError(f"Anthropic error: {data.get('error', {}).get('message', data)}")
+                if data.get("type") == "content_block_delta" and data["delta"].get("text"):
+                    yield data["delta"]["text"]
+                elif data.get("type") == "message_stop":
+                    return
+    except httpx.TimeoutException:
+        raise httpx.TimeoutException(f"Anthropic request timed out after {LLM_TIMEOUTS['anthropic']:g} seconds")
+
+
+async def stream_llm_response(prompt: str):
+    """Like get_llm_response, but yields the text piece by piece as the provider generates it."""
+    async for piece in ai_router.stream(prompt):
+        yield piece
+
+def create_fallback_response(error_message: str = "AI service temporarily unavailable. Please try again.") -> dict:
+    """
+    Create a standardized fallback response for AI service failures.
+    
+    Args:
+        error_message: The error message to include
+        
+    Returns:
+        dict: The fallback response
+    """
+    return {"error": error_message}
+
+
+# -------- AI response cache --------
+# Parsed /ai/suggest and /ai/explain responses, keyed by prompt version,
+# provider/model, language and a normalized form of the code (Python via the
+# AST, other languages with comments and layout whitespace dropped). A small
+# in-process LRU sits in front of a directory of JSON files shared by all
+# workers; entries expire after AI_CACHE_TTL and the directory is trimmed to
+# AI_CACHE_MAX_MB, least recently used first. Mock and fallback answers are
+# never cached.
+
+AI_PROMPT_VERSION = "2"  # bump whenever the suggest/explain prompts change
+AI_CACHE_DIR = os.getenv("AI_CACHE_DIR", os.path.join(tempfile.gettempdir(), "codex_ai_cache"))
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "86400"))
+AI_CACHE_MEMORY_ITEMS = int(os.getenv("AI_CACHE_MEMORY_ITEMS", "512"))
+AI_CACHE_MAX_BYTES = int(os.getenv("AI_CACHE_MAX_MB", "64")) * 1024 * 1024
+AI_CACHE_EVICT_EVERY = 32  # disk trims per process, counted in stores
+
+_CODE_TOKEN = re.compile(
+    r"""(?P<comment>//[^\n]*|/\*.*?\*/)"""
+    r"""|(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)"""
+    r"""|(?P<space>\s+)|(?P<other>.)""",
+    re.S,
+)
+_PY_COMMENT = re.compile(r"""("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|#[^\n]*""")
+_TEMP_PATH = re.compile(re.escape(tempfile.gettempdir()) + r"""/[^\s"':,)]+""")
+
+
+def _token_class(ch: str) -> str:
+    if ch.isalnum() or ch in "_$":
+        return "word"
+    return "op" if ch in "+-*/%&|<>=!^~?:." else "punct"
+
+
+def normalize_code(language: str, code: str) -> str:
+    """Canonical form of `code` for cache keys: formatting and comments don't matter."""
+    if language == "python":
+        try:
+            return ast.unparse(ast.parse(textwrap.dedent(code)))
+        except (SyntaxError, ValueError):
+            # Broken code: keep indentation (it may be the error), drop comments and blank lines
+            stripped = _PY_COMMENT.sub(lambda m: m.group(1) or "", code)
+            return "\n".join(line.rstrip() for line in stripped.splitlines() if line.strip())
+    out: list[str] = []
+    pending_space = False
+    for m in _CODE_TOKEN.finditer(code):
+        kind = m.lastgroup
+        if kind == "comment" or kind == "space":
+            pending_space = True
+            continue
+        text = m.group()
+        # Whitespace only matters where it separates tokens: `int x`, `a - -b`
+        if pending_space and out and _token_class(out[-1][-1]) == _token_class(text[0]) != "punct":
+            out.append(" ")
+        out.append(text)
+        pending_space = False
+    return "".join(out)
+
+
+def normalize_error(error: str | None) -> str:
+    """Error text without the per-run temp paths compilers and tracebacks embed."""
+    if not error:
+        return ""
+    return _TEMP_PATH.sub(lambda m: os.path.basename(m.group()), error.strip())
+
+
+def ai_cache_key(endpoint: str, language: str, code: str, **inputs) -> str:
+    provider = get_ai_provider()
+    parts = {
+        "version": AI_PROMPT_VERSION,
+        "endpoint": endpoint,
+        "provider": provider,
+        "model": get_ai_model(provider),
+        "language": language.lower(),
+        "code": normalize_code(language.lower(), code),
+        **inputs,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AIResponseCache:
+    """Two-tier (memory LRU + shared disk) cache of parsed AI responses."""
+
+    def __init__(self, directory: str, ttl: int, memory_items: int, max_bytes: int):
+        self.directory = directory
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()  # key -> (expires_at, value)
+        self.lock = Lock()
+        self.stats = {"memoryHits": 0, "diskHits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key: str, expires_at: float, value: dict) -> None:
+        with self.lock:
+            self.memory[key] = (expires_at, value)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_items:
+                self.memory.popitem(last=False)
+
+    def get(self, key: str, count: bool = True) -> dict | None:
+        """Cached value for `key`; `count=False` leaves the hit/miss stats alone (polling)."""
+        value = self._memory_get(key, count)
+        return value if value is not None else self._disk_get(key, count)
+
+    async def aget(self, key: str, count: bool = True) -> dict | None:
+        """get() for the event loop: a memory miss reads the disk tier on a worker thread."""
+        value = self._memory_get(key, count)
+        return value if value is not None else await asyncio.to_thread(self._disk_get, key, count)
+
+    def _memory_get(self, key: str, count: bool) -> dict | None:
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[0] > time.time():
+                self.memory.move_to_end(key)
+                if count:
+                    self.stats["memoryHits"] += 1
+                return entry[1]
+            self.memory.pop(key, None)
+        return None
+
+    def _disk_get(self, key: str, count: bool) -> dict | None:
+        now = time.time()
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+            if record["created"] + self.ttl <= now:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            os.utime(path, None)  # mtime tracks last use for LRU trimming
+        except (OSError, ValueError, KeyError):
+            if count:
+                with self.lock:
+                    self.stats["misses"] += 1
+            return None
+        self._remember(key, record["created"] + self.ttl, record["value"])
+        if count:
+            with self.lock:
+                self.stats["diskHits"] += 1
+        return record["value"]
+
+    def put(self, key: str, value: dict) -> None:
+        now = time.time()
+        self._remember(key, now + self.ttl, value)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"created": now, "value": value}, f, separators=(",", ":"))
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            print(f"[DEBUG] AI cache write failed: {e}")
+            return
+        with self.lock:
+            self.stats["stores"] += 1
+            trim = self.stats["stores"] % AI_CACHE_EVICT_EVERY == 0
+        if trim:
+            self.evict()
+
+    async def aput(self, key: str, value: dict) -> None:
+        """put() for the event loop; the file write and any eviction run on a worker thread."""
+        await asyncio.to_thread(self.put, key, value)
+
+    def evict(self) -> None:
+        """Drop expired entries, then least recently used ones beyond max_bytes."""
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.startswith("."):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for mtime, size, path in sorted(entries):
+                # mtime is last use, so anything idle past the TTL is expired too
+                if total <= self.max_bytes and now - mtime <= self.ttl:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+        with self.lock:
+            self.stats["evictions"] += removed
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memoryItems"] = len(self.memory)
+        lookups = stats["memoryHits"] + stats["diskHits"] + stats["misses"]
+        stats["hitRate"] = round((stats["memoryHits"] + stats["diskHits"]) / lookups, 3) if lookups else None
+        return stats
+
+
+ai_cache = AIResponseCache(AI_CACHE_DIR, AI_CACHE_TTL, AI_CACHE_MEMORY_ITEMS, AI_CACHE_MAX_BYTES)
+
+
+# -------- AI similarity cache --------
+# Catches near-duplicates the exact cache misses (a renamed variable, a changed
+# constant). Code is tokenized with identifiers numbered by first use and
+# literals collapsed, cut into AI_SHINGLE_SIZE-token shingles and MinHashed;
+# LSH bands find candidates, which are then checked against the estimated
+# Jaccard similarity. Only answers whose other inputs (endpoint, provider,
+# model, goal, exact error text...) match are eligible, and a reused answer is
+# marked as such. The index is per worker; the answers themselves come from
+# the shared ai_cache.
+
+AI_SIMILARITY_THRESHOLD = float(os.getenv("AI_SIMILARITY_THRESHOLD", "0.9"))
+AI_SIMILARITY_MIN_TOKENS = int(os.getenv("AI_SIMILARITY_MIN_TOKENS", "30"))
+AI_SIMILARITY_MAX_ITEMS = int(os.getenv("AI_SIMILARITY_MAX_ITEMS", "5000"))
+AI_SHINGLE_SIZE = 5
+MINHASH_BANDS, MINHASH_ROWS = 16, 4  # 64 hashes; candidates above ~0.6 similarity are almost always found
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240601)
+_MINHASH_PARAMS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(_MINHASH_PRIME))
+    for _ in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+_FINGERPRINT_TOKEN = re.compile(
+    r"""(?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)"""
+    r"""|(?P<number>\d[\w.]*)|(?P<name>[A-Za-z_$][\w$]*)|(?P<op>\S)"""
+)
+# Names kept verbatim in fingerprints; everything else is numbered by first use
+_KEEP_NAMES = {
+    "python": set(keyword.kwlist) | {"print", "input", "range", "len", "int", "str", "list", "dict", "set",
+                                     "sorted", "sum", "min", "max", "map", "split", "append", "self"},
+    "javascript": {"function", "return", "if", "else", "for", "while", "const", "let", "var", "new", "class",
+                   "console", "log", "length", "push", "map", "filter", "reduce", "of", "in", "this"},
+    "cpp": {"int", "long", "double", "char", "bool", "void", "auto", "return", "if", "else", "for", "while",
+            "include", "using", "namespace", "std", "cin", "cout", "endl", "vector", "string", "const",
+            "class", "struct", "push_back", "size", "main"},
+    "java": {"public", "private", "static", "void", "class", "int", "long", "double", "boolean", "char",
+             "String", "return", "if", "else", "for", "while", "new", "System", "out", "println", "main",
+             "Scanner", "import", "length", "this"},
+}
+
+
+def code_fingerprint_tokens(language: str, code: str) -> list[str]:
+    """Comment-free tokens with local names numbered by first use and literals collapsed."""
+    keep = _KEEP_NAMES.get(language, set())
+    names: dict[str, str] = {}
+    tokens = []
+    for m in _FINGERPRINT_TOKEN.finditer(normalize_code(language, code)):
+        kind, text = m.lastgroup, m.group()
+        if kind == "string":
+            tokens.append("S")
+        elif kind == "number":
+            tokens.append("N")
+        elif kind == "name" and text not in keep:
+            tokens.append(names.setdefault(text, f"v{len(names)}"))
+        else:
+            tokens.append(text)
+    return tokens
+
+
+def minhash_signature(tokens: list[str]) -> list[int]:
+    shingles = {
+        int.from_bytes(hashlib.blake2b(" ".join(tokens[i:i + AI_SHINGLE_SIZE]).encode(), digest_size=8).digest(), "big")
+        for i in range(max(1, len(tokens) - AI_SHINGLE_SIZE + 1))
+    }
+    return [min((a * h + b) % _MINHASH_PRIME for h in shingles) for a, b in _MINHASH_PARAMS]
+
+
+class SimilarityIndex:
+    """MinHash/LSH index from code fingerprints to ai_cache keys, bounded FIFO."""
+
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.entries: OrderedDict[str, tuple[str, list[int]]] = OrderedDict()  # cache key -> (scope, signature)
+        self.bands: dict[tuple, set[str]] = {}
+        self.lock = Lock()
+        self.stats = {"similarHits": 0, "similarMisses": 0}
+
+    @staticmethod
+    def _band_keys(scope: str, signature: list[int]):
+        for band in range(MINHASH_BANDS):
+            yield (scope, band, tuple(signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+
+    def add(self, scope: str, signature: list[int], cache_key: str) -> None:
+        with self.lock:
+            if cache_key in self.entries:
+                return
+            self.entries[cache_key] = (scope, signature)
+            for band_key in self._band_keys(scope, signature):
+                self.bands.setdefault(band_key, set()).add(cache_key)
+            while len(self.entries) > self.max_items:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, cache_key: str) -> None:
+        scope, signature = self.entries.pop(cache_key)
+        for band_key in self._band_keys(scope, signature):
+            bucket = self.bands.get(band_key)
+            if bucket is not None:
+                bucket.discard(cache_key)
+                if not bucket:
+                    del self.bands[band_key]
+
+    def discard(self, cache_key: str) -> None:
+        with self.lock:
+            if cache_key in self.entries:
+                self._remove(cache_key)
+
+    def nearest(self, scope: str, signature: list[int]) -> tuple[str | None, float]:
+        """Most similar indexed key in `scope` at or above the threshold, with its similarity."""
+        best_key, best = None, 0.0
+        with self.lock:
+            candidates = set()
+            for band_key in self._band_keys(scope, signature):
+                candidates |= self.bands.get(band_key, set())
+            for key in candidates:
+                other = self.entries[key][1]
+                similarity = sum(x == y for x, y in zip(signature, other)) / len(signature)
+                if similarity > best:
+                    best_key, best = key, similarity
+        if best < AI_SIMILARITY_THRESHOLD:
+            return None, best
+        return best_key, best
+
+
+similarity_index = SimilarityIndex(AI_SIMILARITY_MAX_ITEMS)
+
+
+def similarity_lookup(language: str, code: str, scope: str) -> tuple[dict | None, float, list[int] | None]:
+    """
+    Find a cached answer for near-identical code; returns (value, similarity, signature).
+
+    The signature is returned for indexing the fresh answer on a miss; it is
+    None for code too short for similarity to be meaningful.
+    """
+    tokens = code_fingerprint_tokens(language.lower(), code)
+    if len(tokens) < AI_SIMILARITY_MIN_TOKENS:
+        return None, 0.0, None
+    signature = minhash_signature(tokens)
+    key, similarity = similarity_index.nearest(scope, signature)
+    value = ai_cache.get(key) if key else None
+    if key and value is None:
+        similarity_index.discard(key)  # expired or evicted from the cache
+    with similarity_index.lock:
+        similarity_index.stats["similarHits" if value is not None else "similarMisses"] += 1
+    return value, similarity, signature
+
+
+def similarity_scope(endpoint: str, language: str, **inputs) -> str:
+    """Everything but the code that must match for an answer to be reused."""
+    provider = get_ai_provider()
+    parts = {"version": AI_PROMPT_VERSION, "endpoint": endpoint, "provider": provider,
+             "model": get_ai_model(provider), "language": language.lower(), **inputs}
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+@app.get("/ai/cache/stats")
+def ai_cache_stats():
+    """Hit/miss counters of this worker's exact and similarity AI caches and request coalescing."""
+    with similarity_index.lock:
+        similar = dict(similarity_index.stats)
+        similar["similarItems"] = len(similarity_index.entries)
+    return {**ai_cache.snapshot(), **similar, **ai_flights.snapshot(), **instant_explain_stats}
+
+
+# -------- AI: request coalescing --------
+# Concurrent requests with the same AI cache key share one provider call. In
+# a worker, the first request starts the call as its own task and later ones
+# wait on it; a waiter that disconnects only stops waiting, and the call is
+# cancelled when nobody is left. Across gunicorn workers, the caller holds a
+# flock on AI_CACHE_DIR/.flight-<key> while it calls the provider; other
+# workers see the lock, poll the shared disk cache for the answer and take
+# over if the lock is released without one (e.g. the answer didn't parse).
+
+AI_FLIGHT_POLL_INTERVAL = float(os.getenv("AI_FLIGHT_POLL_INTERVAL", "0.1"))
+
+
+class Flight:
+    """One in-progress provider call and the requests waiting on it."""
+
+    def __init__(self):
+        self.task: asyncio.Task | None = None
+        self.waiters = 0
+        self.events: list[str] = []  # SSE events published by a streaming call, for late joiners
+        self.wakeup = asyncio.Event()
+
+    def publish(self, event: str) -> None:
+        self.events.append(event)
+        self.notify()
+
+    def notify(self) -> None:
+        wakeup, self.wakeup = self.wakeup, asyncio.Event()
+        wakeup.set()
+
+
+class AISingleflight:
+    """Per-worker registry of in-flight AI calls, coordinated across workers by flock."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.flights: dict[str, Flight] = {}
+        self.stats = {"upstreamCalls": 0, "coalescedLocal": 0, "coalescedRemote": 0}
+
+    def _try_lease(self, key: str):
+        """Open and lock the key's flight file; None while another worker holds it."""
+        path = os.path.join(self.directory, f".flight-{key}")
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            f = open(path, "a")
+            if fcntl is None:
+                return f
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return None
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()  # the previous holder removed the file between our open and lock
+
+    @staticmethod
+    def _release_lease(f) -> None:
+        try:
+            os.remove(f.name)
+        except OSError:
+            pass
+        f.close()
+
+    async def _lead(self, key: str, fn, model: type[BaseModel], flight: Flight):
+        deadline = time.monotonic() + LLM_TIMEOUTS.get(get_ai_provider(), max(LLM_TIMEOUTS.values())) + LLM_CONNECT_TIMEOUT
+        remote = False
+        try:
+            while True:
+                try:
+                    lease = self._try_lease(key)
+                except OSError as e:
+                    print(f"[DEBUG] AI flight lock unavailable ({e}), calling without it")
+                    lease, deadline = None, 0
+                if lease is None and time.monotonic() < deadline:
+                    remote = True
+                    await asyncio.sleep(AI_FLIGHT_POLL_INTERVAL)
+                    cached = await ai_cache.aget(key, count=False)
+                    if cached is not None:
+                        self.stats["coalescedRemote"] += 1
+                        return model(**cached)
+                    continue
+                # Holding the lease, or another worker is stuck past the provider timeout
+                try:
+                    if remote:
+                        cached = await ai_cache.aget(key, count=False)
+                        if cached is not None:
+                            self.stats["coalescedRemote"] += 1
+                            return model(**cached)
+                    self.stats["upstreamCalls"] += 1
+                    return await fn(flight.publish)
+                finally:
+                    if lease is not None:
+                        self._release_lease(lease)
+        finally:
+            self.flights.pop(key, None)
+
+    def start(self, key: str, fn, model: type[BaseModel]) -> Flight:
+        """Join the flight for `key`, or start one running `await fn(publish)`."""
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.stats["coalescedLocal"] += 1
+            return flight
+        flight = Flight()
+        flight.task = asyncio.create_task(self._lead(key, fn, model, flight))
+        flight.task.add_done_callback(lambda _: flight.notify())
+        self.flights[key] = flight
+        return flight
+
+    def _leave(self, flight: Flight) -> None:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            flight.task.cancel()
+
+    async def wait(self, flight: Flight):
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def follow(self, flight: Flight):
+        """Yield the flight's SSE events (past and new), then its result."""
+        flight.waiters += 1
+        try:
+            seen = 0
+            while True:
+                wakeup = flight.wakeup
+                while seen < len(flight.events):
+                    yield flight.events[seen]
+                    seen += 1
+                if flight.task.done():
+                    break
+                await wakeup.wait()
+            yield flight.task.result()
+        finally:
+            self._leave(flight)
+
+    async def run(self, key: str, fn, model: type[BaseModel]):
+        return await self.wait(self.start(key, fn, model))
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "inFlight": len(self.flights)}
+
+
+ai_flights = AISingleflight(AI_CACHE_DIR)
+
+
+# -------- AI: prompt context --------
+# Prompts are kept under a per-endpoint token budget. When the code doesn't
+# fit, it is cut down to the lines around the focus (the cursor for suggest,
+# the line an error points at for explain) plus an outline of the rest:
+# imports and function/class signatures nearest the focus, with the skipped
+# stretches replaced by a "... N lines omitted" comment. Excerpts carry line
+# numbers so they still match the error text. Tokens are estimated locally
+# (word pieces of up to four characters, punctuation, whitespace runs), which
+# errs on the high side for the common tokenizers.
+
+AI_SUGGEST_PROMPT_TOKENS = int(os.getenv("AI_SUGGEST_PROMPT_TOKENS", "2500"))
+AI_EXPLAIN_PROMPT_TOKENS = int(os.getenv("AI_EXPLAIN_PROMPT_TOKENS", "2500"))
+AI_MIN_CODE_TOKENS = 200  # floor for the code share of a prompt
+EXCERPT_NOTE = (" (excerpt with line numbers; lines far from the focus are omitted"
+                " or reduced to their signatures)")
+
+_TOKEN_ESTIMATE = re.compile(r"\w{1,4}|[^\w\s]|\s+")
+_IMPORT_LINE = re.compile(r"\s*(?:import|from|#\s*include|using)\b")
+_ERROR_LINE = {
+    # (pattern, use the last match): Python tracebacks end at the innermost frame
+    "python": (re.compile(r'File "(?![^"]*(?:site-packages|/lib/python|<frozen))[^"]*", line (\d+)'), True),
+    "javascript": (re.compile(r"\.js:(\d+)"), False),
+    # Sources are named after their public class; skip JDK frames of runtime stack traces
+    "java": (re.compile(r"^(?!\s*at (?:java|jdk|sun)\.)[^\n]*?\b\w+\.java:(\d+)", re.M), False),
+    "cpp": (re.compile(r"main\.cpp:(\d+):"), False),
+}
+_OUTLINE_LINE = {
+    "python": re.compile(r"\s*(?:async\s+def|def|class|import|from)\b"),
+    "javascript": re.compile(
+        r"\s*(?:(?:export\s+)?(?:default\s+)?(?:async\s+)?function\b|class\b|import\b"
+        r"|(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:\([^)]*\)|\w+)\s*=>)"
+    ),
+    "java": re.compile(
+        r"\s*(?:import\b|(?:(?:public|private|protected|static|final|abstract)\s+)*"
+        r"(?:class|interface|enum|record)\s+\w+"
+        r"|(?:(?:public|private|protected|static|final|abstract|synchronized)\s+)+[\w<>\[\],.?\s]+\s+\w+\s*\()"
+    ),
+    "cpp": re.compile(
+        r"\s*(?:#\s*include|using\b|template\b|(?:class|struct)\s+\w+"
+        r"|(?!(?:if|else|for|while|switch|return|do|case)\b)[\w:<>,*&]+(?:\s+[\w:<>,*&~]+)+\s*\([^;]*$)"
+    ),
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(_TOKEN_ESTIMATE.findall(text))
+
+
+def cursor_line(code: str, cursor: int | None) -> int | None:
+    """1-based line of a character offset into `code`."""
+    if cursor is None or not 0 <= cursor <= len(code):
+        return None
+    return code.count("\n", 0, cursor) + 1
+
+
+def error_line(language: str, error: str | None) -> int | None:
+    """1-based line of the user's code that `error` points at, if it names one."""
+    if not error:
+        return None
+    pattern, last = _ERROR_LINE.get(language.lower(), _ERROR_LINE["cpp"])
+    matches = list(pattern.finditer(error))
+    if not matches:
+        return None
+    match = matches[-1] if last else matches[0]
+    return int(next(group for group in match.groups() if group))
+
+
+def trim_error(error: str | None, budget: int) -> str | None:
+    """Keep the first line and as many of the last lines as fit in `budget` tokens."""
+    if not error or estimate_tokens(error) <= budget:
+        return error
+    lines = error.strip().split("\n")
+    head, tail = lines[0], []
+    spent = estimate_tokens(head) + 8
+    for line in reversed(lines[1:]):
+        spent += estimate_tokens(line) + 1
+        if spent > budget:
+            break
+        tail.append(line)
+    return "\n".join([head, "..."] + tail[::-1])
+
+
+def code_excerpt(language: str, code: str, focus: int | None, budget: int) -> tuple[str, list[int] | None]:
+    """`code` itself if it fits in `budget` tokens, else a numbered excerpt around line `focus`.
+
+    Returns the text and the [first, last] lines of the focus window (None when not trimmed).
+    """
+    budget = max(budget, AI_MIN_CODE_TOKENS)
+    if estimate_tokens(code) <= budget:
+        return code, None
+    language = language.lower()
+    lines = code.split("\n")
+    width = len(str(len(lines)))
+    cost = [estimate_tokens(line) + 3 for line in lines]  # newline and the line-number prefix
+    center = min(max((focus or 1) - 1, 0), len(lines) - 1)
+
+    # Outline: up to a third of the budget; imports, then signatures nearest the focus
+    pattern = _OUTLINE_LINE.get(language, _OUTLINE_LINE["cpp"])
+    outline = [i for i, line in enumerate(lines) if pattern.match(line)]
+    shown: set[int] = set()
+    spent = 0
+    for i in sorted(outline, key=lambda i: (not _IMPORT_LINE.match(lines[i]), abs(i - center))):
+        if spent + cost[i] > budget // 3:
+            break
+        shown.add(i)
+        spent += cost[i]
+
+    # Window: grow around the focus, alternating down and up, keeping room for the gap markers
+    lo = hi = center
+    if center not in shown:
+        shown.add(center)
+        spent += cost[center]
+    marker = estimate_tokens(f"{'':>{width}}|         // ... 999 lines omitted") + 1
+    room = budget - marker * (len(shown) + 1)
+    grew = True
+    while grew:
+        grew = False
+        for i in (hi + 1, lo - 1):
+            if not 0 <= i < len(lines):
+                continue
+            extra = 0 if i in shown else cost[i]
+            if spent + extra > room:
+                continue
+            shown.add(i)
+            spent += extra
+            lo, hi = min(lo, i), max(hi, i)
+            grew = True
+
+    comment = "#" if language == "python" else "//"
+    out = []
+    i = 0
+    while i < len(lines):
+        if i in shown:
+            out.append(f"{i + 1:>{width}}| {lines[i]}")
+            i += 1
+            continue
+        j = i
+        while j < len(lines) and j not in shown:
+            j += 1
+        indent = lines[i][:len(lines[i]) - len(lines[i].lstrip())]
+        out.append(f"{'':>{width}}| {indent}{comment} ... {j - i} line{'s' if j - i > 1 else ''} omitted")
+        i = j
+    return "\n".join(out), [lo + 1, hi + 1]
+
+
+# -------- AI: Gemini Proxy --------
+class AISuggestRequest(BaseModel):
+    language: str
+    code: str
+    cursor: int | None = None  # character offset into code; centers the excerpt of long files
+    goal: str | None = None
+    hints: list[str] | None = None
+
+
+class AISuggestResponse(BaseModel):
+    suggestions: list[str]
+    explanation: str | None = None
+    qualityNotes: list[str] | None = None
+    variables: list[str] | None = None
+    problemUnderstanding: str | None = None
+    bestApproach: str | None = None
+    algorithmName: str | None = None
+    timeComplexity: str | None = None
+    spaceComplexity: str | None = None
+    whyThisApproach: str | None = None
+    reused: bool = False  # answer was given for near-identical code
+    similarity: float | None = None
+    chunks: dict[str, int] | None = None  # session answers: chunks analyzed / reused / failed / still pending
+
+
+class AIExplainRequest(BaseModel):
+    language: str
+    code: str
+    error: str | None = None
+
+
+class AIExplainResponse(BaseModel):
+    summary: str
+    lineFixes: list[str] | None = None
+    walkthrough: list[str] | None = None
+    beginnerExplanation: str | None = None
+    whyItHappened: str | None = None
+    howToFix: list[str] | None = None
+    proTip: str | None = None
+    reused: bool = False  # answer was given for near-identical code
+    similarity: float | None = None
+    instant: bool = False  # explained by the local error rules, not the model
+
+
+def mock_suggest_response() -> AISuggestResponse:
+    """Generic suggestions served when no AI provider can be used."""
+    return AISuggestResponse(
+        suggestions=["Consider extracting function for readability.", "Use descriptive variable names."],
+        explanation="This suggestion improves code structure and maintainability.",
+        qualityNotes=["Avoid magic numbers", "Prefer early returns"],
+        variables=["leftIndex -> left", "rightIndex -> right"]
+    )
+
+
+def suggest_parse_fallback() -> AISuggestResponse:
+    return AISuggestResponse(
+        suggestions=["Code suggestion temporarily unavailable. The AI response format was unexpected."],
+        explanation="The AI service returned a response in an unexpected format. Please try again.",
+        qualityNotes=[],
+        variables=[]
+    )
+
+
+def explain_parse_fallback() -> AIExplainResponse:
+    return AIExplainResponse(
+        summary="The error likely comes from a syntax or logic issue. Check the highlighted line.",
+        lineFixes=["Review the syntax", "Check for missing symbols"],
+        walkthrough=["Read the error message", "Identify the line number", "Fix the issue"],
+        beginnerExplanation="Something in your code needs to be fixed. Look at the error message for clues.",
+        whyItHappened="This is a common mistake when learning to code.",
+        howToFix=["Read the error message carefully", "Check the line mentioned in the error", "Fix the syntax or logic issue"],
+        proTip="Always read error messages carefully - they tell you exactly what's wrong!"
+    )
+
+
+def explain_unavailable_response() -> AIExplainResponse:
+    return AIExplainResponse(
+        summary="Error analysis temporarily unavailable.",
+        lineFixes=["Check syntax", "Review variable names"],
+        walkthrough=["Debug step by step"],
+        beginnerExplanation="An error occurred in your code. Try reviewing the syntax and logic.",
+        proTip="Practice makes perfect - keep coding!"
+    )
+
+
+def clean_llm_json(text: str) -> str:
+    """Strip a markdown code fence the model may have wrapped its JSON in."""
+    cleaned_text = text.strip()
+    if cleaned_text.startswith('```json'):
+        cleaned_text = cleaned_text[7:]
+        if cleaned_text.endswith('```'):
+            cleaned_text = cleaned_text[:-3]
+        cleaned_text = cleaned_text.strip()
+    elif cleaned_text.startswith('```'):
+        cleaned_text = cleaned_text[3:]
+        if cleaned_text.endswith('```'):
+            cleaned_text = cleaned_text[:-3]
+        cleaned_text = cleaned_text.strip()
+    return cleaned_text
+
+
+def build_suggest_prompt(req: AISuggestRequest, code: str, focus: int | None = None, excerpt: bool = False,
+                         context: str | None = None) -> str:
+    # Determine if code is empty or very short
+    code_is_empty = len(req.code.strip()) == 0 or len(req.code.strip()) < 10
+
+    if code_is_empty:
+        # Special handling for empty/short code
+        prompt = (
+            f"Language: {req.language}\n"
+            f"Goal: {req.goal or 'general'}\n"
+            f"The user is starting to write code in {req.language}. "
+            f"Provide helpful starter suggestions and best practices for {req.language} development. "
+            f"Return ONLY valid JSON (no markdown formatting) with these exact keys:\n"
+            "- suggestions: array of strings with practical starter suggestions\n"
+            "- explanation: string explaining the suggestions\n"
+            "- qualityNotes: array of strings with best practices\n"
+            "- variables: array of strings with common variable naming tips\n"
+            "- problemUnderstanding: string explaining what beginners typically start with\n"
+            "- bestApproach: string with beginner-friendly coding tips\n"
+            "- algorithmName: string (e.g., 'basic syntax' or 'hello world')\n\n"
+            "Return only the JSON object, no other text:"
+        )
+    else:
+        # Normal code analysis with enhanced fields
+        prompt = (
+            f"Language: {req.language}\n"
+            f"Goal: {req.goal or 'general'}\n"
+            f"Hints: {', '.join(req.hints or [])}\n"
+            + (f"Cursor: line {focus}\n" if focus else "")
+            + (f"{context}\n" if context else "")
+            + "\n"
+            "Analyze the following code for a BEGINNER programmer. Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
+            "- problemUnderstanding: string (2-3 sentences explaining what problem the user is trying to solve in simple terms)\n"
+            "- algorithmName: string (name of the algorithm/technique used, e.g., 'linear search', 'two pointer', 'recursion', 'sorting')\n"
+            "- bestApproach: string (explain why this approach works for this problem)\n"
+            "- timeComplexity: string (e.g., 'O(n) - You check each element once')\n"
+            "- spaceComplexity: string (e.g., 'O(1) - Only uses a few variables')\n"
+            "- whyThisApproach: string (explain why this is a good approach for beginners)\n"
+            "- suggestions: array of strings with 3-5 specific code improvements\n"
+            "- explanation: string explaining the main suggestion\n"
+            "- qualityNotes: array of strings with code quality tips\n"
+            "- variables: array of strings with variable rename suggestions (format: 'oldName -> newName')\n\n"
+            f"Code{EXCERPT_NOTE if excerpt else ''}:\n{code}\n\n"
+            "Return only the JSON object, no other text:"
+        )
+
+    return prompt
+
+
+def suggest_from_parsed(parsed: dict) -> AISuggestResponse:
+    """Normalize the fields of a parsed model answer into an AISuggestResponse."""
+    # Handle different response formats
+    suggestions = []
+    explanation = ""
+    quality_notes = []
+    variables = []
+
+    if isinstance(parsed.get("suggestions"), list):
+        for suggestion in parsed.get("suggestions", []):
+            if isinstance(suggestion, dict):
+                if "code" in suggestion:
+                    suggestions.append(suggestion["code"])
+                elif "text" in suggestion:
+                    suggestions.append(suggestion["text"])
+                else:
+                    suggestions.append(str(suggestion))
+            else:
+                suggestions.append(str(suggestion))
+    else:
+        suggestions = [str(s) for s in parsed.get("suggestions", [])]
+
+    explanation = str(parsed.get("explanation", ""))
+    quality_notes = [str(note) for note in parsed.get("qualityNotes", [])]
+    variables = [str(var) for var in parsed.get("variables", [])]
+
+    # Extract new fields
+    problem_understanding = str(parsed.get("problemUnderstanding", "")) if parsed.get("problemUnderstanding") else None
+    best_approach = str(parsed.get("bestApproach", "")) if parsed.get("bestApproach") else None
+    algorithm_name = str(parsed.get("algorithmName", "")) if parsed.get("algorithmName") else None
+    time_complexity = str(parsed.get("timeComplexity", "")) if parsed.get("timeComplexity") else None
+    space_complexity = str(parsed.get("spaceComplexity", "")) if parsed.get("spaceComplexity") else None
+    why_this_approach = str(parsed.get("whyThisApproach", "")) if parsed.get("whyThisApproach") else None
+
+    return AISuggestResponse(
+        suggestions=suggestions,
+        explanation=explanation,
+        qualityNotes=quality_notes,
+        variables=variables,
+        problemUnderstanding=problem_understanding,
+        bestApproach=best_approach,
+        algorithmName=algorithm_name,
+        timeComplexity=time_complexity,
+        spaceComplexity=space_complexity,
+        whyThisApproach=why_this_approach
+    )
+
+
+def build_explain_prompt(req: AIExplainRequest, code: str, error: str | None, excerpt: bool = False) -> str:
+    # Enhanced prompt for beginner-friendly error explanations
+    if error:
+        prompt = (
+            f"Language: {req.language}\n"
+            f"Error Message: {error}\n\n"
+            f"Code{EXCERPT_NOTE if excerpt else ''}:\n{code}\n\n"
+            "Explain this error to a COMPLETE BEGINNER who is just learning to code. "
+            "Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
+            "- beginnerExplanation: string (explain what went wrong in simple, non-technical language)\n"
+            "- whyItHappened: string (explain why beginners commonly make this mistake)\n"
+            "- howToFix: array of strings (step-by-step instructions to fix, numbered)\n"
+            "- proTip: string (one sentence advice to avoid this error in the future)\n"
+            "- summary: string (one-line summary of the error)\n"
+            "- lineFixes: array of strings (specific line-by-line fixes)\n\n"
+            "Return only the JSON object, no other text:"
+        )
+    else:
+        # Code walkthrough without error
+        prompt = (
+            f"Language: {req.language}\n\n"
+            f"Code{EXCERPT_NOTE if excerpt else ''}:\n{code}\n\n"
+            "Provide a beginner-friendly walkthrough of this code. "
+            "Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
+            "- summary: string (what this code does in simple terms)\n"
+            "- walkthrough: array of strings (step-by-step explanation of what each part does)\n"
+            "- beginnerExplanation: string (explain the overall logic for beginners)\n\n"
+            "Return only the JSON object, no other text:"
+        )
+
+    return prompt
+
+
+def explain_from_parsed(parsed: dict) -> AIExplainResponse:
+    """Normalize the fields of a parsed model answer into an AIExplainResponse."""
+    return AIExplainResponse(
+        summary=str(parsed.get("summary", "Code analysis completed")),
+        lineFixes=[str(fix) for fix in parsed.get("lineFixes", [])] if parsed.get("lineFixes") else None,
+        walkthrough=[str(step) for step in parsed.get("walkthrough", [])] if parsed.get("walkthrough") else None,
+        beginnerExplanation=str(parsed.get("beginnerExplanation", "")) if parsed.get("beginnerExplanation") else None,
+        whyItHappened=str(parsed.get("whyItHappened", "")) if parsed.get("whyItHappened") else None,
+        howToFix=[str(step) for step in parsed.get("howToFix", [])] if parsed.get("howToFix") else None,
+        proTip=str(parsed.get("proTip", "")) if parsed.get("proTip") else None
+    )
+
+
+def prepare_suggest(req: AISuggestRequest) -> tuple[str, str, str]:
+    """Prompt, AI cache key and similarity scope of a suggest request."""
+    focus = cursor_line(req.code, req.cursor)
+    overhead = estimate_tokens(build_suggest_prompt(req, "", focus, excerpt=True))
+    code, window = code_excerpt(req.language, req.code, focus, AI_SUGGEST_PROMPT_TOKENS - overhead)
+    prompt = build_suggest_prompt(req, code, focus, excerpt=window is not None)
+    # The cursor only matters through the excerpt it selects
+    inputs = {"goal": req.goal, "hints": req.hints or [], "excerpt": window}
+    return (prompt, ai_cache_key("suggest", req.language, req.code, **inputs),
+            similarity_scope("suggest", req.language, **inputs))
+
+
+def prepare_explain(req: AIExplainRequest) -> tuple[str, str, str]:
+    """Prompt, AI cache key and similarity scope of an explain request."""
+    error = trim_error(req.error, AI_EXPLAIN_PROMPT_TOKENS // 4)
+    overhead = estimate_tokens(build_explain_prompt(req, "", error, excerpt=True))
+    focus = error_line(req.language, req.error)
+    code, window = code_excerpt(req.language, req.code, focus, AI_EXPLAIN_PROMPT_TOKENS - overhead)
+    prompt = build_explain_prompt(req, code, error, excerpt=window is not None)
+    inputs = {"error": normalize_error(req.error), "excerpt": window}
+    return (prompt, ai_cache_key("explain", req.language, req.code, **inputs),
+            similarity_scope("explain", req.language, **inputs))
+
+
+@app.post("/ai/suggest", response_model=AISuggestResponse)
+async def ai_suggest(req: AISuggestRequest):
+    provider = get_ai_provider()
     
     print(f"[DEBUG] AI Provider: {provider}")
     print(f"[DEBUG] Request language: {req.language}")
@@ -510,167 +4608,51 @@ def ai_suggest(req: AISuggestRequest):
     print(f"[DEBUG] Code is empty/short: {len(req.code.strip()) == 0 or len(req.code.strip()) < 10}")
     
     try:
+        prompt, cache_key, scope = prepare_suggest(req)
+        cached = await ai_cache.aget(cache_key)
+        if cached is not None:
+            return AISuggestResponse(**cached)
+        similar, similarity, signature = await asyncio.to_thread(similarity_lookup, req.language, req.code, scope)
+        if similar is not None:
+            print(f"[DEBUG] AI similarity hit for suggest ({similarity:.2f})")
+            return AISuggestResponse(**{**similar, "reused": True, "similarity": round(similarity, 3)})
+
         # Check if we have a valid configuration
-        if provider == "ollama":
-            # Ollama doesn't need API keys, just check if service is available
-            ollama_url = os.getenv("OLLAMA_URL", "http://localhost:11434")
-            try:
-                # Quick health check
-                health_response = requests.get(f"{ollama_url}/api/tags", timeout=5)
-                if health_response.status_code != 200:
-                    raise Exception("Ollama service not available")
-            except Exception as e:
-                print(f"[DEBUG] Ollama service not available: {e}, returning mock response")
-                return AISuggestResponse(
-                    suggestions=["Consider extracting function for readability.", "Use descriptive variable names."],
-                    explanation="This suggestion improves code structure and maintainability.",
-                    qualityNotes=["Avoid magic numbers", "Prefer early returns"],
-                    variables=["leftIndex -> left", "rightIndex -> right"]
-                )
-        else:
-            # Check if we have a valid API key for external providers
-            api_key = None
-            if provider == "openai":
-                api_key = os.getenv("OPENAI_API_KEY")
-            elif provider == "anthropic":
-                api_key = os.getenv("ANTHROPIC_API_KEY")
-            
-            if not api_key:
-                print(f"[DEBUG] No {provider.upper()} API key found, returning mock response")
-                return AISuggestResponse(
-                    suggestions=["Consider extracting function for readability.", "Use descriptive variable names."],
-                    explanation="This suggestion improves code structure and maintainability.",
-                    qualityNotes=["Avoid magic numbers", "Prefer early returns"],
-                    variables=["leftIndex -> left", "rightIndex -> right"]
-                )
+        if not ai_router.candidates():
+            print(f"[DEBUG] No configured AI provider ({provider}), returning mock response")
+            return mock_suggest_response()
 
         print(f"[DEBUG] Making {provider.upper()} API request with timeout 15s...")
         
-        # Determine if code is empty or very short
-        code_is_empty = len(req.code.strip()) == 0 or len(req.code.strip()) < 10
-        
-        if code_is_empty:
-            # Special handling for empty/short code
-            prompt = (
-                f"Language: {req.language}\n"
-                f"Goal: {req.goal or 'general'}\n"
-                f"The user is starting to write code in {req.language}. "
-                f"Provide helpful starter suggestions and best practices for {req.language} development. "
-                f"Return ONLY valid JSON (no markdown formatting) with these exact keys:\n"
-                "- suggestions: array of strings with practical starter suggestions\n"
-                "- explanation: string explaining the suggestions\n"
-                "- qualityNotes: array of strings with best practices\n"
-                "- variables: array of strings with common variable naming tips\n"
-                "- problemUnderstanding: string explaining what beginners typically start with\n"
-                "- bestApproach: string with beginner-friendly coding tips\n"
-                "- algorithmName: string (e.g., 'basic syntax' or 'hello world')\n\n"
-                "Return only the JSON object, no other text:"
-            )
-        else:
-            # Normal code analysis with enhanced fields
-            prompt = (
-                f"Language: {req.language}\n"
-                f"Goal: {req.goal or 'general'}\n"
-                f"Hints: {', '.join(req.hints or [])}\n"
-                f"Cursor: {req.cursor}\n\n"
-                "Analyze the following code for a BEGINNER programmer. Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
-                "- problemUnderstanding: string (2-3 sentences explaining what problem the user is trying to solve in simple terms)\n"
-                "- algorithmName: string (name of the algorithm/technique used, e.g., 'linear search', 'two pointer', 'recursion', 'sorting')\n"
-                "- bestApproach: string (explain why this approach works for this problem)\n"
-                "- timeComplexity: string (e.g., 'O(n) - You check each element once')\n"
-                "- spaceComplexity: string (e.g., 'O(1) - Only uses a few variables')\n"
-                "- whyThisApproach: string (explain why this is a good approach for beginners)\n"
-                "- suggestions: array of strings with 3-5 specific code improvements\n"
-                "- explanation: string explaining the main suggestion\n"
-                "- qualityNotes: array of strings with code quality tips\n"
-                "- variables: array of strings with variable rename suggestions (format: 'oldName -> newName')\n\n"
-                f"Code:\n{req.code}\n\n"
-                "Return only the JSON object, no other text:"
-            )
-        
-        text = get_llm_response(prompt)
-        print(f"[DEBUG] {provider.upper()} API response received successfully")
-        print(f"[DEBUG] Response text length: {len(text)} characters")
-        
-        # Parse JSON response
-        try:
-            # Clean the response text - remove markdown code blocks if present
-            cleaned_text = text.strip()
-            if cleaned_text.startswith('```json'):
-                cleaned_text = cleaned_text[7:]
-                if cleaned_text.endswith('```'):
-                    cleaned_text = cleaned_text[:-3]
-                cleaned_text = cleaned_text.strip()
-            elif cleaned_text.startswith('```'):
-                cleaned_text = cleaned_text[3:]
-                if cleaned_text.endswith('```'):
-                    cleaned_text = cleaned_text[:-3]
-                cleaned_text = cleaned_text.strip()
-            
-            print(f"[DEBUG] Cleaned response: {cleaned_text[:100]}...")
-            
-            parsed = json.loads(cleaned_text)
-            print(f"[DEBUG] Successfully parsed JSON response")
-            
-            # Handle different response formats
-            suggestions = []
-            explanation = ""
-            quality_notes = []
-            variables = []
-            
-            if isinstance(parsed.get("suggestions"), list):
-                for suggestion in parsed.get("suggestions", []):
-                    if isinstance(suggestion, dict):
-                        if "code" in suggestion:
-                            suggestions.append(suggestion["code"])
-                        elif "text" in suggestion:
-                            suggestions.append(suggestion["text"])
-                        else:
-                            suggestions.append(str(suggestion))
-                    else:
-                        suggestions.append(str(suggestion))
-            else:
-                suggestions = [str(s) for s in parsed.get("suggestions", [])]
-            
-            explanation = str(parsed.get("explanation", ""))
-            quality_notes = [str(note) for note in parsed.get("qualityNotes", [])]
-            variables = [str(var) for var in parsed.get("variables", [])]
-            
-            # Extract new fields
-            problem_understanding = str(parsed.get("problemUnderstanding", "")) if parsed.get("problemUnderstanding") else None
-            best_approach = str(parsed.get("bestApproach", "")) if parsed.get("bestApproach") else None
-            algorithm_name = str(parsed.get("algorithmName", "")) if parsed.get("algorithmName") else None
-            time_complexity = str(parsed.get("timeComplexity", "")) if parsed.get("timeComplexity") else None
-            space_complexity = str(parsed.get("spaceComplexity", "")) if parsed.get("spaceComplexity") else None
-            why_this_approach = str(parsed.get("whyThisApproach", "")) if parsed.get("whyThisApproach") else None
-            
-            return AISuggestResponse(
-                suggestions=suggestions,
-                explanation=explanation,
-                qualityNotes=quality_notes,
-                variables=variables,
-                problemUnderstanding=problem_understanding,
-                bestApproach=best_approach,
-                algorithmName=algorithm_name,
-                timeComplexity=time_complexity,
-                spaceComplexity=space_complexity,
-                whyThisApproach=why_this_approach
-            )
-            
-        except Exception as parse_error:
-            print(f"[DEBUG] JSON parsing failed: {parse_error}")
-            print(f"[DEBUG] Raw response: {text[:200]}...")
-            return AISuggestResponse(
-                suggestions=["Code suggestion temporarily unavailable. The AI response format was unexpected."],
-                explanation="The AI service returned a response in an unexpected format. Please try again.",
-                qualityNotes=[],
-                variables=[]
-            )
+        async def answer(publish):
+            text = await get_llm_response(prompt)
+            print(f"[DEBUG] {provider.upper()} API response received successfully")
+            print(f"[DEBUG] Response text length: {len(text)} characters")
+
+            # Parse JSON response
+            try:
+                parsed = json.loads(clean_llm_json(text))
+                print(f"[DEBUG] Successfully parsed JSON response")
+                result = suggest_from_parsed(parsed)
+            except Exception as parse_error:
+                print(f"[DEBUG] JSON parsing failed: {parse_error}")
+                print(f"[DEBUG] Raw response: {text[:200]}...")
+                return suggest_parse_fallback()
+            await ai_cache.aput(cache_key, result.model_dump())
+            if signature is not None:
+                similarity_index.add(scope, signature, cache_key)
+            return result
+
+        try:
+            return await ai_flights.run(cache_key, answer, AISuggestResponse)
+        except ProviderUnavailable as e:
+            print(f"[DEBUG] {e}, returning mock response")
+            return mock_suggest_response()
             
-    except requests.exceptions.Timeout as timeout_error:
+    except httpx.TimeoutException as timeout_error:
         print(f"[DEBUG] Request timeout: {timeout_error}")
         raise HTTPException(status_code=504, detail=create_fallback_response("AI service timeout - please try again"))
-    except requests.exceptions.RequestException as req_error:
+    except httpx.HTTPError as req_error:
         print(f"[DEBUG] Request error: {req_error}")
         raise HTTPException(status_code=503, detail=create_fallback_response("Unable to connect to AI service"))
     except ValueError as value_error:
@@ -682,91 +4664,1295 @@ def ai_suggest(req: AISuggestRequest):
 
 
 @app.post("/ai/explain", response_model=AIExplainResponse)
-def ai_explain(req: AIExplainRequest):
+async def ai_explain(req: AIExplainRequest):
     provider = get_ai_provider()
     
     try:
-        # Enhanced prompt for beginner-friendly error explanations
-        if req.error:
-            prompt = (
-                f"Language: {req.language}\n"
-                f"Error Message: {req.error}\n\n"
-                f"Code:\n{req.code}\n\n"
-                "Explain this error to a COMPLETE BEGINNER who is just learning to code. "
-                "Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
-                "- beginnerExplanation: string (explain what went wrong in simple, non-technical language)\n"
-                "- whyItHappened: string (explain why beginners commonly make this mistake)\n"
-                "- howToFix: array of strings (step-by-step instructions to fix, numbered)\n"
-                "- proTip: string (one sentence advice to avoid this error in the future)\n"
-                "- summary: string (one-line summary of the error)\n"
-                "- lineFixes: array of strings (specific line-by-line fixes)\n\n"
-                "Return only the JSON object, no other text:"
-            )
-        else:
-            # Code walkthrough without error
-            prompt = (
-                f"Language: {req.language}\n\n"
-                f"Code:\n{req.code}\n\n"
-                "Provide a beginner-friendly walkthrough of this code. "
-                "Return ONLY valid JSON (no markdown formatting) with these exact keys:\n\n"
-                "- summary: string (what this code does in simple terms)\n"
-                "- walkthrough: array of strings (step-by-step explanation of what each part does)\n"
-                "- beginnerExplanation: string (explain the overall logic for beginners)\n\n"
-                "Return only the JSON object, no other text:"
-            )
-        
-        text = get_llm_response(prompt)
-        
-        # Parse JSON response
-        try:
-            # Clean the response text
-            cleaned_text = text.strip()
-            if cleaned_text.startswith('```json'):
-                cleaned_text = cleaned_text[7:]
-                if cleaned_text.endswith('```'):
-                    cleaned_text = cleaned_text[:-3]
-                cleaned_text = cleaned_text.strip()
-            elif cleaned_text.startswith('```'):
-                cleaned_text = cleaned_text[3:]
-                if cleaned_text.endswith('```'):
-                    cleaned_text = cleaned_text[:-3]
-                cleaned_text = cleaned_text.strip()
-            
-            parsed = json.loads(cleaned_text)
-            
-            return AIExplainResponse(
-                summary=str(parsed.get("summary", "Code analysis completed")),
-                lineFixes=[str(fix) for fix in parsed.get("lineFixes", [])] if parsed.get("lineFixes") else None,
-                walkthrough=[str(step) for step in parsed.get("walkthrough", [])] if parsed.get("walkthrough") else None,
-                beginnerExplanation=str(parsed.get("beginnerExplanation", "")) if parsed.get("beginnerExplanation") else None,
-                whyItHappened=str(parsed.get("whyItHappened", "")) if parsed.get("whyItHappened") else None,
-                howToFix=[str(step) for step in parsed.get("howToFix", [])] if parsed.get("howToFix") else None,
-                proTip=str(parsed.get("proTip", "")) if parsed.get("proTip") else None
-            )
-            
-        except Exception as parse_error:
-            print(f"[DEBUG] Error explanation parsing failed: {parse_error}")
-            # Fallback response
-            return AIExplainResponse(
-                summary="The error likely comes from a syntax or logic issue. Check the highlighted line.",
-                lineFixes=["Review the syntax", "Check for missing symbols"],
-                walkthrough=["Read the error message", "Identify the line number", "Fix the issue"],
-                beginnerExplanation="Something in your code needs to be fixed. Look at the error message for clues.",
-                whyItHappened="This is a common mistake when learning to code.",
-                howToFix=["Read the error message carefully", "Check the line mentioned in the error", "Fix the syntax or logic issue"],
-                proTip="Always read error messages carefully - they tell you exactly what's wrong!"
-            )
+        instant = instant_explanation(req.language, req.code, req.error)
+        if instant is not None:
+            return instant
+        prompt, cache_key, scope = prepare_explain(req)
+        cached = await ai_cache.aget(cache_key)
+        if cached is not None:
+            return AIExplainResponse(**cached)
+        similar, similarity, signature = await asyncio.to_thread(similarity_lookup, req.language, req.code, scope)
+        if similar is not None:
+            print(f"[DEBUG] AI similarity hit for explain ({similarity:.2f})")
+            return AIExplainResponse(**{**similar, "reused": True, "similarity": round(similarity, 3)})
+
+        async def answer(publish):
+            text = await get_llm_response(prompt)
+
+            # Parse JSON response
+            try:
+                parsed = json.loads(clean_llm_json(text))
+                result = explain_from_parsed(parsed)
+            except Exception as parse_error:
+                print(f"[DEBUG] Error explanation parsing failed: {parse_error}")
+                return explain_parse_fallback()
+            await ai_cache.aput(cache_key, result.model_dump())
+            if signature is not None:
+                similarity_index.add(scope, signature, cache_key)
+            return result
+
+        return await ai_flights.run(cache_key, answer, AIExplainResponse)
             
     except Exception as e:
         print(f"[DEBUG] Error explanation failed: {e}")
-        # Fallback response
-        return AIExplainResponse(
-            summary="Error analysis temporarily unavailable.",
-            lineFixes=["Check syntax", "Review variable names"],
-            walkthrough=["Debug step by step"],
-            beginnerExplanation="An error occurred in your code. Try reviewing the syntax and logic.",
-            proTip="Practice makes perfect - keep coding!"
+        return explain_unavailable_response()
+
+
+# -------- AI: instant error explanations --------
+# Most /ai/explain calls are the same few dozen beginner errors. These are
+# matched against per-language pattern tables and answered locally, with the
+# line and symbol filled in from the error text; only errors no rule knows go
+# to the model. When several errors are reported, the one that appears first
+# (the root cause for compilers) wins. Templates may use {symbol}, {other},
+# {line} and any other named group of their pattern.
+
+AI_INSTANT_EXPLAIN = os.getenv("AI_INSTANT_EXPLAIN", "true").lower() == "true"
+_Q = "['‘’\"`]"  # g++ quotes with ‘’ in UTF-8 locales
+
+
+def _error_rule(pattern: str, summary: str, explanation: str, why: str, fixes: list[str], tip: str,
+                line_fix: str = "") -> dict:
+    return {"pattern": re.compile(pattern.replace("Q", _Q), re.M), "summary": summary,
+            "beginnerExplanation": explanation, "whyItHappened": why, "howToFix": fixes,
+            "proTip": tip, "lineFix": line_fix}
+
+
+_LIMIT_RULES = [
+    _error_rule(r"^CPU time limit exceeded|^Time limit exceeded",
+                "Your program ran out of time.",
+                "The program was stopped because it kept running longer than allowed. Usually a loop never ends, "
+                "or the algorithm does far more work than needed.",
+                "Loops whose condition never becomes false, or recursion without a base case, run forever.",
+                ["Check every loop: does its condition eventually become false?",
+                 "Make sure the loop variable actually changes inside the loop",
+                 "If the input is large, look for a faster approach (fewer nested loops)"],
+                "Print the loop variable for the first few iterations to see whether it is progressing."),
+    _error_rule(r"^Memory limit exceeded|MemoryError|heap out of memory|OutOfMemoryError|std::bad_alloc",
+                "Your program used too much memory.",
+                "The program tried to keep more data in memory than it is allowed to use.",
+                "Lists or strings that grow inside an endless loop, or very deep recursion, eat up memory.",
+                ["Look for a list/array that keeps growing in a loop", "Check loops and recursion actually stop",
+                 "Store only what you need instead of every intermediate value"],
+                "Try the program on a small input first and watch how big your data structures get."),
+    _error_rule(r"^Output limit exceeded",
+                "Your program printed too much output.",
+                "The program printed more text than allowed, which almost always means a print inside an endless loop.",
+                "A print statement inside a loop that never stops will print forever.",
+                ["Find the print inside a loop and check that the loop ends",
+                 "Print a summary instead of every step"],
+                "Limit debug prints to the first few iterations."),
+]
+
+_PYTHON_RULES = [
+    _error_rule(r"^NameError: name Q(?P<symbol>\w+)Q is not defined(?:\. Did you mean: Q(?P<other>\w+)Q\?)?",
+                "'{symbol}' is used before Python knows what it is.",
+                "Python found the name '{symbol}' but it was never created. Every variable must be given a value, "
+                "and every function defined, before it is used.",
+                "This usually comes from a typo, a different capitalisation, using a variable before the line "
+                "that assigns it, or forgetting quotes around text.",
+                ["Check the spelling and capitalisation of '{symbol}'",
+                 "Make sure '{symbol}' is assigned (or defined) above the line that uses it",
+                 "If '{symbol}' is meant to be text, put it in quotes"],
+                "Python names are case-sensitive: 'Total' and 'total' are different variables.",
+                "'{symbol}' is not defined here"),
+    _error_rule(r"^UnboundLocalError: (?:cannot access local variable|local variable) Q(?P<symbol>\w+)Q",
+                "'{symbol}' is read inside a function before it gets a value there.",
+                "Because '{symbol}' is assigned somewhere inside this function, Python treats it as a new local "
+                "variable, and it is read before that assignment runs.",
+                "Changing a variable from outside a function without declaring it global (or passing it in) causes this.",
+                ["Pass '{symbol}' into the function as a parameter and return the new value",
+                 "Or assign '{symbol}' inside the function before reading it",
+                 "Use 'global {symbol}' only if you really need to change a module-level variable"],
+                "Functions are easier to follow when they get inputs as parameters and give results back with return.",
+                "'{symbol}' is read before it is assigned in this function"),
+    _error_rule(r"^IndentationError: expected an indented block",
+                "A block is missing its indented body.",
+                "After a line ending with ':' (if, for, while, def, class...), Python expects the next lines to be "
+                "indented. Here the body is missing or not indented.",
+                "Forgetting to indent the body, or leaving a block empty while writing code, triggers this.",
+                ["Indent the lines that belong to the block by 4 spaces",
+                 "If the block should be empty for now, write 'pass' inside it"],
+                "Use 4 spaces per indentation level and let your editor insert them.",
+                "indent this line so it belongs to the block above"),
+    _error_rule(r"^IndentationError: unexpected indent",
+                "A line is indented when it shouldn't be.",
+                "This line starts further to the right than Python expects. Indentation marks which block a line "
+                "belongs to, so extra spaces change the meaning.",
+                "Copy-pasting code or an accidental space at the start of a line causes this.",
+                ["Line this statement up with the lines around it",
+                 "Only indent after a line that ends with ':'"],
+                "Turn on 'show whitespace' in your editor to spot stray spaces.",
+                "remove the extra indentation"),
+    _error_rule(r"^IndentationError: unindent does not match any outer indentation level|^TabError",
+                "The indentation is inconsistent.",
+                "This line's indentation doesn't line up with any block above it, or tabs and spaces are mixed.",
+                "Mixing tabs and spaces, or using 3 spaces in one place and 4 in another, confuses Python.",
+                ["Re-indent the block using spaces only (4 per level)",
+                 "Make sure this line lines up exactly with the block it belongs to"],
+                "Configure your editor to insert spaces when you press Tab.",
+                "align this line with its block"),
+    _error_rule(r"^SyntaxError: expected Q:Q",
+                "A colon ':' is missing.",
+                "Lines that start a block (if, elif, else, for, while, def, class, try...) must end with a colon.",
+                "It's easy to forget the colon when coming from other languages.",
+                ["Add ':' at the end of the if/for/while/def line"],
+                "Every line that is followed by an indented block ends with ':'.",
+                "add ':' at the end"),
+    _error_rule(r"^SyntaxError: Q(?P<symbol>[(\[{])Q was never closed|^SyntaxError: unexpected EOF while parsing",
+                "A bracket is opened but never closed.",
+                "Python reached the end of the code while a '(', '[' or '{{' was still open.",
+                "Nested function calls and lists make it easy to lose count of closing brackets.",
+                ["Count the opening and closing brackets on the line", "Add the missing closing bracket"],
+                "Most editors highlight the matching bracket when the cursor is next to one.",
+                "close the bracket opened here"),
+    _error_rule(r"^SyntaxError: unterminated (?:triple-quoted )?string literal|^SyntaxError: EOL while scanning string literal",
+                "A string is missing its closing quote.",
+                "Text in quotes must start and end with the same kind of quote on the same line.",
+                "A missing quote, or mixing ' and \" for the same string, causes this.",
+                ["Add the closing quote", "Use the same quote character at both ends"],
+                "If the text itself contains a quote, wrap it in the other kind: \"it's\".",
+                "close the string"),
+    _error_rule(r"^SyntaxError: invalid syntax\. Perhaps you forgot a comma\?",
+                "A comma seems to be missing.",
+                "Items in a list, tuple, dict or function call must be separated by commas.",
+                "Writing several values one after another without commas causes this.",
+                ["Add commas between the items on this line"],
+                "Put each item of a long list on its own line, ending with a comma.",
+                "separate the items with commas"),
+    _error_rule(r"^SyntaxError: (?:invalid syntax|cannot assign to .*|invalid character .*|.*)$",
+                "Python couldn't understand this line.",
+                "The code breaks Python's grammar rules near the marked position: something is missing, extra, "
+                "or in the wrong order.",
+                "Common causes are a missing bracket or colon, '=' instead of '==' in a condition, or a keyword used as a name.",
+                ["Look at the marked line and the line just above it",
+                 "Check brackets, quotes and colons", "Use '==' (not '=') to compare values"],
+                "The real mistake is often at the end of the previous line.",
+                "check the syntax here"),
+    _error_rule(r"^TypeError: can only concatenate str \(not Q(?P<symbol>\w+)Q\) to str",
+                "Text and a value of type {symbol} are being joined with '+'.",
+                "'+' can join two strings, or add two numbers, but not a string and a value of type {symbol}.",
+                "Building a message from text and a number without converting the number is very common.",
+                ["Convert the value with str(...) before joining", "Or use an f-string: f\"Total: {{total}}\""],
+                "f-strings convert values to text for you and are easier to read.",
+                "convert the {symbol} with str() or use an f-string"),
+    _error_rule(r"^TypeError: unsupported operand type\(s\) for (?P<other>\S+): Q(?P<symbol>\w+)Q and Q(?P<third>\w+)Q",
+                "'{other}' can't be used between a {symbol} and a {third}.",
+                "The two values on either side of '{other}' have types that don't work together.",
+                "Numbers read with input() are strings until converted, which often causes this.",
+                ["Convert the values to the same type first (int(...), float(...) or str(...))",
+                 "Print type(value) to check what each value really is"],
+                "Convert input() with int() or float() right where you read it.",
+                "make both sides the same type"),
+    _error_rule(r"^TypeError: (?P<symbol>[\w.]+)\(\) missing (?P<other>\d+) required positional arguments?: (?P<third>.+)",
+                "{symbol}() was called without all of its arguments.",
+                "The function {symbol}() needs more values than were given; missing: {third}.",
+                "The call and the function definition disagree on how many values to pass.",
+                ["Pass a value for each parameter: {third}", "Or give the parameter a default value in the def line"],
+                "Compare the call with the def line side by side.",
+                "pass {third} to {symbol}()"),
+    _error_rule(r"^TypeError: (?P<symbol>[\w.]+)\(\) takes (?P<other>\d+) positional arguments? but (?P<third>\d+) (?:were|was) given",
+                "{symbol}() got {third} arguments but takes {other}.",
+                "The call passes more values than {symbol}() accepts.",
+                "Methods receive 'self' automatically; forgetting 'self' in a method definition also causes this.",
+                ["Remove the extra argument from the call", "If it's a method, add 'self' as its first parameter"],
+                "Methods in a class always start with 'self'.",
+                "match the number of arguments to the definition"),
+    _error_rule(r"^TypeError: Q(?P<symbol>\w+)Q object is not (?P<other>callable|subscriptable|iterable)",
+                "A {symbol} value is being used as if it were {other}.",
+                "The code treats a {symbol} like something it is not: calling it with (), indexing it with [] or looping over it.",
+                "Reusing a name (for example naming a variable 'list' or 'sum') or a missing operator often causes this.",
+                ["Check what type the value really has (print(type(x)))",
+                 "Don't name variables after built-ins like list, str, sum or max"],
+                "Pick descriptive variable names that don't shadow built-ins.",
+                "this {symbol} is not {other}"),
+    _error_rule(r"^ZeroDivisionError",
+                "The program divided by zero.",
+                "Division (or %) by zero has no answer, so Python stops.",
+                "A counter or length that is still 0 (for example an empty list) is used as the divisor.",
+                ["Check the divisor is not 0 before dividing", "Handle the empty case separately"],
+                "Guard averages with 'if count > 0:'.",
+                "make sure the divisor can't be 0"),
+    _error_rule(r"^IndexError: (?P<symbol>\w+) (?:assignment )?index out of range",
+                "The code reads past the end of a {symbol}.",
+                "An index is too big (or too negative) for the {symbol}. Indexes go from 0 to len - 1.",
+                "Loops that go one step too far, like range(len(items) + 1) or items[len(items)], are the usual cause.",
+                ["Make loops stop at len(items) - 1", "Use 'for item in items' instead of indexes where possible",
+                 "Check the list isn't empty before reading items[0]"],
+                "The last element is items[-1] (or items[len(items) - 1]).",
+                "keep the index below the length"),
+    _error_rule(r"^KeyError: (?P<symbol>.+)",
+                "The key {symbol} isn't in the dictionary.",
+                "The code looks up {symbol} in a dictionary that doesn't contain it.",
+                "Typos in keys, or reading a key before it was added, cause this.",
+                ["Check the key's spelling", "Use d.get(key, default) when the key may be missing",
+                 "Check 'if key in d:' before reading"],
+                "dict.get() returns a default instead of crashing.",
+                "{symbol} is missing from the dictionary"),
+    _error_rule(r"^AttributeError: Q(?P<symbol>\w+)Q object has no attribute Q(?P<other>\w+)Q",
+                "A {symbol} has no '{other}'.",
+                "The code uses .{other} on a value of type {symbol}, which doesn't have it.",
+                "Using a method from another language (like list.push) or a value being a different type than expected.",
+                ["Check the name of the method for {symbol} (e.g. lists use append, not push)",
+                 "Print type(value) to make sure it is what you expect"],
+                "dir(value) lists everything a value supports.",
+                "{symbol} has no '{other}'"),
+    _error_rule(r"^ValueError: invalid literal for int\(\) with base 10: (?P<symbol>.+)",
+                "{symbol} can't be turned into a whole number.",
+                "int() only converts text made of digits; {symbol} isn't.",
+                "Reading input that contains spaces, decimals or letters and passing it straight to int().",
+                ["Strip spaces with .strip() before converting", "Use float() for decimal numbers",
+                 "Check the input you typed matches what the program expects"],
+                "Split a line of numbers with input().split() and convert each part.",
+                "check the text passed to int()"),
+    _error_rule(r"^RecursionError: maximum recursion depth exceeded",
+                "A function calls itself too many times.",
+                "The recursion never reaches a case where it stops, so calls pile up until Python gives up.",
+                "A missing or unreachable base case, or a recursive call that doesn't make the problem smaller.",
+                ["Add a base case that returns without calling the function again",
+                 "Make sure each recursive call moves toward that base case"],
+                "Write the base case first when writing a recursive function.",
+                "check the base case"),
+    _error_rule(r"^ModuleNotFoundError: No module named Q(?P<symbol>[\w.]+)Q",
+                "The module '{symbol}' isn't available.",
+                "The code imports '{symbol}', but it isn't installed here (or the name is misspelled).",
+                "Only the standard library is available in the playground.",
+                ["Check the spelling of '{symbol}'", "Use a standard-library alternative"],
+                "The standard library covers math, random, collections, itertools and more.",
+                "'{symbol}' can't be imported here"),
+    _error_rule(r"^EOFError: EOF when reading a line",
+                "The program asked for input, but there was none.",
+                "input() waited for a line of text, but the program's input was empty.",
+                "The program reads more lines with input() than were provided.",
+                ["Type the input in the input box before running", "Make sure you don't call input() more times than there are lines"],
+                "Provide one line of input for every input() call.",
+                "this input() had nothing to read"),
+]
+
+_JAVA_RULES = [
+    _error_rule(r"^No public class found in Java code",
+                "No public class was found.",
+                "Java programs here must contain a public class (for example 'public class Main') with a main method.",
+                "The class is missing the 'public' keyword, or the class declaration was removed.",
+                ["Declare the class as 'public class Main {{ ... }}'",
+                 "Put 'public static void main(String[] args)' inside it"],
+                "Start from the template: public class Main with a main method."),
+    _error_rule(r"error: cannot find symbol(?:\n.*){0,3}?\n\s*symbol:\s+(?P<other>\w+) (?P<symbol>[\w$]+)",
+                "Java doesn't know the {other} '{symbol}'.",
+                "The {other} '{symbol}' is used but never declared where this code can see it.",
+                "Typos, wrong capitalisation, a missing import, or a variable declared inside another block ({{...}}).",
+                ["Check the spelling and capitalisation of '{symbol}'",
+                 "Declare '{symbol}' before using it, in a scope that includes this line",
+                 "If it's a library class, add the right import (e.g. import java.util.*;)"],
+                "Variables declared inside {{ }} only exist inside those braces.",
+                "'{symbol}' is not declared here"),
+    _error_rule(r"error: Q(?P<symbol>[^'\n]+)Q expected",
+                "Java expected '{symbol}' here.",
+                "The code is missing '{symbol}' at this spot; statements usually end with ';' and blocks need matching braces.",
+                "Forgetting a ';' at the end of a statement is the most common cause.",
+                ["Add '{symbol}' at the end of the statement on this line (or the one before)"],
+                "Every Java statement ends with ';'.",
+                "add '{symbol}'"),
+    _error_rule(r"error: incompatible types: (?P<symbol>.+?) cannot be converted to (?P<other>\S+)",
+                "A {symbol} is used where a {other} is required.",
+                "Java is strict about types: a {symbol} can't be stored in or passed as a {other} directly.",
+                "Assigning text to a number variable, or a double to an int, without converting.",
+                ["Convert the value explicitly (Integer.parseInt(...), String.valueOf(...), (int) ...)",
+                 "Or change the variable's type to {symbol}"],
+                "Check the declared type of the variable on the left of '='.",
+                "convert the {symbol} to {other}"),
+    _error_rule(r"error: missing return statement",
+                "The method can finish without returning a value.",
+                "A method with a return type must return a value on every path, including after loops and if/else.",
+                "Returning only inside an if, or only inside a loop, leaves a path with no return.",
+                ["Add a return at the end of the method", "Make sure every branch of if/else returns"],
+                "Follow each path through the method and check it ends in return."),
+    _error_rule(r"error: variable (?P<symbol>\w+) might not have been initialized",
+                "'{symbol}' may be used before it has a value.",
+                "Java requires local variables to be given a value before they are read.",
+                "The variable is only assigned inside an if or loop that might not run.",
+                ["Give '{symbol}' a starting value where it is declared"],
+                "Initialise local variables when you declare them.",
+                "initialise '{symbol}'"),
+    _error_rule(r"error: class (?P<symbol>\w+) is public, should be declared in a file named",
+                "Only one class in the file can be public; '{symbol}' is a second one.",
+                "The file is named after its first public class, and Java requires every public class to live "
+                "in a file of its own name, so '{symbol}' can't be public here.",
+                "Writing 'public' in front of every class is a common habit, but a file holds one public class.",
+                ["Remove 'public' from class {symbol} (and any other extra classes)",
+                 "Or move {symbol} into its own file, {symbol}.java"],
+                "Keep exactly one public class per file; helper classes can stay package-private.",
+                "make {symbol} non-public"),
+    _error_rule(r"error: unreachable statement",
+                "This line can never run.",
+                "It comes after a return, break or continue, so execution can never reach it.",
+                "Leftover code after a return.",
+                ["Remove the line or move it before the return/break"],
+                "Code after return in the same block is always dead.",
+                "this line can never run"),
+    _error_rule(r"java\.lang\.ArrayIndexOutOfBoundsException: Index (?P<symbol>-?\d+) out of bounds for length (?P<other>\d+)",
+                "Index {symbol} is outside an array of length {other}.",
+                "Array indexes go from 0 to length - 1, so {symbol} is not a valid position in an array of length {other}.",
+                "Loops written with '<=' instead of '<' go one step too far.",
+                ["Use 'i < arr.length' in loop conditions", "Check the index before using it"],
+                "The last element is arr[arr.length - 1].",
+                "keep the index below {other}"),
+    _error_rule(r"java\.lang\.StringIndexOutOfBoundsException",
+                "A string position is out of range.",
+                "charAt/substring was given a position outside the string.",
+                "Off-by-one loop bounds or using an index on an empty string.",
+                ["Keep indexes between 0 and s.length() - 1", "Check for empty strings first"],
+                "substring(a, b) includes a but excludes b."),
+    _error_rule(r"java\.lang\.NullPointerException",
+                "Something is null where an object was expected.",
+                "The code calls a method or reads a field on a variable that holds null (no object).",
+                "Objects or array elements that were declared but never created with 'new'.",
+                ["Create the object with 'new' before using it", "Check for null before calling methods on it"],
+                "Arrays of objects start out full of null.",
+                "this value is null"),
+    _error_rule(r"java\.lang\.ArithmeticException: / by zero",
+                "The program divided by zero.",
+                "Integer division by zero has no answer, so Java throws an exception.",
+                "A count or length that is still 0 is used as the divisor.",
+                ["Check the divisor is not 0 before dividing"],
+                "Guard averages with 'if (count > 0)'.",
+                "make sure the divisor can't be 0"),
+    _error_rule(r"java\.util\.(?:InputMismatchException|NoSuchElementException)",
+                "Reading input failed.",
+                "Scanner tried to read a value that isn't there, or isn't of the expected type.",
+                "Calling nextInt() when the input has text, or reading more values than were provided.",
+                ["Provide the input in the input box before running",
+                 "Match nextInt()/nextLine() calls to the input's format",
+                 "Use hasNextInt()/hasNext() before reading"],
+                "Read whole lines with nextLine() and convert them yourself for more control."),
+    _error_rule(r"java\.lang\.StackOverflowError",
+                "A method calls itself too many times.",
+                "The recursion never reaches a base case, so calls pile up until the stack runs out.",
+                "A missing base case or a recursive call that doesn't make the problem smaller.",
+                ["Add a base case that returns without recursing", "Make each call move toward it"],
+                "Write the base case first when writing a recursive method."),
+    _error_rule(r"java\.lang\.NumberFormatException: For input string: \"(?P<symbol>[^\"]*)\"",
+                "\"{symbol}\" isn't a valid number.",
+                "Integer.parseInt (or similar) was given text that isn't a number.",
+                "Extra spaces, decimals passed to parseInt, or the wrong part of the input.",
+                ["trim() the text before parsing", "Use Double.parseDouble for decimals"],
+                "Print the text before parsing it to see exactly what it contains.",
+                "\"{symbol}\" can't be parsed"),
+]
+
+_CPP_STD_NAMES = r"cout|cin|endl|cerr|string|vector|map|set|unordered_map|pair|sort|max|min|swap|getline"
+_CPP_RULES = [
+    _error_rule(r"error: Q(?P<symbol>" + _CPP_STD_NAMES + r")Q was not declared in this scope",
+                "'{symbol}' needs the std:: prefix or an #include.",
+                "'{symbol}' comes from the C++ standard library, which lives in the std namespace and must be included.",
+                "Forgetting '#include <...>' or 'using namespace std;' (or writing std::{symbol}).",
+                ["Add the header: #include <iostream> for cout/cin, <vector>, <string>, <algorithm>...",
+                 "Write std::{symbol}, or add 'using namespace std;' after the includes"],
+                "#include <bits/stdc++.h> pulls in the whole standard library for quick programs.",
+                "use std::{symbol} and include its header"),
+    _error_rule(r"error: Q(?P<symbol>\w+)Q was not declared in this scope(?:; did you mean Q(?P<other>\w+)Q\?)?",
+                "'{symbol}' is used but never declared.",
+                "C++ needs every variable and function to be declared before it is used; '{symbol}' isn't declared where this line can see it.",
+                "Typos, a variable declared inside another block, or a function defined below the code that calls it.",
+                ["Check the spelling of '{symbol}'", "Declare '{symbol}' with a type before this line",
+                 "Define (or declare) functions above the code that calls them"],
+                "Variables declared inside {{ }} only exist inside those braces.",
+                "'{symbol}' is not declared here"),
+    _error_rule(r"error: expected (?:Q[^\n]*?Q or )?Q(?P<symbol>[;,)}\]])Q before",
+                "A '{symbol}' is missing.",
+                "The compiler expected '{symbol}' before the next token; most often a statement is missing its ';'.",
+                "Usually the end of a statement was reached without its ';'.",
+                ["Add '{symbol}' where the compiler points (the end of the statement)"],
+                "Every C++ statement ends with ';'.",
+                "add '{symbol}' at the end"),
+    _error_rule(r"error: expected Q}Q at end of input",
+                "A closing brace '}}' is missing.",
+                "The file ended while a block (function, loop, if) was still open.",
+                "An opening '{{' without its matching '}}'.",
+                ["Add the missing '}}'", "Indent the code to see which block isn't closed"],
+                "Type the closing brace right after the opening one, then fill in the block."),
+    _error_rule(r"error: invalid conversion from Q(?P<symbol>[^'‘’]+)Q to Q(?P<other>[^'‘’]+)Q",
+                "A {symbol} is used where a {other} is needed.",
+                "C++ won't convert a {symbol} into a {other} automatically.",
+                "Mixing pointers and values, or text and numbers.",
+                ["Convert explicitly, or change the variable's type", "Check the types of both sides of '='"],
+                "Hover or look up each variable's declared type.",
+                "convert {symbol} to {other}"),
+    _error_rule(r"error: no matching function for call to Q(?P<symbol>[^'‘’(]+)",
+                "{symbol} was called with the wrong arguments.",
+                "No version of {symbol} accepts the number or types of arguments in this call.",
+                "Passing the wrong number of arguments, or arguments of the wrong type.",
+                ["Compare the call with the function's declaration", "Convert arguments to the expected types"],
+                "The compiler's 'candidate:' notes list the versions that exist.",
+                "fix the arguments of {symbol}"),
+    _error_rule(r"undefined reference to [`'‘]main",
+                "The program has no main function.",
+                "Every C++ program starts at 'int main()', and it is missing or misspelled.",
+                "Renaming main, or writing it inside a class.",
+                ["Add 'int main() {{ ... return 0; }}'"],
+                "main must be a free function returning int."),
+    _error_rule(r"terminate called after throwing an instance of Q(?:std::)?(?P<symbol>\w+)Q",
+                "An uncaught {symbol} exception stopped the program.",
+                "The program threw std::{symbol} and nothing caught it.",
+                "out_of_range usually comes from .at() with a bad index; invalid_argument from stoi() on non-numbers.",
+                ["Check indexes against .size() before using .at()", "Validate input before converting it"],
+                "Print values just before the failing call to see what went wrong."),
+    _error_rule(r"Segmentation fault",
+                "The program accessed memory it shouldn't (segmentation fault).",
+                "The program read or wrote outside the memory it owns and was stopped by the operating system.",
+                "Indexing past the end of an array or vector, using an uninitialised pointer, or very deep recursion.",
+                ["Check array/vector indexes stay below the size", "Initialise pointers before using them",
+                 "Make sure recursion has a base case"],
+                "Use .at(i) instead of [i] while debugging: it reports bad indexes."),
+    _error_rule(r"Floating point exception",
+                "The program divided by zero.",
+                "Integer division (or %) by zero crashes the program.",
+                "A count that is still 0 is used as the divisor.",
+                ["Check the divisor is not 0 before dividing"],
+                "Guard divisions with 'if (count != 0)'."),
+]
+
+_JS_RULES = [
+    _error_rule(r"^ReferenceError: (?P<symbol>[\w$]+) is not defined",
+                "'{symbol}' is used but never declared.",
+                "JavaScript can't find a variable or function named '{symbol}'.",
+                "Typos, wrong capitalisation, or using a variable outside the block where it was declared with let/const.",
+                ["Check the spelling of '{symbol}'", "Declare it with let or const before using it"],
+                "let and const variables only exist inside the {{ }} where they are declared.",
+                "'{symbol}' is not declared here"),
+    _error_rule(r"^ReferenceError: Cannot access Q(?P<symbol>[\w$]+)Q before initialization",
+                "'{symbol}' is used before the line that declares it.",
+                "Variables declared with let/const can't be used above their declaration.",
+                "Code that uses a variable is above the line that creates it.",
+                ["Move the declaration of '{symbol}' above its first use"],
+                "Declare variables at the top of the block that uses them.",
+                "declare '{symbol}' earlier"),
+    _error_rule(r"^TypeError: Assignment to constant variable",
+                "A const variable is being changed.",
+                "Variables declared with const can't be reassigned.",
+                "Using const for a counter or a value that changes later.",
+                ["Declare the variable with let instead of const"],
+                "Use const by default and let only for values that change.",
+                "this variable is const"),
+    _error_rule(r"^TypeError: (?P<symbol>[\w$.\[\]]+) is not a function",
+                "{symbol} is not a function.",
+                "The code calls {symbol}(), but that value isn't a function.",
+                "A typo in a method name, or calling a method that the value's type doesn't have.",
+                ["Check the spelling of the method", "console.log the value to see what it really is"],
+                "Arrays use push/pop; strings have no push.",
+                "{symbol} is not a function"),
+    _error_rule(r"^TypeError: Cannot read propert(?:y|ies) (?:of (?P<other>undefined|null) \(reading Q(?P<symbol>[^'\n]+)Q\)|Q(?P<symbol2>[^'\n]+)Q of (?P<other2>undefined|null))",
+                "Reading a property of undefined/null.",
+                "The code reads a property (like .length or [0]) from a value that is undefined or null.",
+                "Reading past the end of an array, a missing object key, or a function that didn't return anything.",
+                ["console.log the value before this line", "Check array indexes and object keys exist",
+                 "Make sure the function you got the value from returns something"],
+                "Optional chaining (obj?.prop) avoids the crash when a value may be missing.",
+                "this value is undefined or null"),
+    _error_rule(r"^SyntaxError: Unexpected end of input",
+                "The code ends too early: a bracket or brace isn't closed.",
+                "JavaScript reached the end of the file while a '(', '[' or '{{' was still open.",
+                "A missing closing brace for a function, loop or if.",
+                ["Add the missing closing bracket/brace", "Indent the code to see which block isn't closed"],
+                "Type the closing brace right after the opening one, then fill in the block."),
+    _error_rule(r"^SyntaxError: Identifier Q(?P<symbol>[\w$]+)Q has already been declared",
+                "'{symbol}' is declared twice.",
+                "The same name is declared with let/const twice in the same block.",
+                "Copy-pasted declarations, or re-declaring instead of reassigning.",
+                ["Remove the second 'let'/'const' and just assign: {symbol} = ..."],
+                "Declare once, then assign as often as needed (with let).",
+                "'{symbol}' is already declared"),
+    _error_rule(r"^SyntaxError: (?P<symbol>missing .+|Unexpected token.*|Invalid or unexpected token|Unexpected identifier.*)",
+                "JavaScript couldn't understand this line ({symbol}).",
+                "The code breaks JavaScript's grammar near the reported position.",
+                "A missing bracket, parenthesis or comma, or an extra character.",
+                ["Check brackets, parentheses and commas on this line and the one before",
+                 "Look for a missing quote around text"],
+                "The real mistake is often just before the reported position.",
+                "check the syntax here"),
+    _error_rule(r"^RangeError: Maximum call stack size exceeded",
+                "A function calls itself too many times.",
+                "The recursion never reaches a base case, so calls pile up until the stack runs out.",
+                "A missing base case or a recursive call that doesn't make the problem smaller.",
+                ["Add a base case that returns without recursing", "Make each call move toward it"],
+                "Write the base case first when writing a recursive function."),
+]
+
+ERROR_RULES = {
+    "python": _PYTHON_RULES + _LIMIT_RULES,
+    "java": _JAVA_RULES + _LIMIT_RULES,
+    "cpp": _CPP_RULES + _LIMIT_RULES,
+    "javascript": _JS_RULES + _LIMIT_RULES,
+}
+instant_explain_stats = {"instantHits": 0, "instantMisses": 0}
+
+
+class _Blank(dict):
+    def __missing__(self, key):
+        return "?"
+
+
+def instant_explanation(language: str, code: str, error: str | None) -> AIExplainResponse | None:
+    """Explain a well-known error without the model; None when no rule matches."""
+    if not AI_INSTANT_EXPLAIN or not error:
+        return None
+    language = language.lower()
+    best = None
+    for rule in ERROR_RULES.get(language, _LIMIT_RULES):
+        match = rule["pattern"].search(error)
+        if match and (best is None or match.start() < best[1].start()):
+            best = (rule, match)
+    if best is None:
+        instant_explain_stats["instantMisses"] += 1
+        return None
+    rule, match = best
+    values = _Blank({key: value.strip() for key, value in match.groupdict().items() if value})
+    for key in ("symbol", "other"):  # alternative spellings of the same group
+        if key not in values and values.get(key + "2"):
+            values[key] = values[key + "2"]
+    if language in ("cpp", "java"):
+        # Compilers report many errors; use the location printed with this one
+        pattern = _ERROR_LINE["java" if language == "java" else "cpp"][0]
+        located = list(pattern.finditer(error, 0, match.end()))
+        line = int(located[-1].group(1)) if located else error_line(language, error)
+    else:
+        line = error_line(language, error)
+    values["line"] = line or "?"
+
+    line_fixes = None
+    lines = code.split("\n")
+    if line and 0 < line <= len(lines) and rule["lineFix"]:
+        line_fixes = [f"Line {line}: `{lines[line - 1].strip()}` - {rule['lineFix'].format_map(values)}"]
+    summary = rule["summary"].format_map(values)
+    instant_explain_stats["instantHits"] += 1
+    return AIExplainResponse(
+        summary=f"Line {line}: {summary}" if line else summary,
+        lineFixes=line_fixes,
+        beginnerExplanation=rule["beginnerExplanation"].format_map(values),
+        whyItHappened=rule["whyItHappened"].format_map(values),
+        howToFix=[fix.format_map(values) for fix in rule["howToFix"]],
+        proTip=rule["proTip"].format_map(values),
+        instant=True,
+    )
+
+
+# -------- AI: run analysis --------
+# A run on /execute/stream with "analyze" also gets the AI panel's content, so
+# the client doesn't wait for the run and then for a second round trip.
+# Suggestions only depend on the code, so they are requested as soon as the
+# run is received and overlap queueing, compiling and running; once the exit
+# status is known they are either sent or dropped for an explanation of the
+# error. RUN_ANALYZE_SPECULATE=false waits for the exit status instead, which
+# saves the provider call on failing runs.
+
+RUN_ANALYZE_SPECULATE = os.getenv("RUN_ANALYZE_SPECULATE", "true").lower() == "true"
+
+
+class RunAnalysis:
+    """AI suggestions or error explanation for one streamed run."""
+
+    def __init__(self, language: str, code: str, options: dict | bool):
+        options = options if isinstance(options, dict) else {}
+        self.language = language
+        self.code = code
+        self.suggest_req = AISuggestRequest(
+            language=language, code=code, cursor=options.get("cursor"),
+            goal=options.get("goal"), hints=options.get("hints"),
         )
+        self.suggestion = self._suggest() if RUN_ANALYZE_SPECULATE else None
+
+    def _suggest(self) -> asyncio.Task:
+        task = asyncio.create_task(ai_suggest(self.suggest_req))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # discarded tasks may fail unseen
+        return task
+
+    def discard(self) -> None:
+        if self.suggestion is not None:
+            self.suggestion.cancel()
+
+    async def finish(self, outcome: dict) -> dict:
+        """The "analysis" frame for a run that ended with `outcome` (an exit frame plus stderr)."""
+        if outcome["timedOut"] or outcome["exitCode"] != 0:
+            self.discard()
+            error = "\n".join(filter(None, [outcome["stderr"].rstrip("\n"), LIMIT_MESSAGES.get(outcome["limitHit"])]))
+            response = await ai_explain(AIExplainRequest(language=self.language, code=self.code, error=error or None))
+            return {"type": "analysis", "kind": "explain", "response": response.model_dump()}
+        if self.suggestion is None:
+            self.suggestion = self._suggest()
+        try:
+            response = await self.suggestion
+        except HTTPException as e:
+            return {"type": "analysis", "kind": "suggest", "error": e.detail}
+        return {"type": "analysis", "kind": "suggest", "response": response.model_dump()}
+
+
+# -------- AI: editor sessions --------
+# Long files are mostly unchanged between two suggest requests. An editor
+# session keeps the document on the server so the client only sends edits,
+# and splits it into chunks (top-level functions and classes, the methods of
+# Java classes, and the remaining top-level code) that are analysed one by
+# one. Chunk answers are cached under the chunk's text, so after an edit only
+# the chunks that changed reach the model; the answers are merged into one
+# AISuggestResponse. Sessions are JSON files in AI_SESSION_DIR, so any server
+# worker can serve the next request; edits are applied under an flock on the
+# directory's lock file, and a file's mtime is the session's last use.
+
+AI_SESSION_DIR = os.getenv("AI_SESSION_DIR", os.path.join(tempfile.gettempdir(), "codex_ai_sessions"))
+AI_SESSION_TTL = int(os.getenv("AI_SESSION_TTL", "1800"))  # seconds since last use
+AI_SESSION_MAX = int(os.getenv("AI_SESSION_MAX", "500"))
+AI_SESSION_MAX_UNPARSABLE = 64  # chunk keys remembered per session
+AI_SESSION_MAX_CHUNKS = int(os.getenv("AI_SESSION_MAX_CHUNKS", "8"))  # model calls per request
+AI_SESSION_OUTLINE_TOKENS = 300
+AI_SESSION_MAX_ITEMS = 10  # merged suggestions / notes / variables
+
+_CODE_LITERALS = re.compile(r'"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'|`(?:\\.|[^`\\])*`|//.*|/\*.*?\*/')
+_CONTAINER_LINE = re.compile(r"\b(?:class|interface|enum|record)\s+\w+")
+_CHUNK_NAME = re.compile(r"(?:class|struct|interface|enum|record|function)\s+(\w+)|(\w+)\s*(?:=\s*(?:async\s*)?\(|\()")
+_IMPORT_KEYWORDS = ("import", "from", "#", "using")
+
+
+class AISessionEdit(BaseModel):
+    start: int  # character offsets into the document as left by the previous edit
+    end: int
+    text: str = ""
+
+
+class AISessionCreateRequest(BaseModel):
+    language: str
+    code: str
+
+
+class AISessionEditRequest(BaseModel):
+    version: int  # document version the edits apply to
+    edits: list[AISessionEdit]
+
+
+class AISessionSuggestRequest(BaseModel):
+    version: int | None = None  # required with edits
+    edits: list[AISessionEdit] = []
+    cursor: int | None = None
+    goal: str | None = None
+    hints: list[str] | None = None
+
+
+class AISessionChunk(BaseModel):
+    name: str
+    startLine: int
+    endLine: int
+
+
+class AISessionResponse(BaseModel):
+    sessionId: str
+    version: int
+    chunks: list[AISessionChunk]
+
+
+def python_chunks(code: str) -> list[tuple[str, int, int]] | None:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    return [
+        (node.name, min([node.lineno] + [d.lineno for d in node.decorator_list]), node.end_lineno)
+        for node in tree.body
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+    ]
+
+
+def brace_chunks(language: str, code: str) -> list[tuple[str, int, int]]:
+    """Top-level brace blocks that start with a declaration (Java: the members of top-level types)."""
+    header = _OUTLINE_LINE[language]
+    chunks, depth, containers, block = [], 0, set(), None
+    for number, line in enumerate(code.split("\n"), 1):
+        text = _CODE_LITERALS.sub("", line)
+        stripped = text.strip()
+        if block is None and (depth == 0 or depth in containers) and header.match(line) \
+                and not stripped.startswith(_IMPORT_KEYWORDS):
+            if language == "java" and _CONTAINER_LINE.search(text) and depth == 0:
+                containers.add(depth + 1)
+            else:
+                name = _CHUNK_NAME.search(text)
+                block = [next(filter(None, name.groups())) if name else f"line {number}", number, depth, False]
+        depth = max(0, depth + text.count("{") - text.count("}"))
+        containers = {level for level in containers if level <= depth}
+        if block is not None:
+            block[3] = block[3] or "{" in text or depth > block[2]
+            if block[3] and depth <= block[2]:
+                chunks.append((block[0], block[1], number))
+                block = None
+            elif not block[3] and stripped.endswith(";"):  # a declaration, not a definition
+                block = None
+    return chunks
+
+
+def code_chunks(language: str, code: str) -> list[dict]:
+    """Split `code` into named chunks; lines outside any block form the "top-level code" chunk."""
+    language = language.lower()
+    lines = code.split("\n")
+    blocks = python_chunks(code) if language == "python" else (
+        brace_chunks(language, code) if language in _OUTLINE_LINE else None)
+    chunks, covered = [], set()
+    for name, start, end in blocks or []:
+        chunks.append({"name": name, "start": start, "end": end, "text": "\n".join(lines[start - 1:end])})
+        covered.update(range(start, end + 1))
+    rest = [number for number in range(1, len(lines) + 1) if number not in covered]
+    if any(lines[number - 1].strip() for number in rest):
+        chunks.append({
+            "name": "top-level code", "start": rest[0], "end": rest[-1],
+            "text": "\n".join(lines[number - 1] for number in rest),
+        })
+    return sorted(chunks, key=lambda chunk: chunk["start"])
+
+
+def chunk_at(chunks: list[dict], line: int | None) -> int | None:
+    """Index of the chunk holding `line`; the top-level chunk only holds lines outside every block."""
+    holding = [i for i, chunk in enumerate(chunks) if line and chunk["start"] <= line <= chunk["end"]]
+    return min(holding, key=lambda i: chunks[i]["name"] == "top-level code", default=None)
+
+
+def file_outline(language: str, code: str) -> str:
+    pattern = _OUTLINE_LINE.get(language.lower())
+    lines = [line.strip() for line in code.split("\n") if pattern and pattern.match(line)]
+    outline, spent = [], 0
+    for line in lines:
+        spent += estimate_tokens(line) + 1
+        if spent > AI_SESSION_OUTLINE_TOKENS:
+            break
+        outline.append(line)
+    return "\n".join(outline)
+
+
+class EditorSession:
+    def __init__(self, language: str, code: str, session_id: str | None = None, version: int = 0,
+                 unparsable: list[str] = ()):
+        self.id = session_id or uuid4().hex
+        self.language = language.lower()
+        self.code = code
+        self.version = version
+        self._chunks = None
+        self.unparsable: list[str] = list(unparsable)  # chunk cache keys whose answer couldn't be parsed
+
+    def record(self) -> dict:
+        return {"language": self.language, "code": self.code, "version": self.version,
+                "unparsable": self.unparsable[-AI_SESSION_MAX_UNPARSABLE:]}
+
+    def apply(self, version: int | None, edits: list[AISessionEdit]) -> None:
+        if version != self.version:
+            raise HTTPException(status_code=409, detail={"message": "Session is at another version", "version": self.version})
+        code = self.code
+        for edit in edits:
+            if not 0 <= edit.start <= edit.end <= len(code):
+                raise HTTPException(status_code=400, detail=f"Edit {edit.start}-{edit.end} is outside the document")
+            code = code[:edit.start] + edit.text + code[edit.end:]
+        self.code = code
+        self.version += 1
+        self._chunks = None
+
+    def chunks(self) -> list[dict]:
+        if self._chunks is None:
+            self._chunks = code_chunks(self.language, self.code)
+        return self._chunks
+
+    def response(self) -> AISessionResponse:
+        return AISessionResponse(sessionId=self.id, version=self.version, chunks=[
+            AISessionChunk(name=chunk["name"], startLine=chunk["start"], endLine=chunk["end"])
+            for chunk in self.chunks()
+        ])
+
+
+class EditorSessions:
+    """Open editor sessions, one JSON file each, shared by all server workers."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, session_id: str) -> str:
+        if not session_id.isalnum():
+            raise HTTPException(status_code=404, detail="Unknown or expired session")
+        return os.path.join(self.directory, f"{session_id}.json")
+
+    @contextmanager
+    def _locked(self):
+        """Serialize read-modify-write of sessions across workers."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _write(self, session: EditorSession) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(session.record(), f, separators=(",", ":"))
+        os.replace(tmp_path, self._path(session.id))
+
+    def _evict(self) -> None:
+        """Drop sessions idle past AI_SESSION_TTL, then the least recently used beyond AI_SESSION_MAX."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        now = time.time()
+        entries.sort(reverse=True)
+        for i, (mtime, path) in enumerate(entries):
+            if i >= AI_SESSION_MAX or now - mtime > AI_SESSION_TTL:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def create(self, language: str, code: str) -> EditorSession:
+        session = EditorSession(language, code)
+        self._write(session)
+        self._evict()
+        return session
+
+    def get(self, session_id: str) -> EditorSession:
+        path = self._path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > AI_SESSION_TTL:
+                raise FileNotFoundError(path)
+            with open(path) as f:
+                record = json.load(f)
+            os.utime(path, None)
+        except (OSError, ValueError):
+            raise HTTPException(status_code=404, detail="Unknown or expired session")
+        return EditorSession(record["language"], record["code"], session_id, record["version"], record["unparsable"])
+
+    def edit(self, session_id: str, version: int | None, edits: list[AISessionEdit]) -> EditorSession:
+        with self._locked():
+            session = self.get(session_id)
+            session.apply(version, edits)
+            self._write(session)
+        return session
+
+    def mark_unparsable(self, session_id: str, keys: list[str]) -> None:
+        """Remember chunks whose answer couldn't be parsed, for whichever worker serves the session next."""
+        with self._locked():
+            try:
+                session = self.get(session_id)
+            except HTTPException:
+                return  # closed or expired meanwhile
+            session.unparsable += [key for key in keys if key not in session.unparsable]
+            self._write(session)
+
+    def close(self, session_id: str) -> None:
+        try:
+            os.remove(self._path(session_id))
+        except OSError:
+            pass
+
+
+editor_sessions = EditorSessions(AI_SESSION_DIR)
+
+
+async def analyze_chunk(req: AISuggestRequest, chunk: dict, outline: str, cache_key: str) -> AISuggestResponse | None:
+    """The model's answer for one chunk; None when the answer can't be parsed."""
+    context = (f"This is `{chunk['name']}` (lines {chunk['start']}-{chunk['end']}) of a longer file; "
+               f"the other parts are reviewed separately. File outline:\n{outline}")
+    prompt = build_suggest_prompt(req, chunk["text"], context=context)
+
+    async def answer(publish):
+        text = await get_llm_response(prompt)
+        try:
+            result = suggest_from_parsed(loads_lenient(clean_llm_json(text)))
+        except Exception as parse_error:
+            print(f"[DEBUG] Chunk {chunk['name']} answer parsing failed: {parse_error}")
+            print(f"[DEBUG] Raw response: {text[:200]}...")
+            return None
+        await ai_cache.aput(cache_key, result.model_dump())
+        return result
+
+    return await ai_flights.run(cache_key, answer, AISuggestResponse)
+
+
+def _merge_items(groups: list[tuple[str | None, list[str] | None]]) -> list[str]:
+    merged = []
+    for prefix, items in groups:
+        for item in items or []:
+            item = f"{prefix}: {item}" if prefix else item
+            if item not in merged:
+                merged.append(item)
+    return merged[:AI_SESSION_MAX_ITEMS]
+
+
+def merge_chunk_answers(chunks: list[dict], answers: dict[int, AISuggestResponse], focus: int | None) -> AISuggestResponse:
+    """One response from per-chunk answers; the chunk at the cursor (else the largest) leads."""
+    at = chunk_at(chunks, focus)
+    order = sorted(answers, key=lambda i: (i != at, -len(chunks[i]["text"]), i))
+    lead = answers[order[0]]
+    named = len(answers) > 1
+    scalars = {
+        field: next((getattr(answers[i], field) for i in order if getattr(answers[i], field)), None)
+        for field in ("explanation", "problemUnderstanding", "bestApproach", "algorithmName",
+                      "timeComplexity", "spaceComplexity", "whyThisApproach")
+    }
+    return AISuggestResponse(
+        suggestions=_merge_items([(chunks[i]["name"] if named else None, answers[i].suggestions) for i in order]),
+        qualityNotes=_merge_items([(None, answers[i].qualityNotes) for i in order]),
+        variables=_merge_items([(None, answers[i].variables) for i in order]),
+        **{**scalars, "explanation": scalars["explanation"] or lead.explanation},
+    )
+
+
+async def session_suggest(session: EditorSession, req: AISessionSuggestRequest) -> AISuggestResponse:
+    whole = AISuggestRequest(language=session.language, code=session.code, cursor=req.cursor,
+                             goal=req.goal, hints=req.hints)
+    chunks = session.chunks()
+    if len(chunks) <= 1:
+        return await ai_suggest(whole)
+    if not ai_router.candidates():
+        return mock_suggest_response()
+
+    focus = cursor_line(session.code, req.cursor)
+    keys = [ai_cache_key("suggest-chunk", session.language, chunk["text"], goal=req.goal, hints=req.hints or [])
+            for chunk in chunks]
+    answers, missing = {}, []
+    for i, key in enumerate(keys):
+        cached = await ai_cache.aget(key)
+        if cached is not None:
+            answers[i] = AISuggestResponse(**cached)
+        elif key not in session.unparsable:  # not re-sent (and billed) until the chunk changes
+            missing.append(i)
+    reused = len(answers)
+    # The chunk being edited first, then outward from the cursor
+    at = chunk_at(chunks, focus)
+    missing.sort(key=lambda i: (i != at, abs(chunks[i]["start"] - focus) if focus else 0))
+    batch = missing[:AI_SESSION_MAX_CHUNKS]
+    outline = file_outline(session.language, session.code)
+    results = await asyncio.gather(*(analyze_chunk(whole, chunks[i], outline, keys[i]) for i in batch),
+                                   return_exceptions=True)
+    failures, unparsable = [], []
+    for i, result in zip(batch, results):
+        if isinstance(result, BaseException):
+            print(f"[DEBUG] Session {session.id[:8]}: chunk {chunks[i]['name']} failed: {result!r}")
+            failures.append(result)
+        elif result is None:
+            unparsable.append(keys[i])
+        else:
+            answers[i] = result
+    if unparsable:
+        session.unparsable += unparsable
+        await asyncio.to_thread(editor_sessions.mark_unparsable, session.id, unparsable)
+    failed = sum(key in session.unparsable for key in keys) + len(failures)
+    counts = {"analyzed": len(answers) - reused, "reused": reused, "failed": failed,
+              "pending": len(chunks) - len(answers) - failed}
+    print(f"[DEBUG] Session {session.id[:8]}: chunks {counts}")
+    if not answers:
+        if failures:
+            raise failures[0]
+        fallback = suggest_parse_fallback()
+        fallback.chunks = counts
+        return fallback
+    merged = merge_chunk_answers(chunks, answers, focus)
+    merged.chunks = counts
+    return merged
+
+
+@app.post("/ai/sessions", response_model=AISessionResponse)
+def create_ai_session(req: AISessionCreateRequest):
+    if req.language.lower() not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail="Unsupported language")
+    return editor_sessions.create(req.language, req.code).response()
+
+
+@app.patch("/ai/sessions/{session_id}", response_model=AISessionResponse)
+def edit_ai_session(session_id: str, req: AISessionEditRequest):
+    return editor_sessions.edit(session_id, req.version, req.edits).response()
+
+
+@app.delete("/ai/sessions/{session_id}")
+def close_ai_session(session_id: str):
+    editor_sessions.close(session_id)
+    return {"closed": True}
+
+
+@app.post("/ai/sessions/{session_id}/suggest", response_model=AISuggestResponse)
+async def ai_session_suggest(session_id: str, req: AISessionSuggestRequest):
+    if req.edits:
+        session = await asyncio.to_thread(editor_sessions.edit, session_id, req.version, req.edits)
+    else:
+        session = await asyncio.to_thread(editor_sessions.get, session_id)
+    try:
+        return await session_suggest(session, req)
+    except HTTPException:
+        raise
+    except ProviderUnavailable as e:
+        print(f"[DEBUG] {e}, returning mock response")
+        return mock_suggest_response()
+    except httpx.TimeoutException as timeout_error:
+        print(f"[DEBUG] Request timeout: {timeout_error}")
+        raise HTTPException(status_code=504, detail=create_fallback_response("AI service timeout - please try again"))
+    except httpx.HTTPError as req_error:
+        print(f"[DEBUG] Request error: {req_error}")
+        raise HTTPException(status_code=503, detail=create_fallback_response("Unable to connect to AI service"))
+    except Exception as e:
+        print(f"[DEBUG] Unexpected error: {e}")
+        raise HTTPException(status_code=500, detail=create_fallback_response(f"AI service error: {str(e)}"))
+
+
+# -------- AI: token streaming --------
+# /ai/suggest/stream and /ai/explain/stream relay the answer while the model is
+# still writing it, as server-sent events:
+#   delta  {"field", "text"}   more text of a top-level string field
+#   field  {"field", "value"}  a field is complete (normalized like the final answer)
+#   done   {"response"}        the full response, same shape as the plain endpoint
+#   error  {"status", "detail"}
+# Cache and similarity hits, mock answers and fallbacks are sent as a lone `done`.
+
+# An unfinished escape at the end of a partial string, or the high half of a
+# surrogate pair whose low half hasn't arrived yet
+_PARTIAL_ESCAPE = re.compile(r'(\\u[dD][89abAB][0-9a-fA-F]{2})?(\\(u[0-9a-fA-F]{0,3})?)?$')
+_TRAILING_COMMA = re.compile(r',\s*([\]}])')
+
+
+def loads_lenient(text: str):
+    """json.loads that accepts raw control characters and trailing commas."""
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        return json.loads(_TRAILING_COMMA.sub(r'\1', text), strict=False)
+
+
+class IncrementalJSONFields:
+    """Pulls top-level fields out of a JSON object that is still being generated.
+
+    Text before the opening brace (prose, a ``` fence) is skipped and anything
+    after the closing brace ignored. feed() returns ("delta", key, text) events
+    while a top-level string value is being written and ("field", key, value)
+    events as soon as a value is complete.
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+        self.expect = "key"  # at depth 1: "key" | "colon" | "value" | "comma"
+        self.key: str | None = None
+        self.start: int | None = None  # where the current key or value began
+        self.sent = 0  # decoded characters of the current string value already sent
+        self.fields: dict = {}
+
+    def _finish_value(self, end: int, events: list) -> None:
+        raw = self.buf[self.start:end].strip()
+        self.expect = "comma"
+        try:
+            value = loads_lenient(raw)
+        except ValueError:
+            return  # drop a malformed field but keep reading the others
+        if isinstance(value, str) and len(value) > self.sent:
+            events.append(("delta", self.key, value[self.sent:]))
+        self.fields[self.key] = value
+        events.append(("field", self.key, value))
+
+    def feed(self, chunk: str) -> list[tuple[str, str, object]]:
+        events = []
+        self.buf += chunk
+        for i in range(self.pos, len(self.buf)):
+            if self.closed:
+                break
+            c = self.buf[i]
+            if self.depth == 0:
+                if c == "{":
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.expect == "key":
+                        self.key = loads_lenient(self.buf[self.start:i + 1])
+                        self.expect = "colon"
+                    elif self.depth == 1 and self.expect == "value":
+                        self._finish_value(i + 1, events)
+                continue
+            if c == '"':
+                self.in_string = True
+                if self.depth == 1 and self.expect in ("key", "value"):
+                    self.start = i
+                    self.sent = 0
+            elif c in "{[":
+                if self.depth == 1 and self.expect == "value":
+                    self.start = i
+                self.depth += 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 1 and self.expect == "value":
+                    self._finish_value(i + 1, events)
+                elif self.depth == 0:
+                    if self.expect == "value" and self.start is not None:
+                        self._finish_value(i, events)  # scalar as the last field
+                    self.closed = True
+            elif self.depth == 1:
+                if c == ":" and self.expect == "colon":
+                    self.expect = "value"
+                    self.start = None
+                elif c == ",":
+                    if self.expect == "value" and self.start is not None:
+                        self._finish_value(i, events)
+                    self.expect = "key"
+                elif self.expect == "value" and self.start is None and not c.isspace():
+                    self.start = i  # number, true/false/null
+        self.pos = len(self.buf)
+
+        if self.in_string and self.depth == 1 and self.expect == "value":
+            raw = _PARTIAL_ESCAPE.sub("", self.buf[self.start + 1:])
+            try:
+                text = json.loads(f'"{raw}"', strict=False)
+            except ValueError:
+                text = ""
+            if len(text) > self.sent:
+                events.append(("delta", self.key, text[self.sent:]))
+                self.sent = len(text)
+        return events
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_ai_answer(prompt: str, model: type[BaseModel], build, parse_fallback, cache_key: str,
+                           scope: str, signature: list[int] | None):
+    """Relay one model answer as SSE events; yields the final response model last."""
+    parser = IncrementalJSONFields()
+    pieces = []
+    async for piece in stream_llm_response(prompt):
+        pieces.append(piece)
+        for kind, name, value in parser.feed(piece):
+            if kind == "delta":
+                yield sse_event("delta", {"field": name, "text": value})
+            elif name in model.model_fields:
+                # Normalize the lone field the same way the final answer will be
+                normalized = build({name: value}).model_dump()[name]
+                yield sse_event("field", {"field": name, "value": normalized})
+
+    text = "".join(pieces)
+    parsed = parser.fields
+    if not parser.closed:
+        try:
+            parsed = json.loads(clean_llm_json(text))
+        except ValueError:
+            pass  # truncated answer: keep the fields that did complete
+    if not parsed:
+        print(f"[DEBUG] Streamed response had no JSON fields: {text[:200]}...")
+        yield parse_fallback()
+        return
+    result = build(parsed)
+    await ai_cache.aput(cache_key, result.model_dump())
+    if signature is not None:
+        similarity_index.add(scope, signature, cache_key)
+    yield result
+
+
+def stream_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/ai/suggest/stream")
+async def ai_suggest_stream(req: AISuggestRequest):
+    provider = get_ai_provider()
+    prompt, cache_key, scope = prepare_suggest(req)
+
+    async def events():
+        cached = await ai_cache.aget(cache_key)
+        if cached is not None:
+            yield sse_event("done", {"response": cached})
+            return
+        similar, similarity, signature = await asyncio.to_thread(similarity_lookup, req.language, req.code, scope)
+        if similar is not None:
+            response = {**similar, "reused": True, "similarity": round(similarity, 3)}
+            yield sse_event("done", {"response": response})
+            return
+        if not ai_router.candidates():
+            yield sse_event("done", {"response": mock_suggest_response().model_dump()})
+            return
+        try:
+            async def answer(publish):
+                async for item in stream_ai_answer(prompt, AISuggestResponse, suggest_from_parsed,
+                                                   suggest_parse_fallback, cache_key, scope, signature):
+                    if not isinstance(item, str):
+                        return item
+                    publish(item)
+
+            # A request already in flight (streaming or not) is joined instead of repeated
+            flight = ai_flights.start(cache_key, answer, AISuggestResponse)
+            async for item in ai_flights.follow(flight):
+                if isinstance(item, str):
+                    yield item
+                else:
+                    yield sse_event("done", {"response": item.model_dump()})
+        except ProviderUnavailable as e:
+            print(f"[DEBUG] {e}, returning mock response")
+            yield sse_event("done", {"response": mock_suggest_response().model_dump()})
+        except httpx.TimeoutException as e:
+            print(f"[DEBUG] Request timeout: {e}")
+            yield sse_event("error", {"status": 504, "detail": create_fallback_response("AI service timeout - please try again")})
+        except httpx.HTTPError as e:
+            print(f"[DEBUG] Request error: {e}")
+            yield sse_event("error", {"status": 503, "detail": create_fallback_response("Unable to connect to AI service")})
+        except Exception as e:
+            print(f"[DEBUG] Unexpected error: {e}")
+            yield sse_event("error", {"status": 500, "detail": create_fallback_response(f"AI service error: {str(e)}")})
+
+    return stream_response(events())
+
+
+@app.post("/ai/explain/stream")
+async def ai_explain_stream(req: AIExplainRequest):
+    instant = instant_explanation(req.language, req.code, req.error)
+    prompt, cache_key, scope = prepare_explain(req) if instant is None else (None, None, None)
+
+    async def events():
+        if instant is not None:
+            yield sse_event("done", {"response": instant.model_dump()})
+            return
+        cached = await ai_cache.aget(cache_key)
+        if cached is not None:
+            yield sse_event("done", {"response": cached})
+            return
+        similar, similarity, signature = await asyncio.to_thread(similarity_lookup, req.language, req.code, scope)
+        if similar is not None:
+            response = {**similar, "reused": True, "similarity": round(similarity, 3)}
+            yield sse_event("done", {"response": response})
+            return
+        try:
+            async def answer(publish):
+                async for item in stream_ai_answer(prompt, AIExplainResponse, explain_from_parsed,
+                                                   explain_parse_fallback, cache_key, scope, signature):
+                    if not isinstance(item, str):
+                        return item
+                    publish(item)
+
+            # A request already in flight (streaming or not) is joined instead of repeated
+            flight = ai_flights.start(cache_key, answer, AIExplainResponse)
+            async for item in ai_flights.follow(flight):
+                if isinstance(item, str):
+                    yield item
+                else:
+                    yield sse_event("done", {"response": item.model_dump()})
+        except Exception as e:
+            print(f"[DEBUG] Error explanation failed: {e}")
+            yield sse_event("done", {"response": explain_unavailable_response().model_dump()})
+
+    return stream_response(events())
 
 
 # ---------- Recommendations & Hints ----------
@@ -0,0 +1,42 @@
+import asyncio
+import threading
+
+from app.main import AIResponseCache
+
+
+def make_cache(tmp_path) -> AIResponseCache:
+    return AIResponseCache(str(tmp_path), ttl=60, memory_items=8, max_bytes=1024 * 1024)
+
+
+def test_aget_reads_the_disk_tier_off_the_event_loop(tmp_path, monkeypatch):
+    make_cache(tmp_path).put("k", {"answer": 42})
+    cache = make_cache(tmp_path)  # empty memory tier, same directory
+    threads = []
+    disk_get = cache._disk_get
+
+    def recording_disk_get(key, count):
+        threads.append(threading.current_thread())
+        return disk_get(key, count)
+
+    monkeypatch.setattr(cache, "_disk_get", recording_disk_get)
+
+    async def go():
+        return await cache.aget("k"), await cache.aget("k"), await cache.aget("missing")
+
+    assert asyncio.run(go()) == ({"answer": 42}, {"answer": 42}, None)
+    assert len(threads) == 2  # the second lookup was a memory hit
+    assert threading.main_thread() not in threads
+    assert (cache.stats["memoryHits"], cache.stats["diskHits"], cache.stats["misses"]) == (1, 1, 1)
+
+
+def test_aput_is_read_back_by_another_process_cache(tmp_path):
+    asyncio.run(make_cache(tmp_path).aput("k", {"answer": 42}))
+    assert make_cache(tmp_path).get("k") == {"answer": 42}
+
+
+def test_polling_lookups_leave_the_stats_alone(tmp_path):
+    cache = make_cache(tmp_path)
+    asyncio.run(cache.aget("missing", count=False))
+    cache.put("k", {"answer": 42})
+    asyncio.run(cache.aget("k", count=False))
+    assert cache.stats["memoryHits"] == cache.stats["misses"] == 0
@@ -0,0 +1,155 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import main
+from app.main import AIRouter, ProviderHealth, ProviderUnavailable
+
+
+class FakeProviders:
+    """Stands in for the three provider calls: each answers with its name after `delays[name]` seconds."""
+
+    def __init__(self, monkeypatch, delays: dict[str, float], errors: dict[str, Exception] | None = None):
+        self.delays = delays
+        self.errors = errors or {}
+        self.started: list[str] = []
+        self.cancelled: list[str] = []
+        monkeypatch.setattr(main, "get_ollama_response", lambda prompt: self.answer("ollama"))
+        monkeypatch.setattr(main, "get_openai_response", lambda prompt, key: self.answer("openai"))
+        monkeypatch.setattr(main, "get_anthropic_response", lambda prompt, key: self.answer("anthropic"))
+
+    async def answer(self, name: str) -> str:
+        self.started.append(name)
+        try:
+            await asyncio.sleep(self.delays[name])
+        except asyncio.CancelledError:
+            self.cancelled.append(name)
+            raise
+        if name in self.errors:
+            raise self.errors[name]
+        return f"answer from {name}"
+
+
+@pytest.fixture
+def health(monkeypatch):
+    """Fresh provider state, all three providers configured and routed over."""
+    health = {name: ProviderHealth(name) for name in main.AI_PROVIDERS}
+    monkeypatch.setattr(main, "provider_health", health)
+    monkeypatch.setattr(main, "get_ai_provider", lambda: "auto")
+    monkeypatch.setattr(main, "AI_ROUTE_PROVIDERS", list(main.AI_PROVIDERS))
+    monkeypatch.setattr(main, "provider_configured", lambda name: True)
+    monkeypatch.setattr(main, "AI_HEDGE", False)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    return health
+
+
+def measured(health: dict, **latency_ms: float) -> None:
+    for name, ms in latency_ms.items():
+        for _ in range(main.AI_HEDGE_MIN_SAMPLES):
+            health[name].record_success(ms / 1000)
+
+
+def open_circuit(health: ProviderHealth) -> None:
+    for _ in range(main.AI_BREAKER_FAILURES):
+        health.record_failure(httpx.ConnectError("refused"))
+
+
+def test_rank_prefers_unmeasured_then_fastest(health):
+    measured(health, ollama=300, openai=100)
+    assert AIRouter().rank() == ["anthropic", "openai", "ollama"]
+    measured(health, anthropic=200)
+    assert AIRouter().rank() == ["openai", "anthropic", "ollama"]
+    assert AIRouter().rank(exclude=["openai"]) == ["anthropic", "ollama"]
+
+
+def test_errors_busy_providers_and_open_breakers_drop_in_the_ranking(health, monkeypatch):
+    measured(health, ollama=400, openai=100, anthropic=200)
+    for _ in range(main.AI_HEDGE_MIN_SAMPLES // 2):
+        health["openai"].outcomes.append(False)  # a 1/3 error rate inflates 100ms to ~167ms
+    assert AIRouter().rank() == ["openai", "anthropic", "ollama"]
+    for _ in range(main.AI_LATENCY_WINDOW):
+        health["openai"].outcomes.append(False)  # failing every call: 300ms
+    assert AIRouter().rank() == ["anthropic", "openai", "ollama"]
+
+    health["anthropic"].slots = asyncio.Semaphore(0)  # at its concurrency limit
+    assert AIRouter().rank() == ["openai", "ollama", "anthropic"]
+
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 60)
+    open_circuit(health["ollama"])
+    assert AIRouter().rank() == ["openai", "anthropic"]
+
+
+def test_fastest_provider_answers(health, monkeypatch):
+    providers = FakeProviders(monkeypatch, {"ollama": 0, "openai": 0, "anthropic": 0})
+    measured(health, ollama=300, openai=100, anthropic=200)
+    assert asyncio.run(AIRouter().complete("prompt")) == "answer from openai"
+    assert providers.started == ["openai"]
+    assert health["openai"].in_flight == 0 and len(health["openai"].samples) == main.AI_HEDGE_MIN_SAMPLES + 1
+
+
+def test_failed_call_fails_over_to_the_next_provider(health, monkeypatch):
+    providers = FakeProviders(monkeypatch, {"ollama": 0, "openai": 0, "anthropic": 0},
+                              errors={"openai": httpx.ConnectError("refused")})
+    measured(health, ollama=300, openai=100, anthropic=200)
+    assert asyncio.run(AIRouter().complete("prompt")) == "answer from anthropic"
+    assert providers.started == ["openai", "anthropic"]
+    assert health["openai"].failures == 1 and health["openai"].last_error == "refused"
+
+
+def test_all_providers_failing_raises_the_last_error(health, monkeypatch):
+    errors = {name: httpx.ConnectError(f"{name} refused") for name in main.AI_PROVIDERS}
+    FakeProviders(monkeypatch, {"ollama": 0, "openai": 0, "anthropic": 0}, errors=errors)
+    measured(health, ollama=300, openai=100, anthropic=200)
+    with pytest.raises(httpx.ConnectError, match="ollama refused"):
+        asyncio.run(AIRouter().complete("prompt"))
+
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 60)
+    for name in main.AI_PROVIDERS:
+        open_circuit(health[name])
+    with pytest.raises(ProviderUnavailable):
+        asyncio.run(AIRouter().complete("prompt"))
+
+
+def test_slow_provider_is_hedged_and_the_loser_cancelled(health, monkeypatch):
+    monkeypatch.setattr(main, "AI_HEDGE", True)
+    monkeypatch.setattr(main, "AI_HEDGE_MIN_MS", 50)
+    providers = FakeProviders(monkeypatch, {"ollama": 10, "openai": 10, "anthropic": 0.01})
+    measured(health, ollama=300, openai=10, anthropic=200)
+    assert AIRouter().hedge_delay("openai") == 0.05  # p90 of 10ms, raised to AI_HEDGE_MIN_MS
+
+    assert asyncio.run(AIRouter().complete("prompt")) == "answer from anthropic"
+    assert providers.started == ["openai", "anthropic"] and providers.cancelled == ["openai"]
+    # The loser's time until cancellation still counts against it
+    assert health["openai"].samples[-1] >= 50 and health["openai"].in_flight == 0
+    assert health["openai"].failures == 0 and health["openai"].state == "closed"
+
+
+def test_half_open_trial_is_released_when_the_call_is_cancelled(health, monkeypatch):
+    monkeypatch.setattr(main, "AI_HEDGE", True)
+    monkeypatch.setattr(main, "AI_HEDGE_MIN_MS", 50)
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 0)
+    providers = FakeProviders(monkeypatch, {"ollama": 10, "openai": 10, "anthropic": 0.01})
+    measured(health, ollama=300, openai=10, anthropic=200)
+    open_circuit(health["openai"])
+
+    # openai takes the trial, loses the hedge race, and the trial is free again
+    assert asyncio.run(AIRouter().complete("prompt")) == "answer from anthropic"
+    assert providers.cancelled == ["openai"]
+    assert health["openai"].state == "half_open" and not health["openai"].trial_in_flight
+
+    providers.delays["openai"] = 0
+    assert asyncio.run(AIRouter().complete("prompt")) == "answer from openai"
+    assert health["openai"].state == "closed"
+
+
+def test_failed_half_open_trial_reopens_the_circuit(health, monkeypatch):
+    monkeypatch.setattr(main, "get_ai_provider", lambda: "openai")
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 0)
+    FakeProviders(monkeypatch, {"ollama": 0, "openai": 0, "anthropic": 0},
+                  errors={"openai": httpx.ReadTimeout("slow")})
+    open_circuit(health["openai"])
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(AIRouter().complete("prompt"))
+    assert health["openai"].state == "open" and not health["openai"].trial_in_flight
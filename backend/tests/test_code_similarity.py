@@ -0,0 +1,153 @@
+from app import main
+from app.main import SimilarityIndex, code_fingerprint_tokens, minhash_signature, normalize_code
+
+TWO_SUM = """
+def two_sum(nums, target):
+    seen = {}
+    for i, value in enumerate(nums):
+        need = target - value
+        if need in seen:
+            return [seen[need], i]
+        seen[value] = i
+    return []
+
+print(two_sum([2, 7, 11, 15], 9))
+"""
+
+# Same program: other names, other constants, comments and formatting
+TWO_SUM_RENAMED = """
+def find_pair(arr, goal):   # hash map of values seen so far
+    index_of = {}
+    for j, x in enumerate(arr):
+        need = goal - x
+        if need in index_of:
+            return [index_of[need], j]
+        index_of[x] = j
+    return []
+
+
+print(find_pair([3, 2, 4, 8], 6))
+"""
+
+BUBBLE_SORT = """
+def bubble(a):
+    n = len(a)
+    for i in range(n):
+        for j in range(n - i - 1):
+            if a[j] > a[j + 1]:
+                a[j], a[j + 1] = a[j + 1], a[j]
+    return a
+
+print(bubble([5, 1, 4, 2, 8]))
+"""
+
+CPP_SUM = """
+#include <bits/stdc++.h>
+using namespace std;
+int main() {
+    int n; cin >> n;            // count
+    vector<long long> values(n);
+    long long total = 0;
+    for (int i = 0; i < n; i++) { cin >> values[i]; total += values[i]; }
+    cout << total << endl;
+    return 0;
+}
+"""
+
+CPP_SUM_RENAMED = """
+#include <bits/stdc++.h>
+using namespace std;
+/* read and add up */
+int main()
+{
+    int count;
+    cin >> count;
+    vector<long long> xs(count);
+    long long acc = 0;
+    for (int k = 0; k < count; k++)
+    {
+        cin >> xs[k];
+        acc += xs[k];
+    }
+    cout << acc << endl;
+    return 0;
+}
+"""
+
+
+def similarity(a: list[int], b: list[int]) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def signature(language: str, code: str) -> list[int]:
+    return minhash_signature(code_fingerprint_tokens(language, code))
+
+
+def test_normalize_ignores_formatting_and_comments():
+    assert normalize_code("python", "x=1 # one\n\n\nprint( x )\n") == normalize_code("python", "x = 1\nprint(x)")
+    assert normalize_code("cpp", "int  x = a - -b; // note\n") == "int x=a- -b;"
+    assert normalize_code("cpp", CPP_SUM) != normalize_code("cpp", CPP_SUM.replace("+=", "-="))
+
+
+def test_broken_python_keeps_its_indentation():
+    broken = "def f():\n# comment\nreturn 1  # why\n\n"
+    assert normalize_code("python", broken) == "def f():\nreturn 1"
+    assert normalize_code("python", broken) != normalize_code("python", "def f():\n    return 1\n")
+
+
+def test_renamed_code_has_the_same_fingerprint():
+    assert code_fingerprint_tokens("python", TWO_SUM) == code_fingerprint_tokens("python", TWO_SUM_RENAMED)
+    assert code_fingerprint_tokens("cpp", CPP_SUM) == code_fingerprint_tokens("cpp", CPP_SUM_RENAMED)
+    assert len(code_fingerprint_tokens("python", TWO_SUM)) >= main.AI_SIMILARITY_MIN_TOKENS
+
+
+def test_edits_lower_the_similarity_and_unrelated_code_is_far_off():
+    base = signature("python", TWO_SUM)
+    assert signature("python", TWO_SUM.replace("], 9)", "], 26)")) == base  # literals are collapsed
+    edited = signature("python", TWO_SUM.replace("return []", "return None"))
+    # A changed line is still found by the LSH bands, but is no longer reused
+    assert 0.6 < similarity(base, edited) < main.AI_SIMILARITY_THRESHOLD
+    index = SimilarityIndex(max_items=10)
+    index.add("explain", base, "two-sum")
+    assert index.nearest("explain", edited) == (None, similarity(base, edited))
+    assert similarity(base, signature("python", BUBBLE_SORT)) < 0.3
+    assert similarity(signature("cpp", CPP_SUM), base) < 0.3
+
+
+def test_index_finds_near_duplicates_within_their_scope():
+    index = SimilarityIndex(max_items=10)
+    index.add("explain", signature("python", TWO_SUM), "two-sum")
+    index.add("explain", signature("python", BUBBLE_SORT), "bubble")
+    assert index.nearest("explain", signature("python", TWO_SUM_RENAMED)) == ("two-sum", 1.0)
+    assert index.nearest("optimize", signature("python", TWO_SUM_RENAMED)) == (None, 0.0)
+    key, best = index.nearest("explain", signature("python", "print('hello, world')\n" * 8))
+    assert key is None and best < main.AI_SIMILARITY_THRESHOLD
+
+
+def test_index_is_bounded_and_forgets_discarded_keys():
+    index = SimilarityIndex(max_items=2)
+    programs = {"two-sum": TWO_SUM, "bubble": BUBBLE_SORT, "cpp-sum": CPP_SUM}
+    for key, code in programs.items():
+        index.add("explain", signature("python", code), key)
+    assert list(index.entries) == ["bubble", "cpp-sum"]
+    assert index.nearest("explain", signature("python", TWO_SUM))[0] is None
+    index.discard("bubble")
+    assert index.nearest("explain", signature("python", BUBBLE_SORT))[0] is None
+    assert all(bucket <= {"cpp-sum"} for bucket in index.bands.values())
+
+
+def test_lookup_drops_keys_whose_answer_expired(monkeypatch):
+    index = SimilarityIndex(max_items=10)
+    answers = {"two-sum": {"explanation": "hash map"}}
+    monkeypatch.setattr(main, "similarity_index", index)
+    monkeypatch.setattr(main.ai_cache, "get", lambda key, count=True: answers.get(key))
+    index.add("explain", signature("python", TWO_SUM), "two-sum")
+
+    value, best, sig = main.similarity_lookup("python", TWO_SUM_RENAMED, "explain")
+    assert value == answers["two-sum"] and best == 1.0 and sig == signature("python", TWO_SUM)
+
+    answers.clear()
+    assert main.similarity_lookup("python", TWO_SUM_RENAMED, "explain")[0] is None
+    assert "two-sum" not in index.entries
+    assert index.stats == {"similarHits": 1, "similarMisses": 1}
+    assert main.similarity_lookup("python", "print(1)\n", "explain") == (None, 0.0, None)
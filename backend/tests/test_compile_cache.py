@@ -0,0 +1,77 @@
+import os
+import subprocess
+
+import pytest
+
+from app import main
+
+SOURCE = "int main() { return 0; }\n"
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "COMPILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "get_compiler_version", lambda compiler: "g++ 13.2.0")
+    return tmp_path
+
+
+class FakeCompiler:
+    """Stands in for g++: writes an a.exe of `size` bytes, or fails on sources containing 'error'."""
+
+    def __init__(self, size=16):
+        self.size = size
+        self.calls = []
+
+    def __call__(self, cmd, cwd=None):
+        self.calls.append(cmd)
+        src, out = cmd[1], cmd[cmd.index("-o") + 1]
+        with open(src) as f:
+            if "error" in f.read():
+                return subprocess.CompletedProcess(cmd, 1, "", "main.cpp:1:1: error: expected ';'")
+        with open(out, "wb") as f:
+            f.write(b"\0" * self.size)
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+
+
+def entries(cache_dir) -> list[str]:
+    return sorted(name for name in os.listdir(cache_dir) if not name.startswith("."))
+
+
+def test_same_source_compiles_once(cache_dir):
+    compiler = FakeCompiler()
+    first, err = main.compile_cpp(SOURCE, run=compiler)
+    again, _ = main.compile_cpp(SOURCE, run=compiler)
+    assert err is None and first == again and len(compiler.calls) == 1
+    assert os.path.isfile(os.path.join(first, "a.exe"))
+    # Builds are published by renaming their .build-* dir; none are left behind
+    assert sorted(os.listdir(cache_dir)) == [".lock", os.path.basename(first)]
+
+
+def test_flags_and_compiler_version_change_the_key(cache_dir, monkeypatch):
+    compiler = FakeCompiler()
+    plain, _ = main.compile_cpp(SOURCE, run=compiler)
+    profiled, _ = main.compile_cpp(SOURCE, main.CPP_PROFILE_FLAGS, run=compiler)
+    monkeypatch.setattr(main, "get_compiler_version", lambda compiler: "g++ 14.1.0")
+    upgraded, _ = main.compile_cpp(SOURCE, run=compiler)
+    assert len({plain, profiled, upgraded}) == 3 and len(compiler.calls) == 3
+
+
+def test_failed_compile_is_not_cached(cache_dir):
+    compiler = FakeCompiler()
+    for _ in range(2):
+        artifact, err = main.compile_cpp("int main() { error }\n", run=compiler)
+        assert artifact is None and "expected ';'" in err
+    assert len(compiler.calls) == 2 and entries(cache_dir) == []
+
+
+def test_least_recently_used_builds_are_evicted(cache_dir, monkeypatch):
+    monkeypatch.setattr(main, "COMPILE_CACHE_MAX_BYTES", 300)  # two builds: a.exe plus main.cpp each
+    compiler = FakeCompiler(size=100)
+    sources = [SOURCE + f"// {i}\n" for i in range(3)]
+    first, second = (main.compile_cpp(code, run=compiler)[0] for code in sources[:2])
+    os.utime(second, (1, 1))
+    os.utime(first, (2, 2))
+    # Above the cap the oldest by use goes first: here the second build
+    third, _ = main.compile_cpp(sources[2], run=compiler)
+    assert entries(cache_dir) == sorted(os.path.basename(p) for p in (first, third))
+    assert main.compile_cpp(sources[0], run=compiler)[0] == first and len(compiler.calls) == 3
@@ -0,0 +1,65 @@
+import math
+import random
+
+import pytest
+
+from app.main import COMPLEXITY_MIN_SIGNAL_MS, best_complexity, fit_growth
+
+NS = [1000 * 3 ** i for i in range(7)]  # 1000 .. 729000
+
+
+def timings(f, startup_ms: float = 30.0, noise: float = 0.05, seed: int = 1) -> list[float]:
+    """Startup cost plus f(n), scaled so the largest size takes 2s, with relative noise."""
+    rng = random.Random(seed)
+    scale = 2000 / f(NS[-1])
+    return [(startup_ms + scale * f(n)) * (1 + rng.uniform(-noise, noise)) for n in NS]
+
+
+@pytest.mark.parametrize("expected, f", [
+    ("O(n)", lambda n: n),
+    ("O(n log n)", lambda n: n * math.log2(n)),
+    ("O(n^2)", lambda n: n ** 2),
+])
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_recovers_the_class_of_synthetic_timings(expected, f, seed):
+    fit = best_complexity(NS, timings(f, seed=seed), COMPLEXITY_MIN_SIGNAL_MS)
+    assert fit.complexity == expected and fit.note is None
+
+
+def test_exact_data_fits_perfectly():
+    fits = fit_growth(NS, timings(lambda n: n, noise=0))
+    rss, r2 = fits[2]  # O(n)
+    assert rss < 1e-12 and r2 == pytest.approx(1)
+    assert all(other_rss > rss for other_rss, _ in fits[:2] + fits[3:])
+    assert best_complexity(NS, timings(lambda n: n, noise=0), COMPLEXITY_MIN_SIGNAL_MS).confidence > 0.9
+
+
+def test_fit_is_on_relative_error():
+    # 1/y^2 weights: a machine twice as slow gives the same residuals, so the
+    # seconds-long largest sizes can't outweigh the millisecond ones
+    ys = timings(lambda n: n * math.log2(n))
+    assert fit_growth(NS, [2 * y for y in ys]) == pytest.approx(fit_growth(NS, ys))
+
+
+@pytest.mark.parametrize("ys", [
+    [40.0] * 7,  # equal timings
+    [41.0, 38.5, 44.0, 39.0, 52.0, 40.5, 43.0],  # startup noise only
+])
+def test_no_growth_is_reported_as_constant(ys):
+    fit = best_complexity(NS, ys, COMPLEXITY_MIN_SIGNAL_MS)
+    assert fit.complexity == "O(1)" and "No measurable growth" in fit.note
+
+
+def test_equal_timings_do_not_break_the_fit():
+    fits = fit_growth(NS, [40.0] * 7)
+    assert all(math.isfinite(rss) and math.isfinite(r2) for rss, r2 in fits)
+    assert all(rss == pytest.approx(0, abs=1e-9) for rss, _ in fits)
+
+
+def test_shrinking_timings_are_flat_not_negative_growth():
+    fit = best_complexity(NS, [900, 700, 500, 300, 200, 100, 50], COMPLEXITY_MIN_SIGNAL_MS)
+    assert fit.complexity == "O(1)"
+
+
+def test_too_few_points_give_no_fit():
+    assert best_complexity(NS[:2], [10.0, 2000.0], COMPLEXITY_MIN_SIGNAL_MS) is None
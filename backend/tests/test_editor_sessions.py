@@ -0,0 +1,73 @@
+import os
+import time
+
+import pytest
+from fastapi import HTTPException
+
+from app import main
+from app.main import AISessionEdit, EditorSessions
+
+CODE = "def area(r):\n    return 3.14 * r * r\n\n\ndef perimeter(r):\n    return 2 * 3.14 * r\n\nprint(area(2))\n"
+
+
+@pytest.fixture
+def workers(tmp_path):
+    """Two server workers' session stores on the same directory."""
+    return EditorSessions(str(tmp_path)), EditorSessions(str(tmp_path))
+
+
+def test_session_created_on_one_worker_is_served_by_another(workers):
+    first, second = workers
+    session = first.create("python", CODE)
+    start = CODE.index("3.14 * r * r")
+    edited = second.edit(session.id, 0, [AISessionEdit(start=start, end=start + 4, text="math.pi")])
+    assert edited.version == 1 and "math.pi * r * r" in edited.code
+    again = first.get(session.id)
+    assert (again.version, again.code) == (1, edited.code)
+    assert sorted(chunk.name for chunk in again.response().chunks) == ["area", "perimeter", "top-level code"]
+
+
+def test_edit_against_a_stale_version_is_rejected(workers):
+    first, second = workers
+    session = first.create("python", CODE)
+    first.edit(session.id, 0, [AISessionEdit(start=0, end=0, text="# hi\n")])
+    with pytest.raises(HTTPException) as e:
+        second.edit(session.id, 0, [AISessionEdit(start=0, end=0, text="# other\n")])
+    assert e.value.status_code == 409 and e.value.detail["version"] == 1
+    assert second.get(session.id).code == "# hi\n" + CODE
+
+
+def test_unparsable_chunks_are_shared_between_workers(workers):
+    first, second = workers
+    session = first.create("python", CODE)
+    first.mark_unparsable(session.id, ["chunk-a"])
+    second.mark_unparsable(session.id, ["chunk-a", "chunk-b"])
+    assert first.get(session.id).unparsable == ["chunk-a", "chunk-b"]
+
+
+def test_closed_and_idle_sessions_are_gone(workers, monkeypatch):
+    first, second = workers
+    closed, idle = first.create("python", CODE), first.create("python", CODE)
+    second.close(closed.id)
+    path = os.path.join(first.directory, f"{idle.id}.json")
+    past = time.time() - main.AI_SESSION_TTL - 1
+    os.utime(path, (past, past))
+    for session_id in (closed.id, idle.id, "../etc/passwd"):
+        with pytest.raises(HTTPException) as e:
+            second.get(session_id)
+        assert e.value.status_code == 404
+    first.create("python", CODE)  # creating a session sweeps expired ones
+    assert not os.path.exists(path)
+
+
+def test_least_recently_used_session_is_evicted_past_the_limit(workers, monkeypatch):
+    first, second = workers
+    monkeypatch.setattr(main, "AI_SESSION_MAX", 2)
+    older, newer = first.create("python", CODE), first.create("python", CODE)
+    for i, session in enumerate((newer, older)):
+        stamp = time.time() - 10 + i
+        os.utime(os.path.join(first.directory, f"{session.id}.json"), (stamp, stamp))
+    newest = second.create("python", CODE)
+    with pytest.raises(HTTPException):
+        first.get(newer.id)
+    assert first.get(older.id).code == first.get(newest.id).code == CODE
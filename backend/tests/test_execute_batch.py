@@ -0,0 +1,77 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import main
+from app.main import BatchCaseResult, ExecutionEngine, ExecutionQueueFull
+
+PYTHON_CODE = "n = int(input())\nassert n > 0, 'n must be positive'\nprint(n * 2)\n"
+
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = ExecutionEngine(1, 8)
+    monkeypatch.setattr(main, "execution_engine", engine)
+    yield engine
+    engine.executor.shutdown(wait=True)
+
+
+def post_batch(body: dict) -> httpx.Response:
+    async def go():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=60) as client:
+            return await client.post("/execute/batch", json=body)
+
+    return asyncio.run(go())
+
+
+def test_runs_every_input(engine):
+    res = post_batch({"language": "python", "code": PYTHON_CODE, "inputs": ["1", "-2", "3"]})
+    assert res.status_code == 200
+    results = res.json()["results"]
+    assert [r["status"] for r in results] == ["ok", "error", "ok"]
+    assert [r["output"].strip() for r in (results[0], results[2])] == ["2", "6"]
+    assert "n must be positive" in results[1]["stderr"]
+
+
+def test_stop_on_failure_skips_the_remaining_cases(engine):
+    res = post_batch({"language": "python", "code": PYTHON_CODE, "inputs": ["1", "-2", "3", "4"], "stopOnFailure": True})
+    assert [r["status"] for r in res.json()["results"]] == ["ok", "error", "skipped", "skipped"]
+
+
+def test_compile_error_short_circuits_the_runs(engine, monkeypatch):
+    ran = []
+    monkeypatch.setattr(main, "run_case", lambda *args: ran.append(args))
+    monkeypatch.setattr(main, "build_submission", lambda lang, code: (None, "main.cpp:1:1: error: expected ';'"))
+    res = post_batch({"language": "cpp", "code": "int main() { return 0 }", "inputs": ["1", "2"]})
+    assert res.status_code == 200
+    assert res.json() == {"compileError": "main.cpp:1:1: error: expected ';'", "results": []}
+    assert ran == []
+
+
+def refuse_cases(engine, monkeypatch, refused: set[int]):
+    """Make the engine turn away the given case indices as if the queue were full."""
+    run = engine.run
+
+    async def run_or_refuse(fn, *args):
+        if fn is main.run_case and args[3] in refused:
+            raise ExecutionQueueFull(7)
+        return await run(fn, *args)
+
+    monkeypatch.setattr(engine, "run", run_or_refuse)
+    monkeypatch.setattr(main, "run_case", lambda lang, code, stdin, index: BatchCaseResult(index=index, status="ok"))
+
+
+def test_cases_refused_by_a_full_queue_are_busy_and_the_rest_kept(engine, monkeypatch):
+    refuse_cases(engine, monkeypatch, {1, 2})
+    res = post_batch({"language": "python", "code": PYTHON_CODE, "inputs": ["1", "2", "3", "4"]})
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json()["results"]] == ["ok", "busy", "busy", "ok"]
+
+
+def test_batch_where_nothing_ran_gets_503(engine, monkeypatch):
+    refuse_cases(engine, monkeypatch, {0, 1})
+    res = post_batch({"language": "python", "code": PYTHON_CODE, "inputs": ["1", "2"]})
+    assert res.status_code == 503
+    assert res.headers["retry-after"] == "7"
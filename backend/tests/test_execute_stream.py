@@ -0,0 +1,57 @@
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from app.main import ExecutionEngine
+
+WAITS_FOR_INPUT = "print('name?')\nname = input()\nprint('hello', name)\n"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "execution_engine", ExecutionEngine(1, 0))
+    monkeypatch.setattr(main, "stream_engine", ExecutionEngine(1, 0))
+    return TestClient(main.app)
+
+
+def receive_until_exit(ws) -> list[dict]:
+    frames = []
+    while not frames or frames[-1]["type"] not in ("exit", "error"):
+        frames.append(ws.receive_json())
+    return frames
+
+
+def test_idle_interactive_run_does_not_block_execute(client):
+    with client.websocket_connect("/execute/stream") as ws:
+        ws.send_json({"language": "python", "code": WAITS_FOR_INPUT})
+        assert ws.receive_json()["type"] == "stdout"
+        # The program now waits for stdin, holding the only stream slot
+        res = client.post("/execute", json={"language": "python", "code": "print(6 * 7)"})
+        assert res.status_code == 200
+        assert res.json()["output"].strip() == "42"
+
+        with client.websocket_connect("/execute/stream") as other:
+            other.send_json({"language": "python", "code": "print(1)"})
+            frame = other.receive_json()
+            assert frame["type"] == "error" and "queue is full" in frame["message"]
+
+        ws.send_json({"stdin": "ada\n"})
+        ws.send_json({"eof": True})
+        frames = receive_until_exit(ws)
+        assert "".join(f["data"] for f in frames if f["type"] == "stdout").endswith("hello ada\n")
+        assert frames[-1]["exitCode"] == 0
+
+
+def test_compile_step_still_takes_an_execution_slot(client, monkeypatch):
+    built = []
+
+    def build_submission(lang, code):
+        built.append(main.execution_engine.running)
+        return None, "main.cpp:1:1: error: expected ';'"
+
+    monkeypatch.setattr(main, "build_submission", build_submission)
+    with client.websocket_connect("/execute/stream") as ws:
+        ws.send_json({"language": "cpp", "code": "int main() { return 0 }"})
+        frames = receive_until_exit(ws)
+    assert built == [1]
+    assert frames[0] == {"type": "stderr", "data": "main.cpp:1:1: error: expected ';'"}
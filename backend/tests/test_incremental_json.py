@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from app.main import IncrementalJSONFields
+
+OBJECT = (
+    '{"explanation": "Uses a \\"hash\\" map\\n\\tthen \\u00e9t\\u00e9 \\\\ done \\ud83d\\ude80", '
+    '"complexity": {"time": "O(n)", "note": "braces } and ] in a string"}, '
+    '"suggestions": [["a", [1, 2]], "b}", {"c": []}], '
+    '"score": 7.5, "ok": true, "last": null}'
+)
+ANSWER = "Sure, here it is:\n```json\n" + OBJECT + "\n```\nAnything else? {\"extra\": 1}"
+EXPECTED = json.loads(OBJECT)
+
+
+def parse(chunks: list[str]) -> tuple[IncrementalJSONFields, list[tuple]]:
+    parser = IncrementalJSONFields()
+    events = []
+    for chunk in chunks:
+        events += parser.feed(chunk)
+    return parser, events
+
+
+def check(parser: IncrementalJSONFields, events: list[tuple]) -> None:
+    assert parser.closed and parser.fields == EXPECTED
+    fields = [(key, value) for kind, key, value in events if kind == "field"]
+    assert fields == list(EXPECTED.items())
+    # Streamed text adds up to the decoded string, and is complete before its field event
+    deltas = "".join(value for kind, key, value in events if kind == "delta" and key == "explanation")
+    assert deltas == EXPECTED["explanation"]
+    assert events.index(("field", "explanation", EXPECTED["explanation"])) == \
+        max(i for i, (kind, key, _) in enumerate(events) if kind == "delta") + 1
+    assert {key for kind, key, _ in events if kind == "delta"} == {"explanation"}
+
+
+def test_whole_answer_at_once():
+    check(*parse([ANSWER]))
+
+
+def test_one_character_at_a_time():
+    check(*parse(list(ANSWER)))
+
+
+@pytest.mark.parametrize("cut", range(1, len(ANSWER)))
+def test_split_at_every_boundary(cut):
+    check(*parse([ANSWER[:cut], ANSWER[cut:]]))
+
+
+def test_truncated_answer_keeps_the_completed_fields():
+    cut = ANSWER.index('"suggestions"') + len('"suggestions": [["a", [1')
+    parser, events = parse([ANSWER[:cut]])
+    assert not parser.closed
+    assert parser.fields == {"explanation": EXPECTED["explanation"], "complexity": EXPECTED["complexity"]}
+
+
+def test_malformed_field_is_dropped_and_the_rest_still_read():
+    parser, events = parse(['{"a": tru, "b": "ok", "c": [1, 2]}'])
+    assert parser.closed and parser.fields == {"b": "ok", "c": [1, 2]}
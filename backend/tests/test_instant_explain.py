@@ -0,0 +1,48 @@
+from app.main import instant_explanation
+
+JAVA_CODE = """import java.util.*;
+
+public class Solution {
+    public static void main(String[] args) {
+        int total = 0;
+        System.out.println(count);
+        Scanner in = new Scanner(System.in);
+        int n = in.nextInt();
+    }
+}
+"""
+
+
+def test_java_compile_error_line_for_class_not_named_main():
+    error = (
+        "/tmp/codex_compile_cache/.build-x/Solution.java:6: error: cannot find symbol\n"
+        "        System.out.println(count);\n"
+        "                           ^\n"
+        "  symbol:   variable count\n"
+        "  location: class Solution\n"
+        "1 error\n"
+    )
+    result = instant_explanation("java", JAVA_CODE, error)
+    assert result is not None and result.instant
+    assert result.summary.startswith("Line 6:")
+    assert result.lineFixes == ["Line 6: `System.out.println(count);` - 'count' is not declared here"]
+
+
+def test_java_runtime_error_line_skips_jdk_frames():
+    error = (
+        'Exception in thread "main" java.util.InputMismatchException\n'
+        "\tat java.base/java.util.Scanner.throwFor(Scanner.java:939)\n"
+        "\tat java.base/java.util.Scanner.nextInt(Scanner.java:2212)\n"
+        "\tat Solution.main(Solution.java:8)\n"
+    )
+    result = instant_explanation("java", JAVA_CODE, error)
+    assert result is not None
+    assert result.summary.startswith("Line 8:")
+
+
+def test_second_public_class_advice():
+    error = "Solution.java:12: error: class Helper is public, should be declared in a file named Helper.java\n"
+    result = instant_explanation("java", JAVA_CODE + "\npublic class Helper {\n}\n", error)
+    assert result is not None
+    assert "Main" not in " ".join([result.summary, *result.howToFix])
+    assert any("Remove 'public' from class Helper" in fix for fix in result.howToFix)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from app import main
+from app.main import CompilePrewarmer, PrewarmQueueFull
+
+
+def sleeping_compile(lang, code, build):
+    """Stands in for g++/javac: the "source" is how many seconds the compile takes."""
+    proc = build.run(["sleep", code])
+    return None, (proc.stderr if proc.returncode != 0 else None)
+
+
+@pytest.fixture
+def prewarmer(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "COMPILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(CompilePrewarmer, "_compile", staticmethod(sleeping_compile))
+    monkeypatch.setattr(main, "PREWARM_MAX_PENDING", 2)
+    prewarmer = CompilePrewarmer(1)
+    monkeypatch.setattr(main, "compile_prewarmer", prewarmer)
+    yield prewarmer
+    for build in list(prewarmer.pending):
+        build.cancel()
+    prewarmer.executor.shutdown(wait=True)
+
+
+def test_newer_prewarm_cancels_the_editors_older_build(prewarmer):
+    async def go():
+        older = asyncio.create_task(prewarmer.prewarm("cpp", "30", "editor"))
+        await asyncio.sleep(0.2)
+        newer = await prewarmer.prewarm("cpp", "0.01", "editor")
+        return await older, newer
+
+    start = time.monotonic()
+    older, newer = asyncio.run(go())
+    assert time.monotonic() - start < 5
+    assert (older.status, newer.status) == ("cancelled", "ready")
+    assert prewarmer.pending == set() and prewarmer.latest == {}
+    assert prewarmer.stats["cancelled"] == 1
+
+
+def test_prewarms_past_the_limit_get_503(prewarmer):
+    async def go():
+        running = [asyncio.create_task(prewarmer.prewarm("cpp", f"30.{i}", None)) for i in range(2)]
+        await asyncio.sleep(0.2)
+        with pytest.raises(PrewarmQueueFull):
+            await prewarmer.prewarm("cpp", "30.2", "editor")
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post("/execute/prewarm", json={"language": "cpp", "code": "30.3"})
+        for build in list(prewarmer.pending):
+            build.cancel()
+        await asyncio.gather(*running)
+        return res
+
+    res = asyncio.run(go())
+    assert res.status_code == 503
+    assert res.headers["retry-after"] == "1"
+    assert prewarmer.stats["rejected"] == 2
+    assert prewarmer.pending == set()
+
+
+def test_superseding_build_does_not_count_against_the_limit(prewarmer):
+    async def go():
+        other = asyncio.create_task(prewarmer.prewarm("cpp", "30", None))
+        older = asyncio.create_task(prewarmer.prewarm("cpp", "30.1", "editor"))
+        await asyncio.sleep(0.2)
+        newer = asyncio.create_task(prewarmer.prewarm("cpp", "0.01", "editor"))
+        await asyncio.sleep(0.2)
+        for build in [b for b in prewarmer.pending if b is not prewarmer.latest.get("editor")]:
+            build.cancel()
+        return await other, await older, await newer
+
+    other, older, newer = asyncio.run(go())
+    assert (older.status, newer.status) == ("cancelled", "ready")
+    assert prewarmer.stats["rejected"] == 0
+
+
+def test_compile_that_never_finishes_is_killed(prewarmer, monkeypatch):
+    monkeypatch.setattr(main, "PREWARM_COMPILE_TIMEOUT", 0.3)
+    start = time.monotonic()
+    res = asyncio.run(prewarmer.prewarm("cpp", "30", "editor"))
+    assert time.monotonic() - start < 5
+    assert res.status == "error"
+    assert "timed out after 0.3s" in res.diagnostics[0].message
+    assert prewarmer.pending == set()
@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import main
+from app.main import ProviderHealth, probe_provider
+
+
+class FakeClient:
+    def __init__(self, get):
+        self.get = get
+
+
+@pytest.fixture
+def health(monkeypatch):
+    health = ProviderHealth("ollama")
+    monkeypatch.setitem(main.provider_health, "ollama", health)
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 0)
+    return health
+
+
+def use_client(monkeypatch, get):
+    monkeypatch.setattr(main.llm_http, "client", lambda provider: FakeClient(get))
+
+
+def open_circuit(health):
+    for _ in range(main.AI_BREAKER_FAILURES):
+        health.record_failure(httpx.ConnectError("refused"))
+    assert health.state == "open"
+
+
+def test_breaker_closed_open_half_open_closed(health, monkeypatch):
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 60)
+    assert health.allow() and health.state == "closed"
+    for _ in range(main.AI_BREAKER_FAILURES - 1):
+        health.record_failure(httpx.ConnectError("refused"))
+    assert health.state == "closed"
+    health.record_failure(httpx.ConnectError("refused"))
+    assert health.state == "open"
+    assert not health.allow() and not health.available()
+
+    monkeypatch.setattr(main, "AI_BREAKER_COOLDOWN", 0)
+    assert health.available()
+    assert health.allow()  # takes the single half-open trial
+    assert health.state == "half_open" and health.trial_in_flight
+    assert not health.allow() and not health.available()
+
+    health.record_success(0.05)
+    assert health.state == "closed" and not health.trial_in_flight and health.failures == 0
+
+
+def test_failed_trial_reopens_the_circuit(health):
+    open_circuit(health)
+    assert health.allow() and health.state == "half_open"
+    health.record_failure(httpx.ReadTimeout("slow"))
+    assert health.state == "open" and not health.trial_in_flight
+
+
+def test_successful_probe_closes_half_open_circuit(health, monkeypatch):
+    async def get(path, **kwargs):
+        return httpx.Response(200, request=httpx.Request("GET", f"http://ollama{path}"))
+
+    use_client(monkeypatch, get)
+    open_circuit(health)
+    asyncio.run(probe_provider("ollama"))
+    assert health.state == "closed" and health.up and not health.trial_in_flight
+
+
+def test_probe_error_that_is_not_http_releases_the_trial(health, monkeypatch):
+    async def get(path, **kwargs):
+        raise RuntimeError("Cannot send a request, as the client has been closed.")
+
+    use_client(monkeypatch, get)
+    open_circuit(health)
+    asyncio.run(probe_provider("ollama"))
+    assert health.state == "open" and not health.trial_in_flight
+    assert "client has been closed" in health.last_error
+    assert health.allow() and health.state == "half_open"
+
+
+def test_cancelled_probe_releases_the_trial(health, monkeypatch):
+    async def get(path, **kwargs):
+        await asyncio.sleep(10)
+
+    async def go():
+        probe = asyncio.create_task(probe_provider("ollama"))
+        await asyncio.sleep(0.05)
+        assert health.trial_in_flight
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    use_client(monkeypatch, get)
+    open_circuit(health)
+    asyncio.run(go())
+    assert health.state == "half_open" and not health.trial_in_flight
+    assert health.allow()
@@ -0,0 +1,56 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from app import main
+from app.main import PythonZygote
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="the Python pool needs fork()")
+
+
+@pytest.fixture
+def zygote():
+    zygote = PythonZygote()
+    yield zygote
+    zygote.close()
+
+
+@pytest.fixture
+def heavy_zygote(monkeypatch):
+    monkeypatch.setattr(main, "PYTHON_POOL_PRELOAD", "asyncio,email.mime.multipart,http.server,unittest,sqlite3,decimal,pydantic")
+    zygote = PythonZygote()
+    yield zygote
+    zygote.close()
+
+
+def write_program(tmp_path, code: str) -> str:
+    path = tmp_path / "main.py"
+    path.write_text(code)
+    return str(path)
+
+
+def test_run_is_killed_even_before_its_process_group_exists(zygote, tmp_path):
+    # A zero timeout kills the child right after fork, usually before it calls setsid()
+    path = write_program(tmp_path, "while True:\n    pass\n")
+    for _ in range(10):
+        start = time.monotonic()
+        with pytest.raises(subprocess.TimeoutExpired):
+            zygote.run(path, "", 0, {})
+        assert time.monotonic() - start < 2
+    assert zygote.alive()
+
+
+def test_peak_rss_leaves_out_what_the_zygote_preloaded(zygote, heavy_zygote, tmp_path):
+    path = write_program(tmp_path, "print(1)\n")
+    light = zygote.run(path, "", 5, {}).peak_rss_kb
+    heavy = heavy_zygote.run(path, "", 5, {}).peak_rss_kb
+    assert light and heavy
+    assert abs(heavy - light) < 4096
+
+
+def test_peak_rss_counts_what_the_run_allocates(zygote, tmp_path):
+    baseline = zygote.run(write_program(tmp_path, "print(1)\n"), "", 5, {}).peak_rss_kb
+    res = zygote.run(write_program(tmp_path, "data = bytearray(64 * 1024 * 1024)\nprint(len(data))\n"), "", 5, {})
+    assert res.peak_rss_kb - baseline > 60 * 1024
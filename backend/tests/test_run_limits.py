@@ -0,0 +1,35 @@
+import signal
+
+import pytest
+
+from app import main
+from app.main import RunResult
+
+
+@pytest.fixture
+def runs(monkeypatch):
+    """Record the timeout and rlimits of each cold Python run; every run hits the CPU limit."""
+    runs = []
+
+    def run_command(cmd, stdin, cwd=None, timeout=5, native=True, limits=None):
+        runs.append({"timeout": timeout, "cpu": limits["RLIMIT_CPU"]})
+        return RunResult(cmd, -signal.SIGXCPU, "", "", wall_time=0.1, limit_hit="cpu")
+
+    monkeypatch.setattr(main.python_pool, "size", 0)
+    monkeypatch.setattr(main, "run_command", run_command)
+    return runs
+
+
+def test_cpu_limit_scales_with_the_trace_timeout():
+    assert main.TRACE_CPU_LIMIT == main.math.ceil(main.RUN_CPU_LIMIT * main.TRACE_TIMEOUT / 5)
+    assert main.TRACE_CPU_LIMIT > main.RUN_CPU_LIMIT
+
+
+@pytest.mark.parametrize("mode", [{}, {"trace": True}, {"profile": True}])
+def test_each_mode_runs_under_its_own_cpu_limit(runs, mode):
+    res = main.run_submission("python", "print(1)\n", "", **mode)
+    slow = bool(mode)
+    cpu_limit = main.TRACE_CPU_LIMIT if slow else main.RUN_CPU_LIMIT
+    assert runs == [{"timeout": main.TRACE_TIMEOUT if slow else 5, "cpu": (cpu_limit, cpu_limit + 1)}]
+    assert res.limitHit == "cpu"
+    assert res.stderr.endswith(f"CPU time limit exceeded ({cpu_limit}s)")
@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+
+from app import main
+from app.main import TRACER_SRC, _apply_step, read_trace
+
+
+def trace(tmp_path, code: str, **config) -> tuple[str, list[dict], list[str], dict]:
+    """Run `code` under the tracer; returns (stdout, steps, names, info)."""
+    trace_path = os.path.join(tmp_path, "trace.jsonl")
+    config = {
+        "trace_path": trace_path,
+        "max_steps": main.TRACE_MAX_STEPS,
+        "max_bytes": main.TRACE_MAX_BYTES,
+        "loop_full": main.TRACE_LOOP_FULL,
+        "repr_limit": main.TRACE_REPR_LIMIT,
+        **config,
+    }
+    wrapper_path = os.path.join(tmp_path, "trace_wrapper.py")
+    with open(wrapper_path, "w") as f:
+        f.write(f"_CONFIG = {config!r}\n_USER_CODE = {code!r}\n" + TRACER_SRC)
+    proc = subprocess.run([sys.executable, wrapper_path], capture_output=True, text=True, timeout=30)
+    assert proc.stderr == ""
+    steps, names, info = read_trace(trace_path)
+    return proc.stdout, steps, names, info
+
+
+def replay(steps: list[dict], names: list[str]) -> list[tuple[int, dict]]:
+    """(line, locals by name) after each step."""
+    state: dict = {}
+    frames = []
+    for step in steps:
+        _apply_step(state, step)
+        frames.append((step["line"], {names[int(idx)]: value for idx, value in state.items()}))
+    return frames
+
+
+def test_deltas_replay_to_the_locals_of_every_step(tmp_path):
+    code = "x = 1\ny = [x]\nx = 'two'\ndel y\nprint(x)\n"
+    out, steps, names, info = trace(tmp_path, code)
+    assert out == "two\n"
+    assert sorted(names) == ["x", "y"]  # each name interned once
+    assert replay(steps, names) == [
+        (1, {}),
+        (2, {"x": "1"}),
+        (3, {"x": "1", "y": "[1]"}),
+        (4, {"x": "'two'", "y": "[1]"}),
+        (5, {"x": "'two'"}),
+    ]
+    # Unchanged variables are not repeated; the removed one is listed once
+    assert [len(step["set"]) for step in steps] == [0, 1, 1, 1, 0]
+    assert steps[4]["del"] == [names.index("y")]
+    assert info == {"truncated": None, "complete": True, "steps": 5, "sampled": 0}
+
+
+def test_only_the_users_frames_are_traced(tmp_path):
+    code = "import json\ndef f(a):\n    b = a * 2\n    return json.dumps(b)\nr = f(3)\n"
+    _, steps, names, _ = trace(tmp_path, code)
+    assert [line for line, _ in replay(steps, names)] == [1, 2, 5, 3, 4]
+    assert replay(steps, names)[-1][1] == {"a": "3", "b": "6"}
+
+
+def test_hot_lines_are_sampled_without_losing_changes(tmp_path):
+    code = "total = 0\nfor i in range(1000):\n    total += i\nprint(total)\n"
+    out, steps, names, info = trace(tmp_path, code, loop_full=8)
+    assert out == "499500\n"
+    traced = {line: sum(1 for step in steps if step["line"] == line) for line in (2, 3)}
+    assert 8 < traced[3] < 100
+    # The loop header runs once more than the body, when range() is exhausted
+    assert info["sampled"] == (1001 - traced[2]) + (1000 - traced[3])
+    line, local_vars = replay(steps, names)[-1]
+    assert line == 4 and local_vars == {"total": "499500", "i": "999"}
+
+
+def test_step_budget_stops_tracing_but_not_the_program(tmp_path):
+    code = "n = 0\nwhile n < 50:\n    n += 1\nprint(n)\n"
+    out, steps, _, info = trace(tmp_path, code, max_steps=10)
+    assert out == "50\n"
+    assert len(steps) == 10
+    assert info["truncated"] == "steps" and info["complete"] and info["steps"] == 10
+
+
+def test_byte_budget_counts_the_encoded_records(tmp_path):
+    code = "s = ''\nfor i in range(200):\n    s += 'x'\n"
+    _, steps, _, info = trace(tmp_path, code, max_bytes=2000, repr_limit=1000)
+    assert info["truncated"] == "bytes"
+    size = os.path.getsize(os.path.join(tmp_path, "trace.jsonl"))
+    last_step_bytes = len(json.dumps([3, [0, "x" * 200]], separators=(",", ":"))) + 1
+    assert 2000 <= size < 2000 + last_step_bytes + 100
+    assert len(steps) < 200
@@ -0,0 +1,100 @@
+import os
+import shutil
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+
+# x counts up on line 3 and y flips on line 4, for 10 iterations; x goes out of scope at the end
+STEPS = [{"line": 1, "set": {}}]
+for i in range(10):
+    STEPS.append({"line": 3, "set": {"0": str(i)}})
+    STEPS.append({"line": 4, "set": {"1": str(i % 2 == 0)}})
+STEPS.append({"line": 6, "set": {}, "del": [0]})
+NAMES = ["x", "y"]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TRACE_STORE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "TRACE_KEYFRAME_EVERY", 4)
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def trace_id(client):
+    return main.store_trace(STEPS, NAMES, {"truncated": None, "complete": True, "steps": len(STEPS)})
+
+
+def state_after(step: int) -> dict:
+    state: dict = {}
+    for s in STEPS[:step + 1]:
+        main._apply_step(state, s)
+    return state
+
+
+def test_summary(client, trace_id):
+    res = client.get(f"/trace/{trace_id}")
+    assert res.status_code == 200
+    assert res.json()["names"] == NAMES and res.json()["info"]["steps"] == 22
+
+
+@pytest.mark.parametrize("start", [0, 3, 4, 9, 21])
+def test_pages_start_from_the_nearest_keyframe(client, trace_id, start):
+    res = client.get(f"/trace/{trace_id}/steps", params={"start": start, "count": 5}).json()
+    assert res["total"] == 22
+    assert res["steps"] == STEPS[start:start + 5]
+    assert res["base"] == (state_after(start - 1) if start else {})
+
+
+def test_seek_to_the_nth_hit_of_a_line(client, trace_id):
+    res = client.get(f"/trace/{trace_id}/seek", params={"line": 4, "hit": 7}).json()
+    assert res == {"traceId": trace_id, "step": 14, "line": 4, "locals": {"x": "6", "y": "True"}}
+    res = client.get(f"/trace/{trace_id}/seek", params={"line": 6}).json()
+    assert res["locals"] == {"y": "False"}
+    missing = client.get(f"/trace/{trace_id}/seek", params={"line": 4, "hit": 11})
+    assert missing.status_code == 404 and "10 recorded hits" in missing.json()["detail"]
+
+
+def test_variable_history(client, trace_id):
+    res = client.get(f"/trace/{trace_id}/variables/x", params={"start": 8}).json()
+    assert res["total"] == 11
+    assert res["history"] == [
+        {"step": 17, "line": 3, "value": "8"},
+        {"step": 19, "line": 3, "value": "9"},
+        {"step": 21, "line": 6, "value": None},
+    ]
+    assert client.get(f"/trace/{trace_id}/variables/z").status_code == 404
+
+
+def test_evicted_trace_is_not_served_from_the_meta_cache(client, trace_id):
+    assert client.get(f"/trace/{trace_id}").status_code == 200
+    shutil.rmtree(os.path.join(main.TRACE_STORE_DIR, trace_id))
+    for path in ("", "/steps", "/variables/x"):
+        assert client.get(f"/trace/{trace_id}{path}").status_code == 404
+
+
+def test_expired_traces_are_gone_and_swept(client, trace_id, monkeypatch):
+    path = os.path.join(main.TRACE_STORE_DIR, trace_id)
+    past = time.time() - main.TRACE_STORE_TTL - 1
+    os.utime(os.path.join(path, "meta.json"), (past, past))
+    assert client.get(f"/trace/{trace_id}").status_code == 404
+    os.utime(path, (past, past))
+    main.store_trace(STEPS, NAMES, {})
+    assert not os.path.exists(path)
+
+
+def test_oldest_traces_are_evicted_past_the_limit(client, monkeypatch):
+    monkeypatch.setattr(main, "TRACE_STORE_MAX", 2)
+    ids = []
+    for i in range(3):
+        ids.append(main.store_trace(STEPS, NAMES, {}))
+        stamp = time.time() - 10 + i
+        os.utime(os.path.join(main.TRACE_STORE_DIR, ids[-1]), (stamp, stamp))
+    assert sorted(os.listdir(main.TRACE_STORE_DIR)) == sorted(ids[1:])
+
+
+def test_trace_ids_cannot_leave_the_store(client):
+    assert client.get("/trace/..%2F..%2Fetc").status_code == 404
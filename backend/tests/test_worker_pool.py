@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from app import main
+from app.main import PooledWorker, WorkerPool
+
+
+class FakeWorker(PooledWorker):
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def alive(self) -> bool:
+        return not self.closed
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class Factory:
+    """Starts FakeWorkers; the calls listed in `fail_on` (1-based) raise instead."""
+
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.calls = 0
+        self.started: list[FakeWorker] = []
+
+    def __call__(self) -> FakeWorker:
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise OSError("runtime not found")
+        worker = FakeWorker()
+        self.started.append(worker)
+        return worker
+
+
+@pytest.fixture(autouse=True)
+def backoff(monkeypatch):
+    monkeypatch.setattr(main, "WORKER_RESTART_BACKOFF", 0.2)
+
+
+def test_failed_first_fill_closes_the_workers_already_started():
+    factory = Factory(fail_on={3})
+    pool = WorkerPool("Fake", factory, size=3, wait=1)
+    assert pool.acquire() is None
+    assert len(factory.started) == 2 and all(w.closed for w in factory.started)
+    assert pool.size == 0
+    assert pool.acquire() is None and factory.calls == 3
+
+
+def test_dirty_worker_is_replaced_on_release():
+    factory = Factory()
+    pool = WorkerPool("Fake", factory, size=1, wait=1)
+    worker = pool.acquire()
+    worker.dirty = True
+    pool.release(worker)
+    assert worker.closed
+    replacement = pool.acquire()
+    assert replacement is factory.started[1] and not replacement.closed
+
+
+def test_failed_restart_is_retried_by_a_later_acquire():
+    factory = Factory(fail_on={2, 3})
+    pool = WorkerPool("Fake", factory, size=1, wait=5)
+    worker = pool.acquire()
+    worker.dirty = True
+    pool.release(worker)  # restart fails: the pool has no worker left
+
+    # Nothing to wait for: fall back to a cold process at once rather than after `wait`
+    start = time.monotonic()
+    assert pool.acquire() is None
+    assert time.monotonic() - start < 1 and factory.calls == 2
+
+    time.sleep(0.25)
+    assert pool.acquire() is None and factory.calls == 3  # failed again, backs off again
+    assert pool.acquire() is None and factory.calls == 3
+    time.sleep(0.25)
+    worker = pool.acquire()
+    assert worker is factory.started[-1] and factory.calls == 4
+    pool.release(worker)
+    assert pool.acquire() is worker
+
+
+def test_waits_for_a_busy_worker_while_another_is_missing():
+    factory = Factory(fail_on={3, 4})
+    pool = WorkerPool("Fake", factory, size=2, wait=0.3)
+    first, second = pool.acquire(), pool.acquire()
+    second.dirty = True
+    pool.release(second)  # one worker missing, the other still busy
+    start = time.monotonic()
+    assert pool.acquire() is None
+    assert time.monotonic() - start >= 0.25
+    pool.release(first)
+    assert pool.acquire() is first
@@ -8,6 +8,7 @@ import { python } from '@codemirror/lang-python'
 import { cpp } from '@codemirror/lang-cpp'
 import { java } from '@codemirror/lang-java'
 import { javascript } from '@codemirror/lang-javascript'
+import { prewarmCompile } from '../services/executeApi'
 
 type Language = 'python' | 'javascript' | 'cpp' | 'java'
 
@@ -15,6 +16,8 @@ type Props = {
   value: string
   language: Language
   onChange(value: string): void
+  // Character offset of the cursor, reported as it moves
+  onCursor?(offset: number): void
 }
 
 const keywordDocs: Record<Language, Record<string, string>> = {
@@ -82,8 +85,26 @@ function languageExtensions(lang: Language): Extension {
   }
 }
 
-function simpleLinter(lang: Language) {
-  return linter((view): Diagnostic[] => {
+// Compiles C++/Java in the background after edits (the linter's debounce); the run that
+// follows reuses the build, and compiler errors show up as inline markers.
+async function compilerDiagnostics(view: EditorView, lang: 'cpp' | 'java', editorId: string): Promise<Diagnostic[]> {
+  const doc = view.state.doc
+  try {
+    const res = await prewarmCompile(lang, doc.toString(), editorId)
+    return res.diagnostics
+      .filter(d => d.line !== null && d.line <= doc.lines)
+      .map(d => {
+        const line = doc.line(d.line!)
+        const from = Math.min(line.from + Math.max((d.column ?? 1) - 1, 0), line.to)
+        return { from, to: d.column === null ? line.to : from, severity: d.severity, message: d.message, source: 'compiler' }
+      })
+  } catch {
+    return []
+  }
+}
+
+function simpleLinter(lang: Language, editorId: string) {
+  return linter(async (view): Promise<Diagnostic[]> => {
     const text = view.state.doc.toString()
     const diags: Diagnostic[] = []
 
@@ -140,6 +161,8 @@ function simpleLinter(lang: Language) {
       })
     }
 
+    if (lang === 'cpp' || lang === 'java') diags.push(...await compilerDiagnostics(view, lang, editorId))
+
     return diags
   })
 }
@@ -213,9 +236,10 @@ function tooltipExtension(lang: Language): Extension {
   })
 }
 
-export function CodeEditor({ value, language, onChange }: Props) {
+export function CodeEditor({ value, language, onChange, onCursor }: Props) {
   const ref = useRef<HTMLDivElement | null>(null)
   const viewRef = useRef<EditorView | null>(null)
+  const editorId = useRef(Math.random().toString(36).slice(2))
 
   useEffect(() => {
     if (!ref.current) return
@@ -225,10 +249,11 @@ export function CodeEditor({ value, language, onChange }: Props) {
         oneDark,
         syntaxHighlighting(defaultHighlightStyle, { fallback: true }),
         languageExtensions(language),
-        simpleLinter(language),
+        simpleLinter(language, editorId.current),
         tooltipExtension(language),
         EditorView.updateListener.of(v => {
           if (v.docChanged) onChange(v.state.doc.toString())
+          if (v.selectionSet) onCursor?.(v.state.selection.main.head)
         }),
         EditorView.editable.of(true),
         EditorView.lineWrapping,
@@ -265,11 +290,14 @@ export function CodeEditor({ value, language, onChange }: Props) {
         oneDark,
         syntaxHighlighting(defaultHighlightStyle, { fallback: true }),
         languageExtensions(language),
-        simpleLinter(language),
+        simpleLinter(language, editorId.current),
         tooltipExtension(language),
         EditorView.editable.of(true),
         EditorView.lineWrapping,
-        EditorView.updateListener.of(v => { if (v.docChanged) onChange(v.state.doc.toString()) }),
+        EditorView.updateListener.of(v => {
+          if (v.docChanged) onChange(v.state.doc.toString())
+          if (v.selectionSet) onCursor?.(v.state.selection.main.head)
+        }),
         EditorView.theme({
           '&': {
             fontSize: '15px',
@@ -1,5 +1,5 @@
 import { useEffect, useMemo, useState, useRef } from 'react'
-import { executeCode } from '../../services/executeApi'
+import { executeStream } from '../../services/executeApi'
 import { aiSuggest, aiExplain } from '../../services/aiApi'
 import { recommend } from '../../services/recommendApi'
 import { CodeEditor } from '../../components/CodeEditor'
@@ -71,6 +71,7 @@ export function Playground() {
   const [editorWidth, setEditorWidth] = useState(60) // percentage - default 60% for better code visibility
   const [isResizing, setIsResizing] = useState(false)
   const containerRef = useRef<HTMLDivElement>(null)
+  const cursorRef = useRef<number | undefined>(undefined)
 
   const activeTab = useMemo(
     () => tabs.find(t => t.id === activeId)!,
@@ -96,14 +97,37 @@ export function Playground() {
     setLastRunCode(activeTab.content)
     
     try {
-      const res = await executeCode({ language, code: activeTab.content, stdin, trace: false })
+      // Stream output into the panel as the program produces it
+      let live = ''
+      const append = (chunk: string) => {
+        live += chunk
+        setOutput(live)
+      }
+      // The server starts the AI suggestions while the program runs and answers with
+      // suggestions or an error explanation right after it exits
+      const stream = executeStream(
+        { language, code: activeTab.content, stdin },
+        { onStdout: append, onStderr: append },
+        false,
+        { cursor: cursorRef.current, goal: 'assist coding', hints: detectAlgorithms(activeTab.content) }
+      )
+      const result = await stream.done
+      const res = {
+        output: result.output,
+        stderr: result.timedOut
+          ? (result.stderr ? `${result.stderr}\n` : '') + '⏱ Execution timed out'
+          : result.exitCode !== 0 ? result.stderr : undefined
+      }
       
       if (res.stderr) {
         setOutput(res.stderr)
         setError('Execution Error')
         // Ask AI to explain the error
         try {
-          const ai = await aiExplain(language, activeTab.content, res.stderr)
+          const analysis = await stream.analysis
+          const ai = analysis?.kind === 'explain' && analysis.response
+            ? analysis.response
+            : await aiExplain(language, activeTab.content, res.stderr)
           setAiData({ suggestions: ai.lineFixes || [], explanation: ai.summary, qualityNotes: ai.walkthrough, variables: [] })
           setErrorExplanation({
             beginnerExplanation: ai.beginnerExplanation,
@@ -121,7 +145,10 @@ export function Playground() {
         try {
           setAiLoading(true)
           console.log('[DEBUG] Fetching AI suggestions...')
-          const aiRes = await aiSuggest({ language, code: activeTab.content, goal: 'assist coding', hints: detectAlgorithms(activeTab.content) })
+          const analysis = await stream.analysis
+          const aiRes = analysis?.kind === 'suggest' && analysis.response
+            ? analysis.response
+            : await aiSuggest({ language, code: activeTab.content, cursor: cursorRef.current, goal: 'assist coding', hints: detectAlgorithms(activeTab.content) })
           console.log('[DEBUG] AI Response:', aiRes)
           setAiData(aiRes)
           setErrorExplanation({}) // Clear error explanation on success
@@ -243,7 +270,7 @@ export function Playground() {
               </div>
             </div>
             <div style={{ flex: 1, background: '#0d1117', overflow: 'hidden' }}>
-              <CodeEditor value={activeTab.content} language={language} onChange={onEdit} />
+              <CodeEditor value={activeTab.content} language={language} onChange={onEdit} onCursor={pos => { cursorRef.current = pos }} />
             </div>
           </div>
 
@@ -3,7 +3,7 @@ const API_BASE = import.meta.env.VITE_API_BASE ?? 'http://localhost:8000'
 type AISuggestRequest = {
   language: string
   code: string
-  cursor?: number
+  cursor?: number // character offset into code; centers the excerpt of long files
   goal?: string
   hints?: string[]
 }
@@ -19,6 +19,7 @@ export type AISuggestResponse = {
   timeComplexity?: string
   spaceComplexity?: string
   whyThisApproach?: string
+  chunks?: { analyzed: number; reused: number; failed: number; pending: number } // session answers only
 }
 
 export async function aiSuggest(req: AISuggestRequest): Promise<AISuggestResponse> {
@@ -39,6 +40,7 @@ export type AIExplainResponse = {
   whyItHappened?: string
   howToFix?: string[]
   proTip?: string
+  instant?: boolean // answered by the built-in error rules
 }
 
 export async function aiExplain(language: string, code: string, error?: string): Promise<AIExplainResponse> {
@@ -51,4 +53,113 @@ export async function aiExplain(language: string, code: string, error?: string):
   return await res.json()
 }
 
+export type AIStreamHandlers<T> = {
+  // More text of a string field that is still being generated
+  onDelta?: (field: keyof T & string, text: string) => void
+  // A field is complete
+  onField?: (field: keyof T & string, value: unknown) => void
+}
+
+// Reads the server-sent events of /ai/suggest/stream or /ai/explain/stream; resolves with the final response.
+async function streamAI<T>(path: string, body: unknown, handlers: AIStreamHandlers<T>): Promise<T> {
+  const res = await fetch(`${API_BASE}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body)
+  })
+  if (!res.ok || !res.body) throw new Error(await res.text())
+  const reader = res.body.pipeThrough(new TextDecoderStream()).getReader()
+  let buffer = ''
+  for (;;) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buffer += value
+    let end: number
+    while ((end = buffer.indexOf('\n\n')) >= 0) {
+      const block = buffer.slice(0, end)
+      buffer = buffer.slice(end + 2)
+      const event = /^event: (.*)$/m.exec(block)?.[1]
+      const data = JSON.parse(/^data: (.*)$/m.exec(block)?.[1] ?? 'null')
+      if (event === 'delta') handlers.onDelta?.(data.field, data.text)
+      else if (event === 'field') handlers.onField?.(data.field, data.value)
+      else if (event === 'done') return data.response as T
+      else if (event === 'error') throw new Error(JSON.stringify(data.detail))
+    }
+  }
+  throw new Error('AI stream ended without a response')
+}
+
+export function aiSuggestStream(req: AISuggestRequest, handlers: AIStreamHandlers<AISuggestResponse>): Promise<AISuggestResponse> {
+  return streamAI('/ai/suggest/stream', req, handlers)
+}
+
+export function aiExplainStream(
+  language: string,
+  code: string,
+  error: string | undefined,
+  handlers: AIStreamHandlers<AIExplainResponse>
+): Promise<AIExplainResponse> {
+  return streamAI('/ai/explain/stream', { language, code, error }, handlers)
+}
+
+type AISessionEdit = { start: number; end: number; text: string }
+
+// The single edit turning `before` into `after` (common prefix and suffix kept)
+function diffEdit(before: string, after: string): AISessionEdit | null {
+  if (before === after) return null
+  let start = 0
+  while (start < before.length && start < after.length && before[start] === after[start]) start++
+  let tail = 0
+  while (
+    tail < before.length - start && tail < after.length - start &&
+    before[before.length - 1 - tail] === after[after.length - 1 - tail]
+  ) tail++
+  return { start, end: before.length - tail, text: after.slice(start, after.length - tail) }
+}
+
+// Suggestions for a document kept on the server: each call uploads only what changed since the
+// last one, and the server re-analyzes only the functions/classes that changed.
+export class AISuggestSession {
+  private id: string | null = null
+  private version = 0
+  private synced = ''
 
+  constructor(private language: string) {}
+
+  private async open(code: string) {
+    const res = await fetch(`${API_BASE}/ai/sessions`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ language: this.language, code })
+    })
+    if (!res.ok) throw new Error(await res.text())
+    const session = await res.json()
+    this.id = session.sessionId
+    this.version = session.version
+    this.synced = code
+  }
+
+  async suggest(code: string, opts: Omit<AISuggestRequest, 'language' | 'code'> = {}, retry = true): Promise<AISuggestResponse> {
+    if (this.id === null) await this.open(code)
+    const edit = diffEdit(this.synced, code)
+    const res = await fetch(`${API_BASE}/ai/sessions/${this.id}/suggest`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ ...opts, version: this.version, edits: edit ? [edit] : [] })
+    })
+    if (retry && (res.status === 404 || res.status === 409)) {
+      // Expired, or at another version than ours: start over with the full text
+      this.id = null
+      return this.suggest(code, opts, false)
+    }
+    if (!res.ok) throw new Error(await res.text())
+    if (edit) this.version += 1
+    this.synced = code
+    return await res.json()
+  }
+
+  close() {
+    if (this.id !== null) fetch(`${API_BASE}/ai/sessions/${this.id}`, { method: 'DELETE' }).catch(() => {})
+    this.id = null
+  }
+}
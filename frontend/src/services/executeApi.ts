@@ -1,3 +1,5 @@
+import type { AISuggestResponse, AIExplainResponse } from './aiApi'
+
 const API_BASE = import.meta.env.VITE_API_BASE ?? 'http://localhost:8000'
 
 type ExecuteRequest = {
@@ -5,11 +7,29 @@ type ExecuteRequest = {
   code: string
   stdin?: string
   trace?: boolean
+  profile?: boolean
+}
+
+export type LimitHit = 'cpu' | 'memory' | 'output' | 'processes' | 'wall'
+
+export type ProfileReport = {
+  tool: 'cProfile' | 'gprof' | 'jvm-sampler' | null
+  totalMs: number | null
+  functions: { name: string; line: number | null; calls: number | null; selfMs: number | null; totalMs: number | null }[]
+  lines: { line: number; hits: number; timeMs: number }[]
+  note: string | null
 }
 
 type ExecuteResponse = {
   output?: string
   stderr?: string
+  exitCode?: number | null
+  wallTimeMs?: number | null
+  cpuTimeMs?: number | null
+  compileTimeMs?: number | null
+  peakRssKb?: number | null
+  limitHit?: LimitHit | null
+  profile?: ProfileReport | null
 }
 
 export async function executeCode(body: ExecuteRequest): Promise<ExecuteResponse> {
@@ -25,3 +45,130 @@ export async function executeCode(body: ExecuteRequest): Promise<ExecuteResponse
 }
 
 
+
+export type CompileDiagnostic = {
+  line: number | null
+  column: number | null
+  severity: 'error' | 'warning'
+  message: string
+}
+
+export type PrewarmResponse = {
+  status: 'ready' | 'error' | 'cancelled'
+  sourceHash: string | null
+  compileTimeMs: number | null
+  diagnostics: CompileDiagnostic[]
+}
+
+// Compiles C++/Java in the background so the next run of the same code starts at once;
+// newer code with the same editorId cancels the older build.
+export async function prewarmCompile(language: 'cpp' | 'java', code: string, editorId?: string): Promise<PrewarmResponse> {
+  const res = await fetch(`${API_BASE}/execute/prewarm`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ language, code, editorId })
+  })
+  if (!res.ok) throw new Error(await res.text())
+  return (await res.json()) as PrewarmResponse
+}
+
+export type ExecuteStreamHandlers = {
+  onStdout?: (data: string) => void
+  onStderr?: (data: string) => void
+}
+
+export type ExecuteStreamResult = {
+  output: string
+  stderr: string
+  exitCode: number | null
+  wallTimeMs: number | null
+  timedOut: boolean
+  limitHit: LimitHit | null
+}
+
+// AI options for a streamed run: suggestions are requested while the program runs
+export type RunAnalyzeOptions = {
+  cursor?: number
+  goal?: string
+  hints?: string[]
+}
+
+export type RunAnalysis =
+  | { kind: 'suggest'; response?: AISuggestResponse; error?: unknown }
+  | { kind: 'explain'; response?: AIExplainResponse; error?: unknown }
+
+export type ExecuteStream = {
+  sendStdin: (data: string) => void
+  closeStdin: () => void
+  kill: () => void
+  done: Promise<ExecuteStreamResult>
+  // Suggestions on success or an explanation of the error; null unless `analyze` was given
+  analysis: Promise<RunAnalysis | null>
+}
+
+// Runs code over the /execute/stream WebSocket, delivering stdout/stderr as it is produced.
+// Unless `interactive` is set, stdin is closed right after `body.stdin` is sent.
+export function executeStream(
+  body: ExecuteRequest,
+  handlers: ExecuteStreamHandlers = {},
+  interactive = false,
+  analyze?: RunAnalyzeOptions
+): ExecuteStream {
+  const ws = new WebSocket(`${API_BASE.replace(/^http/, 'ws')}/execute/stream`)
+  const send = (msg: object) => {
+    if (ws.readyState === WebSocket.OPEN) ws.send(JSON.stringify(msg))
+  }
+  let output = ''
+  let stderr = ''
+  let settleAnalysis: (analysis: RunAnalysis | null) => void = () => {}
+  const analysis = new Promise<RunAnalysis | null>((resolve) => {
+    settleAnalysis = resolve
+  })
+  if (!analyze) settleAnalysis(null)
+
+  const done = new Promise<ExecuteStreamResult>((resolve, reject) => {
+    ws.onopen = () => {
+      ws.send(JSON.stringify(analyze ? { ...body, analyze } : body))
+      if (!interactive) send({ eof: true })
+    }
+    ws.onmessage = (event) => {
+      const frame = JSON.parse(event.data)
+      if (frame.type === 'stdout') {
+        output += frame.data
+        handlers.onStdout?.(frame.data)
+      } else if (frame.type === 'stderr') {
+        stderr += frame.data
+        handlers.onStderr?.(frame.data)
+      } else if (frame.type === 'exit') {
+        resolve({
+          output,
+          stderr,
+          exitCode: frame.exitCode,
+          wallTimeMs: frame.wallTimeMs,
+          timedOut: frame.timedOut,
+          limitHit: frame.limitHit ?? null
+        })
+        if (!analyze) ws.close()
+      } else if (frame.type === 'analysis') {
+        settleAnalysis({ kind: frame.kind, response: frame.response, error: frame.error })
+        ws.close()
+      } else if (frame.type === 'error') {
+        reject(new Error(frame.message || 'Execution failed'))
+        ws.close()
+      }
+    }
+    ws.onerror = () => reject(new Error('Failed to fetch: streaming connection error'))
+    ws.onclose = () => {
+      reject(new Error('Execution stream closed unexpectedly'))
+      settleAnalysis(null)
+    }
+  })
+
+  return {
+    sendStdin: (data) => send({ stdin: data }),
+    closeStdin: () => send({ eof: true }),
+    kill: () => send({ kill: true }),
+    done,
+    analysis
+  }
+}